@@ -0,0 +1,482 @@
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import logging
+import os
+import pickle
+import time
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import silhouette_score
+from threadpoolctl import threadpool_limits
+
+# Setting up a logger
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def iter_row_chunks(matrix, chunk_rows=10000):
+    '''
+    Slices a feature matrix into consecutive blocks of rows
+
+    Args
+        matrix: scipy sparse or numpy matrix, or a featureMatrix
+
+        chunk_rows: int, default = 10000. Rows per block
+
+    Returns
+        Generator of matrices of at most chunk_rows rows
+    '''
+
+    matrix = getattr(matrix, 'matrix', matrix)
+
+    for start in range(0, matrix.shape[0], chunk_rows):
+        yield matrix[start:start + chunk_rows]
+
+
+def write_feature_chunks(matrix, directory, chunk_rows=10000) -> list:
+    '''
+    Writes a feature matrix to disk as blocks of rows, so it can be fitted
+    without holding it in memory. Chunks left by an earlier write are
+    removed, and a manifest of the features they hold is written last.
+
+    Args
+        matrix: scipy sparse matrix or featureMatrix
+
+        directory: directory to write the chunk files to
+
+        chunk_rows: int, default = 10000. Rows per file
+
+    Returns
+        List of the written file paths, in row order
+    '''
+
+    os.makedirs(directory, exist_ok=True)
+
+    manifest_path = os.path.join(directory, 'manifest.json')
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    for path in feature_chunk_paths(directory):
+        os.remove(path)
+
+    paths = []
+    for i, chunk in enumerate(iter_row_chunks(matrix, chunk_rows)):
+        path = os.path.join(directory, f'features_{i:06d}.npz')
+        sparse.save_npz(path, sparse.csr_matrix(chunk), compressed=False)
+        paths.append(path)
+
+    manifest = {'features_key': features_key(matrix),
+                'chunk_rows': chunk_rows,
+                'n_rows': getattr(matrix, 'matrix', matrix).shape[0],
+                'n_chunks': len(paths)}
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    return paths
+
+
+def feature_chunks_match(directory, matrix, chunk_rows=10000) -> bool:
+    '''
+    Checks whether the chunks in a directory hold a feature matrix
+
+    Args
+        directory: directory of the chunk files
+
+        matrix: scipy sparse matrix or featureMatrix
+
+        chunk_rows: int, default = 10000. Rows per file
+
+    Returns
+        True if the chunks were written from the same features with the
+        same number of rows per file
+    '''
+
+    try:
+        with open(os.path.join(directory, 'manifest.json')) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return False
+
+    return manifest.get('chunk_rows') == chunk_rows and \
+        manifest.get('n_chunks') == len(feature_chunk_paths(directory)) and \
+        manifest.get('features_key') == features_key(matrix)
+
+
+def feature_chunk_paths(directory) -> list:
+    '''
+    Lists the chunk files written by write_feature_chunks
+
+    Args
+        directory: directory of the chunk files
+
+    Returns
+        List of file paths in row order, empty if there are none
+    '''
+
+    if not os.path.isdir(directory):
+        return []
+
+    return [os.path.join(directory, name)
+            for name in sorted(os.listdir(directory))
+            if name.startswith('features_') and name.endswith('.npz')]
+
+
+def read_feature_chunks(directory):
+    '''
+    Reads the feature chunks written by write_feature_chunks one at a time
+
+    Args
+        directory: directory of the chunk files
+
+    Returns
+        Generator of scipy sparse matrices, in row order
+    '''
+
+    for path in feature_chunk_paths(directory):
+        yield sparse.load_npz(path)
+
+
+def fit_minibatch_kmeans(chunks, n_clusters, max_epochs=10, tol=1e-3,
+                         random_state=None, init='k-means++') -> tuple:
+    '''
+    Fits MiniBatchKMeans with partial_fit, one chunk of rows at a time,
+    so memory is bounded by the chunk size rather than the number of
+    users. Passes over the data stop once the centers move less than tol
+    relative to their size.
+
+    Args
+        chunks: function returning a new iterable of row chunks for every
+        pass, for example lambda: iter_row_chunks(matrix) or
+        lambda: read_feature_chunks(directory)
+
+        n_clusters: int, number of clusters
+
+        max_epochs: int, default = 10. Most passes over the data
+
+        tol: float, default = 1e-3. Relative center shift between passes
+        under which the fit has converged
+
+        random_state: int, default = None. Seed of the center
+        initialization
+
+        init: string or array of shape (n_clusters, n_features), default
+        = 'k-means++'. Initial centers, for example those of a fit on a
+        sample of the rows
+
+    Returns
+        Tuple of the fitted MiniBatchKMeans and a pandas dataframe with
+        the inertia and center shift of each pass
+    '''
+
+    k_means = MiniBatchKMeans(n_clusters=n_clusters,
+                              random_state=random_state,
+                              init=init,
+                              n_init=1)
+
+    report = []
+    centers = None
+
+    for epoch in range(1, max_epochs + 1):
+        inertia = 0.0
+        n_rows = 0
+
+        for chunk in chunks():
+            k_means.partial_fit(chunk)
+
+            # Inertia of the chunk against the updated centers
+            inertia -= k_means.score(chunk)
+            n_rows += chunk.shape[0]
+
+        shift = np.inf if centers is None else \
+            np.linalg.norm(k_means.cluster_centers_ - centers) / \
+            max(np.linalg.norm(centers), np.finfo(float).eps)
+        centers = k_means.cluster_centers_.copy()
+
+        report.append({'epoch': epoch,
+                       'rows': n_rows,
+                       'inertia': inertia,
+                       'center_shift': shift})
+
+        logger.info("Epoch %s of %s: inertia %.4g, center shift %.3g",
+                    epoch, max_epochs, inertia, shift)
+
+        if shift < tol:
+            logger.info("MiniBatchKMeans converged after %s epochs", epoch)
+            break
+    else:
+        logger.info("MiniBatchKMeans stopped after %s epochs without "
+                    "converging", max_epochs)
+
+    return k_means, pd.DataFrame(report).set_index('epoch')
+
+
+def predict_chunks(k_means, chunks) -> np.ndarray:
+    '''
+    Assigns clusters one chunk of rows at a time
+
+    Args
+        k_means: fitted KMeans or MiniBatchKMeans
+
+        chunks: iterable of row chunks
+
+    Returns
+        Numpy array of the cluster of every row, in chunk order
+    '''
+
+    labels = [k_means.predict(chunk) for chunk in chunks]
+
+    return np.concatenate(labels) if labels else np.zeros(0, dtype=np.int32)
+
+
+def features_key(matrix, feature_names=None) -> str:
+    '''
+    Hashes the content of a feature matrix, so fitted models are reused
+    only for the exact same features
+
+    Args
+        matrix: scipy sparse matrix or featureMatrix
+
+        feature_names: list of column names, default = None for the names
+        of a featureMatrix
+
+    Returns
+        Hex digest of the matrix and its column names
+    '''
+
+    if feature_names is None:
+        feature_names = getattr(matrix, 'feature_names', [])
+    matrix = sparse.csr_matrix(getattr(matrix, 'matrix', matrix))
+    matrix.sort_indices()
+
+    digest = hashlib.sha256()
+    digest.update(repr((matrix.shape, str(matrix.dtype),
+                        list(feature_names))).encode('utf-8'))
+    for array in (matrix.indptr, matrix.indices, matrix.data):
+        digest.update(np.ascontiguousarray(array).tobytes())
+
+    return digest.hexdigest()
+
+
+def stratified_sample(strata, size, random_state=None) -> np.ndarray:
+    '''
+    Draws rows so every stratum keeps its share of the sample, with at
+    least one row from each
+
+    Args
+        strata: pandas series or array of the stratum of every row, like
+        the country of each user
+
+        size: int, number of rows to draw. All rows are kept if there are
+        fewer
+
+        random_state: int, default = None. Seed of the draw
+
+    Returns
+        Numpy array of the sorted positions of the drawn rows
+    '''
+
+    codes, uniques = pd.factorize(np.asarray(strata), use_na_sentinel=False)
+    n_rows = len(codes)
+    if size >= n_rows:
+        return np.arange(n_rows)
+
+    counts = np.bincount(codes, minlength=len(uniques))
+    quotas = np.maximum(np.round(counts * size / n_rows), 1).astype(np.int64)
+
+    # Rank of each row within its stratum after a random shuffle
+    order = np.random.default_rng(random_state).permutation(n_rows)
+    order = order[np.argsort(codes[order], kind='stable')]
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    ranks = np.arange(n_rows) - starts[codes[order]]
+
+    return np.sort(order[ranks < quotas[codes[order]]])
+
+
+class modelCache:
+    '''
+    On-disk cache of fitted clustering models, pickled under a key of the
+    feature set hash, the number of clusters and the fit settings
+    '''
+
+    def __init__(self, cache_dir='.model_cache') -> None:
+        self.cache_dir = cache_dir
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(feature_key, k, random_state=None) -> str:
+        '''
+        Builds the key of a model
+
+        Args
+            feature_key: hash of the features from features_key
+
+            k: int, number of clusters
+
+            random_state: int, default = None. Seed of the fit
+
+        Returns
+            String used as the cache file name
+        '''
+
+        return f'{feature_key[:32]}_k{k}_seed{random_state}'
+
+    def _path(self, key) -> str:
+        return os.path.join(self.cache_dir, f'{key}.pkl')
+
+    def get(self, key):
+        '''Loads a cached model, or returns None on a cache miss'''
+
+        try:
+            with open(self._path(key), 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, model) -> None:
+        '''Stores a fitted model'''
+
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+
+        # Writing to a temporary file so readers never see partial models
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(model, f)
+        os.replace(tmp_path, path)
+
+
+# Helper for the Davies-Bouldin index without densifying the features
+def _davies_bouldin(matrix, labels, k) -> float:
+    present = np.unique(labels)
+    if len(present) < 2:
+        return np.nan
+
+    # Float64, the expanded distances cancel badly in float32
+    matrix = matrix.astype(np.float64)
+    indicator = sparse.csr_matrix(
+        (np.ones(len(labels)), (labels, np.arange(len(labels)))),
+        shape=(k, len(labels)))
+    sizes = np.asarray(indicator.sum(axis=1)).ravel()
+    centers = (indicator @ matrix).toarray() / np.maximum(sizes, 1)[:, None]
+
+    # Distance of each row to the mean of its cluster
+    row_norms = np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel()
+    dots = np.asarray(matrix @ centers.T)[np.arange(len(labels)), labels]
+    center_norms = (centers ** 2).sum(axis=1)
+    distances = np.sqrt(np.maximum(
+        row_norms - 2 * dots + center_norms[labels], 0))
+
+    scatter = np.bincount(labels, weights=distances, minlength=k) / \
+        np.maximum(sizes, 1)
+    scatter, centers = scatter[present], centers[present]
+
+    separation = np.linalg.norm(centers[:, None, :] - centers[None, :, :],
+                                axis=2)
+
+    # Coinciding centers, and each center with itself, add no ratio
+    separation[separation <= 1e-12] = np.inf
+    ratios = (scatter[:, None] + scatter[None, :]) / separation
+
+    return float(ratios.max(axis=1).mean())
+
+
+# Task run by the worker processes, fitting k unless a model is given.
+# Each worker keeps OpenMP and BLAS to one thread, the pool already runs
+# one worker per core
+def _score_k(matrix, k, model=None, silhouette_size=10000,
+             random_state=None) -> tuple:
+    with threadpool_limits(limits=1):
+        start = time.perf_counter()
+
+        fitted = model is None
+        if fitted:
+            model = KMeans(n_clusters=k, random_state=random_state)\
+                .fit(matrix)
+
+        labels = model.predict(matrix)
+        silhouette = silhouette_score(
+            matrix, labels,
+            sample_size=min(silhouette_size, matrix.shape[0]),
+            random_state=random_state) \
+            if 1 < len(np.unique(labels)) < matrix.shape[0] else np.nan
+
+        metrics = {'k': k,
+                   'inertia': -model.score(matrix),
+                   'silhouette': silhouette,
+                   'davies_bouldin': _davies_bouldin(matrix, labels, k),
+                   'seconds': time.perf_counter() - start}
+
+    return metrics, model if fitted else None
+
+
+def select_k(matrix, k_values=range(2, 16), sample_size=100000, strata=None,
+             silhouette_size=10000, n_workers=None, cache_dir='.model_cache',
+             random_state=0) -> tuple:
+    '''
+    Fits KMeans for a range of k on a stratified sample of the features
+    in a process pool, reusing the models cached for the same sample
+
+    Args
+        matrix: scipy sparse matrix or featureMatrix, one row per user
+
+        k_values: iterable of ints, default = range(2, 16). Numbers of
+        clusters to compare
+
+        sample_size: int, default = 100000. Rows fitted for every k
+
+        strata: pandas series or array aligned with the rows, default =
+        None for a simple random sample
+
+        silhouette_size: int, default = 10000. Rows the silhouette is
+        computed on, since it is quadratic in the rows
+
+        n_workers: int, default = None for one process per CPU
+
+        cache_dir: string, default = '.model_cache'. Directory of the
+        fitted models, None to disable the cache
+
+        random_state: int, default = 0. Seed of the sample and the fits
+
+    Returns
+        Tuple of a pandas dataframe indexed by k with the inertia,
+        silhouette, Davies-Bouldin index, fit seconds and whether the
+        model came from the cache, and a dictionary of k to fitted model
+    '''
+
+    matrix = sparse.csr_matrix(getattr(matrix, 'matrix', matrix))
+    if strata is None:
+        strata = np.zeros(matrix.shape[0], dtype=np.int8)
+
+    rows = stratified_sample(strata, sample_size, random_state=random_state)
+    sample = matrix[rows]
+
+    cache = modelCache(cache_dir) if cache_dir is not None else None
+    feature_key = features_key(sample)
+    keys = {k: modelCache.key(feature_key, k, random_state)
+            for k in k_values}
+    models = {k: cache.get(key) if cache is not None else None
+              for k, key in keys.items()}
+
+    # The sample is sent once per k, it is bounded by sample_size
+    with ProcessPoolExecutor(max_workers=n_workers or os.cpu_count()) \
+            as pool:
+        futures = {k: pool.submit(_score_k, sample, k, models[k],
+                                  silhouette_size, random_state)
+                   for k in keys}
+        results = {k: future.result() for k, future in futures.items()}
+
+    report = []
+    for k, (metrics, model) in results.items():
+        metrics['cached'] = model is None
+        if model is not None:
+            models[k] = model
+            if cache is not None:
+                cache.put(keys[k], model)
+        report.append(metrics)
+
+    logger.info("Compared %s values of k on %s sampled rows",
+                len(report), sample.shape[0])
+
+    return pd.DataFrame(report).set_index('k').sort_index(), models
@@ -0,0 +1,178 @@
+import numpy as np
+import pandas as pd
+from src.data_loader import FLAG_COLUMNS
+
+# Cohort lengths supported by assign_cohorts
+COHORT_FREQS = ['day', 'week', 'month']
+
+
+# Helper parsing a date column once per distinct value
+def _to_days(dates) -> np.ndarray:
+    codes, uniques = pd.factorize(dates)
+    days = pd.to_datetime(uniques).to_numpy().astype('datetime64[D]')
+
+    return np.append(days, np.datetime64('NaT', 'D'))[codes]
+
+
+def assign_cohorts(dates, freq='week', origin=None) -> np.ndarray:
+    '''
+    Numbers the day, week or month of each date with datetime64
+    arithmetic, without a per-row function
+
+    Args
+        dates: pandas series or array of dates, YYYYMMDD strings or
+        datetimes
+
+        freq: string, default = 'week'. One of 'day', 'week' or 'month'
+
+        origin: date, default = None for the earliest date. Days and
+        weeks are counted from it, months from its calendar month
+
+    Returns
+        Numpy array of int64 periods since the origin, starting at 0,
+        with -1 for missing dates
+    '''
+
+    if freq not in COHORT_FREQS:
+        raise ValueError(f"freq must be one of {COHORT_FREQS}")
+
+    days = _to_days(dates)
+    missing = np.isnat(days)
+
+    if origin is None:
+        origin = days[~missing].min() if (~missing).any() \
+            else np.datetime64('1970-01-01', 'D')
+    else:
+        origin = np.datetime64(pd.Timestamp(origin).date(), 'D')
+
+    if freq == 'month':
+        periods = (days.astype('datetime64[M]') -
+                   origin.astype('datetime64[M]')).astype(np.int64)
+    else:
+        periods = (days - origin).astype(np.int64)
+        if freq == 'week':
+            periods = periods // 7
+
+    periods[missing] = -1
+
+    return periods
+
+
+def cohort_counts(session_df, freq='week', step='purchased') -> pd.DataFrame:
+    '''
+    Counts the users of each cohort active in each period after their
+    first session, and those reaching a funnel step in that period, in a
+    single grouped pass over the sessions
+
+    Args
+        session_df: pandas dataframe with one row per user and session,
+        like ecommerceProcessor.session_df
+
+        freq: string, default = 'week'. Length of the cohorts and periods
+
+        step: funnel flag column counted as converting, default =
+        'purchased'
+
+    Returns
+        Pandas dataframe indexed by cohort start date and period with the
+        number of active and converted users
+    '''
+
+    if step not in FLAG_COLUMNS:
+        raise ValueError(f"step must be one of {FLAG_COLUMNS}")
+
+    days = _to_days(session_df['first_event_date'])
+    origin = days[~np.isnat(days)].min() if (~np.isnat(days)).any() \
+        else None
+    periods = assign_cohorts(days, freq=freq, origin=origin)
+    user_codes, users = pd.factorize(session_df['user_pseudo_id'])
+
+    valid = (periods >= 0) & (user_codes >= 0)
+    periods, user_codes = periods[valid], user_codes[valid]
+    converted = session_df[step].to_numpy()[valid].astype(np.int64)
+
+    # The cohort of each user is the period of their first session
+    cohorts = np.full(len(users), np.iinfo(np.int64).max)
+    np.minimum.at(cohorts, user_codes, periods)
+    cohorts = cohorts[user_codes]
+    offsets = periods - cohorts
+
+    n_periods = int(periods.max()) + 1 if len(periods) else 0
+    cells = cohorts * n_periods + offsets
+
+    # Each user is counted once per cell, converted if any session was
+    pairs, pair_uniques = pd.factorize(user_codes * max(n_periods ** 2, 1) +
+                                       cells)
+    pair_converted = np.zeros(len(pair_uniques), dtype=np.int64)
+    np.maximum.at(pair_converted, pairs, converted)
+    pair_cells = pair_uniques % max(n_periods ** 2, 1)
+
+    n_cells = n_periods ** 2
+    active = np.bincount(pair_cells, minlength=n_cells)
+    reached = np.bincount(pair_cells, weights=pair_converted,
+                          minlength=n_cells).astype(np.int64)
+
+    # Only cells a cohort can reach, periods after the last date are empty
+    cohort_idx, period_idx = np.divmod(np.arange(n_cells), max(n_periods, 1))
+    keep = cohort_idx + period_idx < n_periods
+
+    starts = _period_starts(origin, n_periods, freq)
+
+    index = pd.MultiIndex.from_arrays(
+        [starts[cohort_idx[keep]], period_idx[keep]],
+        names=['cohort', 'period'])
+
+    return pd.DataFrame({'users': active[keep],
+                         'converted': reached[keep]},
+                        index=index)
+
+
+# Helper for the first day of each period
+def _period_starts(origin, n_periods, freq) -> pd.DatetimeIndex:
+    if origin is None:
+        return pd.DatetimeIndex([])
+
+    if freq == 'month':
+        months = origin.astype('datetime64[M]') + np.arange(n_periods)
+        return pd.DatetimeIndex(months.astype('datetime64[D]'))
+
+    step = 7 if freq == 'week' else 1
+    return pd.DatetimeIndex(origin + step * np.arange(n_periods))
+
+
+def retention_matrix(counts) -> pd.DataFrame:
+    '''
+    Divides the active users of each cohort and period by the cohort size
+
+    Args
+        counts: pandas dataframe from cohort_counts
+
+    Returns
+        Pandas dataframe with one row per cohort and one column per
+        period, empty cohorts and future periods missing
+    '''
+
+    return _share_of_cohort(counts, 'users')
+
+
+def conversion_matrix(counts) -> pd.DataFrame:
+    '''
+    Divides the converted users of each cohort and period by the cohort
+    size
+
+    Args
+        counts: pandas dataframe from cohort_counts
+
+    Returns
+        Pandas dataframe with one row per cohort and one column per period
+    '''
+
+    return _share_of_cohort(counts, 'converted')
+
+
+def _share_of_cohort(counts, col) -> pd.DataFrame:
+    matrix = counts[col].unstack('period')
+    sizes = counts['users'].xs(0, level='period')
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return matrix.div(sizes.where(sizes > 0), axis=0)
@@ -1,34 +1,622 @@
-from google.cloud import bigquery
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
 import logging
+import os
+import threading
+import time
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 
 logging.basicConfig(level=logging.INFO)
 
 logger = logging.getLogger(__name__)
 
-# Use the public dataset's project for running queries
-client = bigquery.Client(project='product-analytics-portfolio')
+# Public GA4 sample dataset holding the daily events_YYYYMMDD shards
+GA4_DATASET = 'bigquery-public-data.ga4_obfuscated_sample_ecommerce'
 
-# Query to get all the events by user pseudo id, event name and session -------
 
+# Backend for running the loader queries on BigQuery -------
 
-def ecommerce_loader_test(return_dict=False):
+
+class bigqueryBackend:
+    '''
+    Runs loader queries against the GA4 export in BigQuery. The client
+    is created on first use and reused by every query, so the backend is
+    cheap to construct and shares its HTTP connections across loads.
+    '''
+
+    # Dialect used to flatten the event params for the session id
+    unnest_params = 'UNNEST(event_params) AS events'
+
+    def __init__(self, project='product-analytics-portfolio',
+                 dataset=GA4_DATASET, client=None):
+        self.project = project
+        self.dataset = dataset
+        self._client = client
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        '''BigQuery client, resolving credentials on first access'''
+
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    from google.cloud import bigquery
+
+                    self._client = bigquery.Client(project=self.project)
+                    logger.info("Created BigQuery client for %s",
+                                self.project)
+
+        return self._client
+
+    def table(self, shard='*'):
+        '''
+        Renders the table reference for an events shard
+
+        Args
+            shard: string, default = '*'. Date suffix of the shard, or
+            the wildcard to read all events_* shards
+
+        Returns
+            String to use in a FROM clause
+        '''
+
+        return f"`{self.dataset}.events_{shard}`"
+
+    def sample_users(self, frac):
+        '''Renders a filter keeping a deterministic fraction of users'''
+
+        return ('MOD(ABS(FARM_FINGERPRINT(user_pseudo_id)), 1000000) < '
+                f'{int(frac * 1000000)}')
+
+    def list_shards(self):
+        '''Returns the sorted suffixes of the events shards in the dataset'''
+
+        tables = self.client.list_tables(self.dataset)
+
+        return sorted(table.table_id[len('events_'):] for table in tables
+                      if table.table_id.startswith('events_'))
+
+    def dry_run(self, sql):
+        '''Returns the bytes a SQL statement would process without running'''
+
+        from google.cloud import bigquery
+
+        config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+
+        return self.client.query(sql, job_config=config).total_bytes_processed
+
+    def _execute(self, sql, stats):
+        start = time.perf_counter()
+        job = self.client.query(sql)
+        job.result()
+
+        if stats is not None:
+            stats['execution_seconds'] = time.perf_counter() - start
+            stats['bytes_processed'] = job.total_bytes_processed
+            stats['bytes_billed'] = job.total_bytes_billed
+
+        return job
+
+    def query(self, sql, stats=None):
+        '''
+        Runs a SQL statement and returns the results as a dataframe
+
+        Args
+            sql: string SQL statement
+
+            stats: dictionary, default = None. Filled with the job
+            execution and download times and the bytes processed
+
+        Returns
+            Pandas dataframe
+        '''
+
+        job = self._execute(sql, stats)
+
+        start = time.perf_counter()
+        result = job.to_dataframe()
+
+        if stats is not None:
+            stats['download_seconds'] = time.perf_counter() - start
+
+        return result
+
+    def query_arrow(self, sql, stats=None):
+        '''Runs a SQL statement and returns the results as an Arrow table'''
+
+        job = self._execute(sql, stats)
+
+        start = time.perf_counter()
+        result = job.to_arrow()
+
+        if stats is not None:
+            stats['download_seconds'] = time.perf_counter() - start
+
+        return result
+
+    def query_batches(self, sql, batch_size=100000):
+        '''Runs a SQL statement and yields Arrow record batches by page'''
+
+        rows = self.client.query(sql).result(page_size=batch_size)
+
+        yield from rows.to_arrow_iterable()
+
+
+# Backend for running the loader queries locally on Parquet exports -------
+
+
+class duckdbBackend:
+    '''
+    Runs loader queries locally with DuckDB over Parquet exports of the
+    GA4 events_* shards, one events_YYYYMMDD.parquet file per shard.
+    '''
+
+    # DuckDB needs a column alias to expose the unnested struct
+    unnest_params = 'UNNEST(event_params) AS params(events)'
+
+    def __init__(self, parquet_dir, database=':memory:'):
+        try:
+            import duckdb
+        except ImportError as e:
+            raise ImportError('duckdbBackend requires duckdb, '
+                              'install it with `pip install duckdb`') from e
+
+        self.parquet_dir = parquet_dir
+        self.connection = duckdb.connect(database)
+
+    def table(self, shard='*'):
+        '''
+        Renders the table reference for an events shard. The shard suffix
+        is exposed as _TABLE_SUFFIX to match the BigQuery wildcard tables.
+
+        Args
+            shard: string, default = '*'. Date suffix of the shard, or
+            the wildcard to read all events_* shards
+
+        Returns
+            String to use in a FROM clause
+        '''
+
+        path = os.path.join(self.parquet_dir, f'events_{shard}.parquet')
+
+        return ("(SELECT *, regexp_extract(filename, "
+                "'events_([0-9]+)\\.parquet$', 1) AS _TABLE_SUFFIX "
+                f"FROM read_parquet('{path}', filename=true))")
+
+    def sample_users(self, frac):
+        '''Renders a filter keeping a deterministic fraction of users'''
+
+        return f'hash(user_pseudo_id) % 1000000 < {int(frac * 1000000)}'
+
+    def list_shards(self):
+        '''Returns the sorted suffixes of the exported events shards'''
+
+        return sorted(name[len('events_'):-len('.parquet')]
+                      for name in os.listdir(self.parquet_dir)
+                      if name.startswith('events_')
+                      and name.endswith('.parquet'))
+
+    def dry_run(self, sql):
+        '''DuckDB has no estimate of the bytes a query will read'''
+
+        return None
+
+    def _execute(self, sql, stats):
+        start = time.perf_counter()
+
+        # A cursor per query keeps the backend safe to share across threads
+        result = self.connection.cursor().execute(sql)
+
+        if stats is not None:
+            stats['execution_seconds'] = time.perf_counter() - start
+
+        return result
+
+    def query(self, sql, stats=None):
+        '''
+        Runs a SQL statement and returns the results as a dataframe
+
+        Args
+            sql: string SQL statement
+
+            stats: dictionary, default = None. Filled with the execution
+            and fetch times
+
+        Returns
+            Pandas dataframe
+        '''
+
+        result = self._execute(sql, stats)
+
+        start = time.perf_counter()
+        df = result.df()
+
+        if stats is not None:
+            stats['download_seconds'] = time.perf_counter() - start
+
+        return df
+
+    def query_arrow(self, sql, stats=None):
+        '''Runs a SQL statement and returns the results as an Arrow table'''
+
+        reader = self._record_batches(sql, stats=stats)
+
+        start = time.perf_counter()
+        table = reader.read_all()
+
+        if stats is not None:
+            stats['download_seconds'] = time.perf_counter() - start
+
+        return table
+
+    def query_batches(self, sql, batch_size=100000):
+        '''Runs a SQL statement and yields Arrow record batches by page'''
+
+        yield from self._record_batches(sql, batch_size)
+
+    def _record_batches(self, sql, batch_size=1000000, stats=None):
+        result = self._execute(sql, stats)
+
+        # Newer DuckDB releases renamed the record batch reader
+        if hasattr(result, 'to_arrow_reader'):
+            return result.to_arrow_reader(batch_size)
+
+        return result.fetch_record_batch(batch_size)
+
+
+# Shared backend used when a loader is not given one, created on first use
+_default_backend = None
+
+
+def get_backend():
+    '''
+    Returns the shared backend, creating a BigQuery backend for the public
+    dataset's project the first time it is needed.
+
+    Args
+        None
+
+    Returns
+        Query backend
+    '''
+
+    global _default_backend
+
+    if _default_backend is None:
+        _default_backend = bigqueryBackend()
+
+    return _default_backend
+
+
+def set_backend(backend) -> None:
+    '''
+    Swaps the shared backend used by loaders that are not given one
+
+    Args
+        backend: query backend, or None to go back to BigQuery
+
+    Returns
+        None
+    '''
+
+    global _default_backend
+
+    _default_backend = backend
+
+
+# Funnel flag columns returned by the event and session queries
+FLAG_COLUMNS = ['viewed_page', 'added_to_cart', 'began_checkout', 'purchased']
+
+# First timestamp of each funnel step, in microseconds like event_timestamp
+STEP_TIMESTAMP_COLUMNS = [f'{step}_timestamp' for step in FLAG_COLUMNS]
+
+# How rows of the same user or session are merged: earliest dates and
+# step times, and the OR of the funnel flags
+FUNNEL_AGGREGATIONS = {'first_event_date': 'min',
+                       'first_event_timestamp': 'min',
+                       **{step: 'max' for step in FLAG_COLUMNS},
+                       **{col: 'min' for col in STEP_TIMESTAMP_COLUMNS}}
+
+
+# Helpers for compact, typed loader results -------
+
+
+def compact_table(table):
+    '''
+    Converts loader results to compact Arrow types: dictionary encoded
+    ids and dimensions, int8 funnel flags, and real date and timestamp
+    types for the date and first event columns.
+
+    Args
+        table: pyarrow table returned by one of the loader queries
+
+    Returns
+        Pyarrow table with the compact types
+    '''
+
+    columns = []
+    for name, column in zip(table.column_names, table.columns):
+        if name in FLAG_COLUMNS:
+            column = column.cast(pa.int8())
+        elif name in ('first_event_date', 'event_date') and \
+                pa.types.is_string(column.type):
+            column = pc.strptime(column, format='%Y%m%d', unit='s')\
+                .cast(pa.date32())
+        elif name in ['first_event_timestamp'] + STEP_TIMESTAMP_COLUMNS and \
+                pa.types.is_integer(column.type):
+            column = column.cast(pa.timestamp('us', tz='UTC'))
+        elif pa.types.is_string(column.type) or \
+                pa.types.is_large_string(column.type):
+            column = column.dictionary_encode()
+
+        columns.append(column)
+
+    return pa.table(columns, names=table.column_names)
+
+
+def to_compact_frame(table):
+    '''
+    Converts loader results to a pandas dataframe with compact types,
+    where dictionary encoded strings become categoricals.
+
+    Args
+        table: pyarrow table, or a pandas dataframe to re-type
+
+    Returns
+        Pandas dataframe
+    '''
+
+    if isinstance(table, pd.DataFrame):
+        table = pa.Table.from_pandas(table, preserve_index=False)
+
+    return compact_table(table).to_pandas(date_as_object=False)
+
+
+# Metrics recorded for each loader query -------
+
+
+class queryMetrics:
+    '''
+    Collects the cost and latency of loader queries: the dry-run bytes
+    estimate, job execution and download times, row count and memory of
+    the resulting dataframe.
+    '''
+
+    def __init__(self) -> None:
+        self.records = []
+        self._lock = threading.Lock()
+
+    def record(self, query_name, **fields) -> None:
+        '''Adds the metrics of one query'''
+
+        record = {'query': query_name, 'recorded_at': time.time()}
+        record.update(fields)
+
+        with self._lock:
+            self.records.append(record)
+
+    def to_frame(self) -> pd.DataFrame:
+        '''Returns the metrics as a dataframe with one row per query'''
+
+        return pd.DataFrame(self.records)
+
+    def to_json(self, path) -> None:
+        '''
+        Appends the metrics to a JSON lines log
+
+        Args
+            path: file to append one JSON record per query to
+
+        Returns
+            None
+        '''
+
+        with open(path, 'a') as f:
+            for record in self.records:
+                f.write(json.dumps(record, default=str) + '\n')
+
+
+# Helper for running a set of named queries -------
+
+
+def _run_query(name, sql, backend, cache=None, suffix_range=None,
+               refresh_cache=False, typed=False, metrics=None,
+               dry_run=False):
+    '''Runs one query, or loads it from the cache, and logs the timing'''
+
+    start = time.perf_counter()
+    stats = {}
+
+    if dry_run:
+        stats['dry_run_bytes'] = backend.dry_run(sql)
+
+    variant = 'typed' if typed else None
+    key = None if cache is None else cache.key(sql, suffix_range, variant)
+    result = None if key is None or refresh_cache else cache.get(key)
+
+    if result is None:
+        if typed:
+            result = to_compact_frame(backend.query_arrow(sql, stats))
+        else:
+            result = backend.query(sql, stats)
+        source = 'ran'
+
+        if key is not None:
+            cache.put(key, result)
+    else:
+        source = 'loaded cached'
+
+    elapsed = time.perf_counter() - start
+
+    logger.info("Successfully %s %s in %.2fs (%d rows)",
+                source,
+                name.replace('_', ' '),
+                elapsed,
+                result.shape[0])
+
+    if metrics is not None:
+        metrics.record(name,
+                       cached=source != 'ran',
+                       total_seconds=elapsed,
+                       rows=result.shape[0],
+                       memory_bytes=int(result.memory_usage(deep=True).sum()),
+                       **stats)
+
+    return result
+
+
+def _run_queries(queries, backend, concurrent=False, cache=None,
+                 suffix_range=None, refresh_cache=False, typed=False,
+                 metrics=None, dry_run=False):
+    '''
+    Runs named SQL statements on a backend
+
+    Args
+        queries: dictionary of query name to SQL statement
+
+        backend: backend used to run the queries
+
+        concurrent: boolean, default = False. Submits all queries to a
+        thread pool so the wall-clock time is roughly the slowest query
+
+        cache: queryCache, default = None. Reuses stored results of
+        identical queries instead of running them again
+
+        suffix_range: tuple of the first and last table suffixes read,
+        default = None for queries over all shards. Part of the cache key
+
+        refresh_cache: boolean, default = False. Runs the queries even if
+        they are cached and overwrites the stored results
+
+        typed: boolean, default = False. Returns compact categorical,
+        int8 and datetime columns instead of the default types
+
+        metrics: queryMetrics, default = None. Records the timings, size
+        and row count of each query
+
+        dry_run: boolean, default = False. Estimates the bytes processed
+        by each query with a dry run before running it
+
+    Returns
+        Dictionary of query name to pandas dataframe, in the same order
+    '''
+
+    start = time.perf_counter()
+    run_args = (backend, cache, suffix_range, refresh_cache, typed,
+                metrics, dry_run)
+
+    if concurrent:
+        with ThreadPoolExecutor(max_workers=len(queries)) as pool:
+            futures = {name: pool.submit(_run_query, name, sql, *run_args)
+                       for name, sql in queries.items()}
+            results = {name: future.result()
+                       for name, future in futures.items()}
+    else:
+        results = {name: _run_query(name, sql, *run_args)
+                   for name, sql in queries.items()}
+
+    logger.info("Ran %d queries in %.2fs",
+                len(queries), time.perf_counter() - start)
+
+    return results
+
+
+def split_combined_query(combined_df):
+    '''
+    Splits the combined single-scan query into the session, device and
+    geo dataframes returned by the separate queries.
+
+    Args
+        combined_df: pandas dataframe with one row per user, session,
+        device and geo combination along with the funnel flags
+
+    Returns
+        Tuple of the session, device and geo pandas dataframes
+    '''
+
+    keys = ['user_pseudo_id', 'session']
+
+    # Sessions only count if they contain one of the funnel events
+    session_df = combined_df\
+        .groupby(keys, sort=False, dropna=False, observed=True)\
+        .agg({col: how for col, how in FUNNEL_AGGREGATIONS.items()
+              if col in combined_df.columns})\
+        .dropna(subset=['first_event_date'])\
+        .reset_index()
+
+    device_cols = ['category', 'mobile_brand_name', 'operating_system']
+    device_df = combined_df.loc[:, keys + device_cols]\
+        .drop_duplicates().reset_index(drop=True)
+
+    geo_cols = ['continent', 'country', 'region', 'city']
+    geo_df = combined_df.loc[:, keys + geo_cols]\
+        .drop_duplicates().reset_index(drop=True)
+
+    return session_df, device_df, geo_df
+
+
+# SQL for the loader queries -------
+
+
+def _table_suffix(date):
+    '''Converts a date, or a date string, to an events_* table suffix'''
+
+    return pd.Timestamp(str(date)).strftime('%Y%m%d')
+
+
+def loader_queries(backend, start_date=None, end_date=None,
+                   sample_frac=None, suffixes=None):
+    '''
+    Builds the SQL statements of the loader, pruning the events_* shards
+    on _TABLE_SUFFIX so only the requested dates are scanned.
+
+    Args
+        backend: query backend the SQL is rendered for
+
+        start_date: date or string, default = None. First shard to read,
+        None starts from the first shard
+
+        end_date: date or string, default = None. Last shard to read,
+        None reads up to the latest shard
+
+        sample_frac: float, default = None. Keeps a deterministic sample
+        of this fraction of users, the same users in every query
+
+        suffixes: list of shard suffixes, default = None. Restricts the
+        queries to these events_YYYYMMDD shards
+
+    Returns
+        Dictionary of query name to SQL statement, including the
+        combined_query used by the single-scan mode
+    '''
+
+    conditions = []
+    if start_date is not None:
+        conditions.append(f"_TABLE_SUFFIX >= '{_table_suffix(start_date)}'")
+    if end_date is not None:
+        conditions.append(f"_TABLE_SUFFIX <= '{_table_suffix(end_date)}'")
+    if suffixes is not None:
+        conditions.append("_TABLE_SUFFIX IN ({})".format(
+            ', '.join(f"'{suffix}'" for suffix in suffixes)))
+    if sample_frac is not None:
+        conditions.append(backend.sample_users(sample_frac))
+
+    # Filter appended to the WHERE clause of every query
+    table_filter = ''.join(f' AND {condition}' for condition in conditions)
 
     # SQL Statement
-    event_sql = """WITH stacked_table AS (SELECT event_date,
+    event_sql = f"""WITH stacked_table AS (SELECT event_date,
         event_timestamp,
         user_pseudo_id,
         event_name
-    FROM `bigquery-public-data.ga4_obfuscated_sample_ecommerce.events_20210130`
+    FROM {backend.table()}
     WHERE event_name IN ('page_view', 'add_to_cart',
-    'begin_checkout', 'purchase')
-    UNION ALL
-    SELECT event_date,
-        event_timestamp,
-        user_pseudo_id,
-        event_name
-    FROM `bigquery-public-data.ga4_obfuscated_sample_ecommerce.events_20210131`
-    WHERE event_name IN ('page_view', 'add_to_cart',
-    'begin_checkout', 'purchase')),
+    'begin_checkout', 'purchase'){table_filter}),
 
     flagged_events AS (SELECT *,
         CASE WHEN event_name = 'page_view' THEN 1 ELSE 0 END AS page_view,
@@ -43,45 +631,30 @@ def ecommerce_loader_test(return_dict=False):
         CASE WHEN SUM(page_view) > 0 THEN 1 ELSE 0 END viewed_page,
         CASE WHEN SUM(add_to_cart) > 0 THEN 1 ELSE 0 END added_to_cart,
         CASE WHEN SUM(begin_checkout) > 0 THEN 1 ELSE 0 END began_checkout,
-        CASE WHEN SUM(purchase) > 0 THEN 1 ELSE 0 END purchased
+        CASE WHEN SUM(purchase) > 0 THEN 1 ELSE 0 END purchased,
+        MIN(CASE WHEN event_name = 'page_view' THEN event_timestamp END) AS viewed_page_timestamp,
+        MIN(CASE WHEN event_name = 'add_to_cart' THEN event_timestamp END) AS added_to_cart_timestamp,
+        MIN(CASE WHEN event_name = 'begin_checkout' THEN event_timestamp END) AS began_checkout_timestamp,
+        MIN(CASE WHEN event_name = 'purchase' THEN event_timestamp END) AS purchased_timestamp
     FROM flagged_events
     GROUP BY user_pseudo_id;"""
 
-    # Running the query
-    event_query = client.query(event_sql).to_dataframe()
-
-    logger.info("Successfully ran event query")
-
     # Query for intra-session conversion -------------
 
     # SQL statement
-    session_sql = """-- CTE to stack relevant columns from two date tables
-    -- Needs to be compressed to query across all tables for prod
+    session_sql = f"""-- CTE to stack relevant columns from the selected shards
     WITH stacked_table AS (SELECT DISTINCT user_pseudo_id,
         event_date,
         event_timestamp,
         events.value.int_value AS session,
         event_name
-    FROM `bigquery-public-data.ga4_obfuscated_sample_ecommerce.events_20210130`,
-        UNNEST(event_params) AS events
-    WHERE event_name IN ('page_view',
-                         'add_to_cart',
-                         'begin_checkout',
-                         'purchase') AND
-        events.key = 'ga_session_id'
-    UNION ALL
-    SELECT DISTINCT user_pseudo_id,
-        event_date,
-        event_timestamp,
-        events.value.int_value AS session,
-        event_name
-    FROM `bigquery-public-data.ga4_obfuscated_sample_ecommerce.events_20210130`,
-        UNNEST(event_params) AS events
+    FROM {backend.table()},
+        {backend.unnest_params}
     WHERE event_name IN ('page_view',
                          'add_to_cart',
                          'begin_checkout',
                          'purchase') AND
-        events.key = 'ga_session_id'),
+        events.key = 'ga_session_id'{table_filter}),
 
     -- CTE to create flagged events by user and session
     flagged_events AS (SELECT *,
@@ -99,217 +672,730 @@ def ecommerce_loader_test(return_dict=False):
         CASE WHEN SUM(page_view) > 0 THEN 1 ELSE 0 END viewed_page,
         CASE WHEN SUM(add_to_cart) > 0 THEN 1 ELSE 0 END added_to_cart,
         CASE WHEN SUM(begin_checkout) > 0 THEN 1 ELSE 0 END began_checkout,
-        CASE WHEN SUM(purchase) > 0 THEN 1 ELSE 0 END purchased
+        CASE WHEN SUM(purchase) > 0 THEN 1 ELSE 0 END purchased,
+        MIN(CASE WHEN event_name = 'page_view' THEN event_timestamp END) AS viewed_page_timestamp,
+        MIN(CASE WHEN event_name = 'add_to_cart' THEN event_timestamp END) AS added_to_cart_timestamp,
+        MIN(CASE WHEN event_name = 'begin_checkout' THEN event_timestamp END) AS began_checkout_timestamp,
+        MIN(CASE WHEN event_name = 'purchase' THEN event_timestamp END) AS purchased_timestamp
     FROM flagged_events
     GROUP BY user_pseudo_id, session;"""
 
-    # Running the Query
-    session_query = client.query(session_sql).to_dataframe()
-
-    logger.info("Successfully ran session query")
-
     # Query for device information ----------
 
     # SQL statement
-    device_sql = """SELECT DISTINCT user_pseudo_id,
+    device_sql = f"""SELECT DISTINCT user_pseudo_id,
         events.value.int_value AS session,
         device.category,
         device.mobile_brand_name,
         device.operating_system
-    FROM `bigquery-public-data.ga4_obfuscated_sample_ecommerce.events_20210129`,
-        UNNEST(event_params) AS events
-    WHERE events.key = 'ga_session_id'
-    UNION ALL
-    SELECT DISTINCT user_pseudo_id,
-        events.value.int_value AS session,
-        device.category,
-        device.mobile_brand_name,
-        device.operating_system
-    FROM `bigquery-public-data.ga4_obfuscated_sample_ecommerce.events_20210130`,
-        UNNEST(event_params) AS events
-    WHERE events.key = 'ga_session_id'
-    UNION ALL
-    SELECT DISTINCT user_pseudo_id,
-        events.value.int_value AS session,
-        device.category,
-        device.mobile_brand_name,
-        device.operating_system
-    FROM `bigquery-public-data.ga4_obfuscated_sample_ecommerce.events_20210131`,
-        UNNEST(event_params) AS events
-    WHERE events.key = 'ga_session_id'"""
-
-    # Running the query
-    device_query = client.query(device_sql).to_dataframe()
-
-    logger.info("Successfully ran device query")
+    FROM {backend.table()},
+        {backend.unnest_params}
+    WHERE events.key = 'ga_session_id'{table_filter}"""
 
     # Query for geo location ------------
 
     # Geo SQL statement
-    geo_sql = """SELECT DISTINCT user_pseudo_id,
+    geo_sql = f"""SELECT DISTINCT user_pseudo_id,
         events.value.int_value AS session,
         geo.continent,
         geo.country,
         geo.region,
         geo.city
-    FROM `bigquery-public-data.ga4_obfuscated_sample_ecommerce.events_20210129`,
-        UNNEST(event_params) AS events
-    WHERE events.key = 'ga_session_id'
-    UNION ALL
-    SELECT DISTINCT user_pseudo_id,
+    FROM {backend.table()},
+        {backend.unnest_params}
+    WHERE events.key = 'ga_session_id'{table_filter}"""
+
+    # Combined query for session, device and geo in a single scan ----------
+
+    # SQL statement
+    combined_sql = f"""-- CTE reading each event once with its session id
+    WITH session_events AS (SELECT user_pseudo_id,
         events.value.int_value AS session,
+        event_date,
+        event_timestamp,
+        event_name,
+        device.category,
+        device.mobile_brand_name,
+        device.operating_system,
         geo.continent,
         geo.country,
         geo.region,
         geo.city
-    FROM `bigquery-public-data.ga4_obfuscated_sample_ecommerce.events_20210130`,
-        UNNEST(event_params) AS events
-    WHERE events.key = 'ga_session_id'
-    UNION ALL
-    SELECT DISTINCT user_pseudo_id,
+    FROM {backend.table()},
+        {backend.unnest_params}
+    WHERE events.key = 'ga_session_id'{table_filter})
+
+    -- Funnel flags by session for each device and geo combination
+    SELECT user_pseudo_id,
+        session,
+        category,
+        mobile_brand_name,
+        operating_system,
+        continent,
+        country,
+        region,
+        city,
+        MIN(CASE WHEN event_name IN ('page_view', 'add_to_cart',
+        'begin_checkout', 'purchase') THEN event_date END) AS first_event_date,
+        MIN(CASE WHEN event_name IN ('page_view', 'add_to_cart',
+        'begin_checkout', 'purchase') THEN event_timestamp END)
+            AS first_event_timestamp,
+        MAX(CASE WHEN event_name = 'page_view' THEN 1 ELSE 0 END) viewed_page,
+        MAX(CASE WHEN event_name = 'add_to_cart' THEN 1 ELSE 0 END) added_to_cart,
+        MAX(CASE WHEN event_name = 'begin_checkout' THEN 1 ELSE 0 END) began_checkout,
+        MAX(CASE WHEN event_name = 'purchase' THEN 1 ELSE 0 END) purchased,
+        MIN(CASE WHEN event_name = 'page_view' THEN event_timestamp END) AS viewed_page_timestamp,
+        MIN(CASE WHEN event_name = 'add_to_cart' THEN event_timestamp END) AS added_to_cart_timestamp,
+        MIN(CASE WHEN event_name = 'begin_checkout' THEN event_timestamp END) AS began_checkout_timestamp,
+        MIN(CASE WHEN event_name = 'purchase' THEN event_timestamp END) AS purchased_timestamp
+    FROM session_events
+    GROUP BY user_pseudo_id, session, category, mobile_brand_name,
+        operating_system, continent, country, region, city"""
+
+    # Query for the raw funnel events, for ordered funnels ----------
+
+    # SQL statement
+    step_sql = f"""SELECT DISTINCT user_pseudo_id,
         events.value.int_value AS session,
-        geo.continent,
-        geo.country,
-        geo.region,
-        geo.city
-    FROM `bigquery-public-data.ga4_obfuscated_sample_ecommerce.events_20210131`,
-        UNNEST(event_params) AS events
-    WHERE events.key = 'ga_session_id'"""
+        event_date,
+        event_timestamp,
+        event_name
+    FROM {backend.table()},
+        {backend.unnest_params}
+    WHERE event_name IN ('page_view',
+                         'add_to_cart',
+                         'begin_checkout',
+                         'purchase') AND
+        events.key = 'ga_session_id'{table_filter}"""
 
-    # Running the query
-    geo_query = client.query(geo_sql).to_dataframe()
+    return {'event_query': event_sql,
+            'session_query': session_sql,
+            'device_query': device_sql,
+            'geo_query': geo_sql,
+            'combined_query': combined_sql,
+            'step_query': step_sql}
 
-    logger.info("Successfully ran geo query")
 
-    if return_dict:
-        return {'event_query': event_query,
-                'session_query': session_query,
-                'device_query': device_query,
-                'geo_query': geo_query}
+# Helper for the shards covered by the queries, as part of the cache key
+def _suffix_range(start_date=None, end_date=None, suffixes=None):
+    if suffixes is not None:
+        return (min(suffixes), max(suffixes))
+    elif start_date is not None or end_date is not None:
+        return tuple('*' if date is None else _table_suffix(date)
+                     for date in (start_date, end_date))
     else:
-        return event_query, session_query, device_query, geo_query
+        return None
 
-# Ecommerce loader to load the full datasets for prod
 
+# Ecommerce loader for a range of dates -------
 
-def ecommerce_loader_prod(return_dict=False):
 
-    # SQL Statement
-    event_sql = """WITH stacked_table AS (SELECT event_date,
-        event_timestamp,
-        user_pseudo_id,
-        event_name
-    FROM `bigquery-public-data.ga4_obfuscated_sample_ecommerce.events_*`
-    WHERE event_name IN ('page_view', 'add_to_cart',
-    'begin_checkout', 'purchase')),
+def ecommerce_loader(start_date=None, end_date=None, sample_frac=None,
+                     return_dict=False, backend=None, concurrent=False,
+                     combined=False, cache=None, refresh_cache=False,
+                     suffixes=None, typed=False, return_metrics=False,
+                     metrics_log=None, dry_run=False):
+    '''
+    Loads the event, session, device and geo data for a range of dates
 
-    flagged_events AS (SELECT *,
-        CASE WHEN event_name = 'page_view' THEN 1 ELSE 0 END AS page_view,
-        CASE WHEN event_name = 'add_to_cart' THEN 1 ELSE 0 END AS add_to_cart,
-        CASE WHEN event_name = 'begin_checkout' THEN 1 ELSE 0 END as begin_checkout,
-        CASE WHEN event_name = 'purchase' THEN 1 ELSE 0 END as purchase
-    FROM stacked_table)
+    Args
+        start_date: date or string, default = None. First day to load,
+        None starts from the first shard
 
-    SELECT user_pseudo_id,
-        MIN(event_date) AS first_event_date,
-        MIN(event_timestamp) AS first_event_timestamp,
-        CASE WHEN SUM(page_view) > 0 THEN 1 ELSE 0 END viewed_page,
-        CASE WHEN SUM(add_to_cart) > 0 THEN 1 ELSE 0 END added_to_cart,
-        CASE WHEN SUM(begin_checkout) > 0 THEN 1 ELSE 0 END began_checkout,
-        CASE WHEN SUM(purchase) > 0 THEN 1 ELSE 0 END purchased
-    FROM flagged_events
-    GROUP BY user_pseudo_id;"""
+        end_date: date or string, default = None. Last day to load,
+        None loads up to the latest shard
 
-    # Running the query
-    event_query = client.query(event_sql).to_dataframe()
+        sample_frac: float, default = None. Loads a deterministic sample
+        of this fraction of users instead of all of them
 
-    logger.info("Successfully ran event query")
+        return_dict: boolean, default = False. Returns the results in a
+        dictionary keyed by query instead of a tuple
 
-    # Query for intra-session conversion -------------
+        backend: query backend, default = None. Uses BigQuery when None,
+        or a duckdbBackend to run against local Parquet exports
 
-    # SQL statement
-    session_sql = """-- CTE to stack relevant columns from two date tables
-    -- Needs to be compressed to query across all tables for prod
-    WITH stacked_table AS (SELECT DISTINCT user_pseudo_id,
-        event_date,
-        event_timestamp,
-        events.value.int_value AS session,
-        event_name
-    FROM `bigquery-public-data.ga4_obfuscated_sample_ecommerce.events_*`,
-        UNNEST(event_params) AS events
-    WHERE event_name IN ('page_view',
-                         'add_to_cart',
-                         'begin_checkout',
-                         'purchase') AND
-        events.key = 'ga_session_id'),
+        concurrent: boolean, default = False. Runs the four independent
+        queries in a thread pool instead of one after another
 
-    -- CTE to create flagged events by user and session
-    flagged_events AS (SELECT *,
-        CASE WHEN event_name = 'page_view' THEN 1 ELSE 0 END AS page_view,
-        CASE WHEN event_name = 'add_to_cart' THEN 1 ELSE 0 END AS add_to_cart,
-        CASE WHEN event_name = 'begin_checkout' THEN 1 ELSE 0 END as begin_checkout,
-        CASE WHEN event_name = 'purchase' THEN 1 ELSE 0 END as purchase
-    FROM stacked_table)
+        combined: boolean, default = False. Reads the events shards once
+        for the session, device and geo data and splits the result,
+        instead of scanning events_* with a separate query for each
 
-    -- Getting aggregated values by session and user
-    SELECT user_pseudo_id,
-        session,
-        MIN(event_date) AS first_event_date,
-        MIN(event_timestamp) AS first_event_timestamp,
-        CASE WHEN SUM(page_view) > 0 THEN 1 ELSE 0 END viewed_page,
-        CASE WHEN SUM(add_to_cart) > 0 THEN 1 ELSE 0 END added_to_cart,
-        CASE WHEN SUM(begin_checkout) > 0 THEN 1 ELSE 0 END began_checkout,
-        CASE WHEN SUM(purchase) > 0 THEN 1 ELSE 0 END purchased
-    FROM flagged_events
-    GROUP BY user_pseudo_id, session;"""
+        cache: queryCache, default = None. Loads results of previously
+        run queries from disk, None bypasses the cache
 
-    # Running the Query
-    session_query = client.query(session_sql).to_dataframe()
+        refresh_cache: boolean, default = False. Reruns the queries and
+        overwrites any cached results
 
-    logger.info("Successfully ran session query")
+        suffixes: list of shard suffixes, default = None. Restricts the
+        queries to these events_YYYYMMDD shards
 
-    # Query for device information ----------
+        typed: boolean, default = False. Returns categorical ids and
+        dimensions, int8 funnel flags and datetime columns, which take
+        several times less memory than the default types
 
-    # SQL statement
-    device_sql = """SELECT DISTINCT user_pseudo_id,
-        events.value.int_value AS session,
-        device.category,
-        device.mobile_brand_name,
-        device.operating_system
-    FROM `bigquery-public-data.ga4_obfuscated_sample_ecommerce.events_*`,
-        UNNEST(event_params) AS events
-    WHERE events.key = 'ga_session_id'"""
+        return_metrics: boolean, default = False. Also returns a
+        queryMetrics with the timings, rows and memory of each query
 
-    # Running the query
-    device_query = client.query(device_sql).to_dataframe()
+        metrics_log: file path, default = None. Appends the query
+        metrics to this JSON lines log
 
-    logger.info("Successfully ran device query")
+        dry_run: boolean, default = False. Records a dry-run estimate of
+        the bytes each query processes before running it
 
-    # Query for geo location ------------
+    Returns
+        Tuple or dictionary of pandas dataframes, followed by the
+        queryMetrics when return_metrics is True
+    '''
 
-    # Geo SQL statement
-    geo_sql = """SELECT DISTINCT user_pseudo_id,
-        events.value.int_value AS session,
-        geo.continent,
-        geo.country,
-        geo.region,
-        geo.city
-    FROM `bigquery-public-data.ga4_obfuscated_sample_ecommerce.events_*`,
-        UNNEST(event_params) AS events
-    WHERE events.key = 'ga_session_id'"""
+    if backend is None:
+        backend = get_backend()
+
+    metrics = queryMetrics()
+    queries = loader_queries(backend, start_date, end_date, sample_frac,
+                             suffixes)
+
+    suffix_range = _suffix_range(start_date, end_date, suffixes)
+
+    if combined:
+        results = _run_queries({'event_query': queries['event_query'],
+                                'combined_query': queries['combined_query']},
+                               backend,
+                               concurrent,
+                               cache,
+                               suffix_range,
+                               refresh_cache,
+                               typed,
+                               metrics,
+                               dry_run)
+        (
+            results['session_query'],
+            results['device_query'],
+            results['geo_query']
+        ) = split_combined_query(results.pop('combined_query'))
+    else:
+        results = _run_queries({name: queries[name]
+                                for name in ['event_query',
+                                             'session_query',
+                                             'device_query',
+                                             'geo_query']},
+                               backend,
+                               concurrent,
+                               cache,
+                               suffix_range,
+                               refresh_cache,
+                               typed,
+                               metrics,
+                               dry_run)
+
+    if metrics_log is not None:
+        metrics.to_json(metrics_log)
+
+    if not return_dict:
+        results = (results['event_query'],
+                   results['session_query'],
+                   results['device_query'],
+                   results['geo_query'])
+
+    if return_metrics:
+        return results, metrics
+    else:
+        return results
+
+
+# Loader for the raw funnel events -------
+
+
+def ecommerce_loader_steps(start_date=None, end_date=None, sample_frac=None,
+                           backend=None, cache=None, refresh_cache=False,
+                           suffixes=None, typed=False):
+    '''
+    Loads every page view, add to cart, checkout and purchase event with
+    its user, session and timestamp, for funnels that need the order of
+    the steps rather than the per-user flags of the event query.
+
+    Args
+        start_date: date or string, default = None. First day to load
+
+        end_date: date or string, default = None. Last day to load
+
+        sample_frac: float, default = None. Loads a deterministic sample
+        of this fraction of users
+
+        backend: query backend, default = None. Uses BigQuery when None
+
+        cache: queryCache, default = None. Loads previous results from disk
+
+        refresh_cache: boolean, default = False. Reruns the query and
+        overwrites any cached result
+
+        suffixes: list of shard suffixes, default = None. Restricts the
+        query to these events_YYYYMMDD shards
+
+        typed: boolean, default = False. Returns categorical ids and
+        event names
+
+    Returns
+        Pandas dataframe with user_pseudo_id, session, event_date,
+        event_timestamp and event_name
+    '''
+
+    if backend is None:
+        backend = get_backend()
+
+    sql = loader_queries(backend, start_date, end_date, sample_frac,
+                         suffixes)['step_query']
+
+    return _run_query('step_query',
+                      sql,
+                      backend,
+                      cache=cache,
+                      suffix_range=_suffix_range(start_date, end_date,
+                                                 suffixes),
+                      refresh_cache=refresh_cache,
+                      typed=typed)
+
+
+# Shards loaded by the test loader
+TEST_DATE_RANGE = ('20210130', '20210131')
+
+
+def ecommerce_loader_test(return_dict=False, backend=None, *,
+                          sample_frac=None, concurrent=False,
+                          combined=False, cache=None, refresh_cache=False,
+                          typed=False, return_metrics=False,
+                          metrics_log=None, dry_run=False):
+    '''
+    Loads the data for the two test shards in TEST_DATE_RANGE
+
+    Args
+        return_dict: boolean, default = False. Returns the results in a
+        dictionary keyed by query instead of a tuple
+
+        backend: query backend, default = None. Uses BigQuery when None,
+        or a duckdbBackend to run against local Parquet exports
+
+        The keyword arguments are passed on to ecommerce_loader
+
+    Returns
+        Tuple or dictionary of pandas dataframes, followed by the
+        queryMetrics when return_metrics is True
+    '''
 
-    # Running the query
-    geo_query = client.query(geo_sql).to_dataframe()
+    return ecommerce_loader(*TEST_DATE_RANGE, sample_frac=sample_frac,
+                            return_dict=return_dict, backend=backend,
+                            concurrent=concurrent, combined=combined,
+                            cache=cache, refresh_cache=refresh_cache,
+                            typed=typed, return_metrics=return_metrics,
+                            metrics_log=metrics_log, dry_run=dry_run)
+
+
+def ecommerce_loader_prod(return_dict=False, backend=None, *,
+                          sample_frac=None, concurrent=False,
+                          combined=False, cache=None, refresh_cache=False,
+                          suffixes=None, typed=False, return_metrics=False,
+                          metrics_log=None, dry_run=False):
+    '''
+    Loads the data for all shards
+
+    Args
+        return_dict: boolean, default = False. Returns the results in a
+        dictionary keyed by query instead of a tuple
+
+        backend: query backend, default = None. Uses BigQuery when None,
+        or a duckdbBackend to run against local Parquet exports
+
+        The keyword arguments are passed on to ecommerce_loader
+
+    Returns
+        Tuple or dictionary of pandas dataframes, followed by the
+        queryMetrics when return_metrics is True
+    '''
+
+    return ecommerce_loader(sample_frac=sample_frac,
+                            return_dict=return_dict, backend=backend,
+                            concurrent=concurrent, combined=combined,
+                            cache=cache, refresh_cache=refresh_cache,
+                            suffixes=suffixes, typed=typed,
+                            return_metrics=return_metrics,
+                            metrics_log=metrics_log, dry_run=dry_run)
+
+
+# Streaming loader yielding the results page by page -------
+
+
+def ecommerce_loader_stream(query_name, backend=None, batch_size=100000,
+                            start_date=None, end_date=None,
+                            sample_frac=None, typed=False):
+    '''
+    Runs one of the loader queries and yields its results in batches, so
+    consumers can fold them into running aggregates without holding
+    the full result in memory.
+
+    Args
+        query_name: one of 'event_query', 'session_query',
+        'device_query', 'geo_query' or 'step_query'
+
+        backend: query backend, default = None. Uses BigQuery when None,
+        or a duckdbBackend to run against local Parquet exports
+
+        batch_size: int, default = 100000. Rows per page of results
+
+        start_date: date or string, default = None. First day to load
+
+        end_date: date or string, default = None. Last day to load
+
+        sample_frac: float, default = None. Loads a deterministic sample
+        of this fraction of users
+
+        typed: boolean, default = False. Yields categorical ids and
+        dimensions, int8 funnel flags and datetime columns
+
+    Returns
+        Generator of pandas dataframes with at most batch_size rows
+    '''
+
+    if backend is None:
+        backend = get_backend()
+
+    sql = loader_queries(backend, start_date, end_date,
+                         sample_frac)[query_name]
+
+    n_rows = 0
+    for batch in backend.query_batches(sql, batch_size):
+        if batch.num_rows == 0:
+            continue
+
+        n_rows += batch.num_rows
+
+        if typed:
+            yield to_compact_frame(pa.Table.from_batches([batch]))
+        else:
+            yield batch.to_pandas()
+
+    logger.info("Streamed %d rows from %s",
+                n_rows, query_name.replace('_', ' '))
+
+
+# Helper describing the query and shards a Parquet export holds
+def _parquet_provenance(query_name, backend, start_date=None, end_date=None,
+                        sample_frac=None) -> dict:
+    sql = loader_queries(backend, start_date, end_date,
+                         sample_frac)[query_name]
+
+    first, last = (_table_suffix(date) if date is not None else None
+                   for date in (start_date, end_date))
+    shards = [suffix for suffix in backend.list_shards()
+              if (first is None or suffix >= first)
+              and (last is None or suffix <= last)]
+
+    return {'query': query_name,
+            'backend': type(backend).__name__,
+            'sql_hash': hashlib.sha256(sql.encode('utf-8')).hexdigest(),
+            'shards': shards}
+
+
+# Helper writing the manifest next to a Parquet export
+def _write_parquet_manifest(path, provenance, n_rows) -> None:
+    with open(f'{path}.manifest.json', 'w') as f:
+        json.dump(dict(provenance, n_rows=n_rows), f, indent=2)
+
+
+def parquet_export_matches(path, query_name, backend=None, start_date=None,
+                           end_date=None, sample_frac=None) -> bool:
+    '''
+    Checks whether a Parquet file written by ecommerce_loader_to_parquet,
+    or by an incremental load, holds the given query over the shards
+    currently in the dataset
+
+    Args
+        path: Parquet file
+
+        query_name: name of the loader query, like 'session_query'
+
+        backend: query backend, default = None. Uses BigQuery when None
+
+        start_date, end_date, sample_frac: range and sample of the query,
+        as passed to ecommerce_loader_to_parquet
+
+    Returns
+        Boolean, False when the file or its manifest is missing
+    '''
+
+    manifest_path = f'{path}.manifest.json'
+    if not os.path.exists(path) or not os.path.exists(manifest_path):
+        return False
+
+    if backend is None:
+        backend = get_backend()
+
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+
+    provenance = _parquet_provenance(query_name, backend, start_date,
+                                     end_date, sample_frac)
+
+    return manifest == dict(provenance,
+                            n_rows=pq.ParquetFile(path).metadata.num_rows)
+
+
+def ecommerce_loader_to_parquet(query_name, path, backend=None,
+                                batch_size=100000, start_date=None,
+                                end_date=None, sample_frac=None) -> str:
+    '''
+    Streams one of the loader queries into a Parquet file, one row group
+    per page of results, so the result never has to fit in memory. Used
+    to spill the session query for out-of-core processing. A manifest of
+    the query, shards and row count is written next to the file, see
+    parquet_export_matches.
+
+    Args
+        query_name: name of the loader query, like 'session_query'
+
+        path: Parquet file to write
+
+        backend: query backend, default = None. Uses BigQuery when None
+
+        batch_size: int, default = 100000. Rows per page and row group
+
+        start_date: date or string, default = None. First day to load
+
+        end_date: date or string, default = None. Last day to load
+
+        sample_frac: float, default = None. Loads a deterministic sample
+        of this fraction of users
+
+    Returns
+        Path of the written file
+    '''
+
+    if backend is None:
+        backend = get_backend()
+
+    sql = loader_queries(backend, start_date, end_date,
+                         sample_frac)[query_name]
+    provenance = _parquet_provenance(query_name, backend, start_date,
+                                     end_date, sample_frac)
+
+    # Writing to a temporary file so readers never see a partial file
+    tmp_path = f'{path}.{threading.get_ident()}.tmp'
+    writer = None
+    n_rows = 0
+
+    try:
+        for batch in backend.query_batches(sql, batch_size):
+            if batch.num_rows == 0:
+                continue
+
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, batch.schema)
+
+            writer.write_table(pa.Table.from_batches([batch]),
+                               row_group_size=batch_size)
+            n_rows += batch.num_rows
+    except BaseException:
+        if writer is not None:
+            writer.close()
+            os.remove(tmp_path)
+        raise
+
+    if writer is None:
+        raise ValueError(f'{query_name} returned no rows')
+
+    writer.close()
+    os.replace(tmp_path, path)
+    _write_parquet_manifest(path, provenance, n_rows)
+
+    logger.info("Wrote %d rows from %s to %s",
+                n_rows, query_name.replace('_', ' '), path)
+
+    return path
+
+
+def read_row_groups(path, columns=None, typed=False):
+    '''
+    Reads a Parquet file one row group at a time
+
+    Args
+        path: Parquet file, such as one written by
+        ecommerce_loader_to_parquet or the session_query.parquet of an
+        incremental state directory
+
+        columns: list of columns to read, default = None for all
+
+        typed: boolean, default = False. Yields compact types
+
+    Returns
+        Generator of pandas dataframes, one per row group
+    '''
+
+    parquet_file = pq.ParquetFile(path)
+
+    for i in range(parquet_file.num_row_groups):
+        table = parquet_file.read_row_group(i, columns=columns)
+
+        if typed:
+            yield to_compact_frame(table)
+        else:
+            yield table.to_pandas()
+
+
+# Incremental loader that only queries new daily shards -------
+
+
+def _merge_aggregates(stored_df, new_df, keys):
+    '''
+    Merges per-user or per-session funnel aggregates from separate shards,
+    taking the earliest dates and the OR of the funnel flags.
+
+    Args
+        stored_df: pandas dataframe of previously loaded aggregates
+
+        new_df: pandas dataframe of aggregates from the new shards
+
+        keys: list of columns identifying a row
+
+    Returns
+        Pandas dataframe with one row per key
+    '''
+
+    merged_df = pd.concat([stored_df, new_df], ignore_index=True)
+
+    # State saved before the step times existed only merges the flags
+    return merged_df\
+        .groupby(keys, sort=False, dropna=False, observed=True)\
+        .agg({col: how for col, how in FUNNEL_AGGREGATIONS.items()
+              if col in merged_df.columns})\
+        .reset_index()
+
+
+def ecommerce_loader_incremental(state_dir, return_dict=False,
+                                 backend=None, concurrent=False,
+                                 combined=False, typed=False,
+                                 return_metrics=False, metrics_log=None,
+                                 dry_run=False):
+    '''
+    Loads the prod data by querying only the events shards that have not
+    been loaded before and merging them into the stored aggregates.
+
+    Args
+        state_dir: directory holding the loaded results as Parquet files
+        and a manifest of the loaded shard suffixes
+
+        return_dict: boolean, default = False. Returns the results in a
+        dictionary keyed by query instead of a tuple
+
+        backend: query backend, default = None. Uses BigQuery when None,
+        or a duckdbBackend to run against local Parquet exports
+
+        concurrent: boolean, default = False. Runs the queries for the
+        new shards in a thread pool
+
+        combined: boolean, default = False. Reads the new shards once for
+        the session, device and geo data
+
+        typed: boolean, default = False. Returns categorical ids and
+        dimensions, int8 funnel flags and datetime columns, which take
+        several times less memory than the default types
+
+        return_metrics: boolean, default = False. Also returns a
+        queryMetrics of the queries run for the new shards, empty when
+        there were none
+
+        metrics_log: file path, default = None. Appends the query
+        metrics to this JSON lines log
+
+        dry_run: boolean, default = False. Records a dry-run estimate of
+        the bytes each query processes before running it
+
+    Returns
+        Tuple or dictionary of pandas dataframes, followed by the
+        queryMetrics when return_metrics is True
+    '''
+
+    if backend is None:
+        backend = get_backend()
+
+    metrics = queryMetrics()
+    names = ['event_query', 'session_query', 'device_query', 'geo_query']
+    manifest_path = os.path.join(state_dir, 'manifest.json')
+
+    # Loading the record of shards already merged into the stored results
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            loaded = set(json.load(f)['loaded_suffixes'])
+        results = {name: pd.read_parquet(
+            os.path.join(state_dir, f'{name}.parquet')) for name in names}
+    else:
+        loaded = set()
+        results = None
+
+    new_suffixes = [suffix for suffix in backend.list_shards()
+                    if suffix not in loaded]
+
+    if new_suffixes:
+        logger.info("Loading %d new shards from %s to %s",
+                    len(new_suffixes), new_suffixes[0], new_suffixes[-1])
+
+        new_results, metrics = ecommerce_loader(return_dict=True,
+                                                backend=backend,
+                                                concurrent=concurrent,
+                                                combined=combined,
+                                                suffixes=new_suffixes,
+                                                typed=typed,
+                                                return_metrics=True,
+                                                metrics_log=metrics_log,
+                                                dry_run=dry_run)
+
+        if results is None:
+            results = new_results
+        else:
+            results = {
+                'event_query': _merge_aggregates(
+                    results['event_query'],
+                    new_results['event_query'],
+                    ['user_pseudo_id']),
+                'session_query': _merge_aggregates(
+                    results['session_query'],
+                    new_results['session_query'],
+                    ['user_pseudo_id', 'session']),
+                'device_query': pd.concat(
+                    [results['device_query'], new_results['device_query']],
+                    ignore_index=True).drop_duplicates(ignore_index=True),
+                'geo_query': pd.concat(
+                    [results['geo_query'], new_results['geo_query']],
+                    ignore_index=True).drop_duplicates(ignore_index=True)}
+
+            # Concatenating categoricals falls back to object columns
+            if typed:
+                results = {name: to_compact_frame(df)
+                           for name, df in results.items()}
+
+        # Writing the manifest last so a failed write is retried next run
+        os.makedirs(state_dir, exist_ok=True)
+        for name in names:
+            path = os.path.join(state_dir, f'{name}.parquet')
+            results[name].to_parquet(path, index=False)
+
+            # The merged results match the query over every loaded shard
+            _write_parquet_manifest(path, _parquet_provenance(name, backend),
+                                    len(results[name]))
+
+        with open(manifest_path, 'w') as f:
+            json.dump({'loaded_suffixes': sorted(loaded | set(new_suffixes))},
+                      f, indent=2)
+    elif results is None:
+        raise ValueError('No events shards found to load')
+    else:
+        logger.info("No new shards, using stored results")
 
-    logger.info("Successfully ran geo query")
+    if not return_dict:
+        results = tuple(results[name] for name in names)
 
-    if return_dict:
-        return {'event_query': event_query,
-                'session_query': session_query,
-                'device_query': device_query,
-                'geo_query': geo_query}
+    if return_metrics:
+        return results, metrics
     else:
-        return event_query, session_query, device_query, geo_query
+        return results
 
 
 if __name__ == "__main__":
@@ -1,4 +1,25 @@
-from src.data_loader import ecommerce_loader_test, ecommerce_loader_prod
+from src.data_loader import (ecommerce_loader,
+                             ecommerce_loader_incremental,
+                             ecommerce_loader_steps,
+                             ecommerce_loader_stream,
+                             ecommerce_loader_to_parquet,
+                             parquet_export_matches,
+                             read_row_groups,
+                             FLAG_COLUMNS,
+                             TEST_DATE_RANGE)
+from src.funnel_engine import (EVENT_LABELS,
+                               counts_to_long,
+                               funnel_counts,
+                               funnelCube,
+                               ordered_funnel)
+from src.cohort_engine import (cohort_counts,
+                               conversion_matrix,
+                               retention_matrix)
+from src.latency_engine import latency_histogram, latency_quantiles
+from src.pipeline import pipelineDAG, stage
+from src.sharded_executor import shardedExecutor
+from src.snapshot import snapshotStore
+from src import funnel_engine, polars_engine
 import logging
 import pandas as pd
 
@@ -7,9 +28,80 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+# Running funnel counts folded from streamed query results
+class funnelAccumulator:
+    '''
+    Folds batches of the event or session query into running counts of
+    rows and of rows reaching each funnel step by first event date.
+    '''
+
+    def __init__(self) -> None:
+        self.counts = None
+
+    def update(self, batch_df) -> None:
+        '''
+        Adds one batch of rows to the running counts
+
+        Args
+            batch_df: pandas dataframe with first_event_date and the
+            funnel flag columns
+
+        Returns
+            None
+        '''
+
+        # Counting on the flag arrays, only distinct dates are parsed
+        batch_counts = funnel_counts(batch_df, by='first_event_date')
+
+        if self.counts is None:
+            self.counts = batch_counts
+        else:
+            self.counts = self.counts.add(batch_counts, fill_value=0)\
+                .astype('int64')
+
+    def conversion_rates(self) -> pd.Series:
+        '''Returns the overall conversion rate of each funnel step'''
+
+        totals = self.counts.sum()
+
+        return (totals[FLAG_COLUMNS] / totals['total']).rename(EVENT_LABELS)
+
+    def agg_long(self) -> pd.DataFrame:
+        '''
+        Returns the counts of each step by date in the long format of
+        ecommerceProcessor.agg_long_event_df
+        '''
+
+        return counts_to_long(self.counts)
+
+
 # Setting up the data processor class
 class ecommerceProcessor:
-    def __init__(self) -> None:
+    def __init__(self, backend=None, cache=None, n_workers=None,
+                 engine='pandas') -> None:
+
+        # Query backend, None defaults to BigQuery in the data loader
+        self.backend = backend
+
+        # On-disk queryCache for loader results, None runs every query
+        self.cache = cache
+
+        # Process pool for the aggregations, None runs them in this process
+        self.executor = None if n_workers is None \
+            else shardedExecutor(n_workers=n_workers)
+
+        # Engine for the reshapes and aggregations, 'pandas' or 'polars'.
+        # Polars runs lazy multi-threaded queries and hands back pandas
+        # dataframes, so the visualizations are unchanged
+        engines = {'pandas': funnel_engine, 'polars': polars_engine}
+        if engine not in engines:
+            raise ValueError(f"engine must be one of {list(engines)}")
+
+        if engine == 'polars':
+            polars_engine.import_polars()
+
+        self.engine = engine
+        self._engine = engines[engine]
 
         # Dataframes
         self.event_df = None
@@ -19,14 +111,122 @@ class ecommerceProcessor:
         self.long_event_df = None
         self.long_session_df = None
         self.agg_long_event_df = None
+        self.agg_session_df = None
         self.heatmap_conversion_df = None
+        self.step_df = None
+        self.ordered_funnel_df = None
+
+        # funnelCube of step counts shared by the visualizations
+        self.funnel_cube = None
+
+        # queryMetrics of the last run_queries call
+        self.query_metrics = None
+
+        # Dates and sample of the last run_queries call, None for all
+        self.query_range = {'start_date': None, 'end_date': None,
+                            'sample_frac': None}
+
+        # Stage dependencies, shared with the segmentation of this processor
+        self.pipeline = pipelineDAG()
+        self.pipeline.register(self)
+
+    # Name and dataframes of the processor in snapshots
+    snapshot_name = 'processor'
+    snapshot_frames = ['event_df', 'session_df', 'device_df', 'geo_df',
+                       'long_event_df', 'long_session_df',
+                       'agg_long_event_df', 'agg_session_df',
+                       'heatmap_conversion_df',
+                       'step_df', 'ordered_funnel_df']
+
+    # Whether customer segments have been added to the events
+    @property
+    def created_segments(self) -> bool:
+        return self.pipeline.has_run('add_customer_segments')
+
+    # Helpers for the frames and objects stored in snapshots
+    def _snapshot_state(self) -> tuple:
+        frames = {attr: getattr(self, attr) for attr in self.snapshot_frames}
+
+        # The cube is stored as its counts and rebuilt on restore
+        frames['funnel_cube'] = None if self.funnel_cube is None \
+            else self.funnel_cube.counts
+
+        return frames, {}
+
+    def _restore_state(self, frames, objects) -> None:
+        for attr in self.snapshot_frames:
+            setattr(self, attr, frames.get(attr))
+
+        counts = frames.get('funnel_cube')
+        self.funnel_cube = None if counts is None else funnelCube(counts)
+
+    def save_snapshot(self, snapshot_dir='.snapshots') -> str:
+        '''
+        Saves every populated dataframe, along with those of the
+        segmentation of this processor and its fitted KMeans model, to a
+        new version of an Arrow IPC snapshot
+
+        Args
+            snapshot_dir: directory of the snapshot versions,
+            default = '.snapshots'
+
+        Returns
+            Name of the saved version
+        '''
+
+        frames, objects = {}, {'pipeline': self.pipeline.state()}
+
+        for owner in self.pipeline.owner_objects():
+            owner_frames, owner_objects = owner._snapshot_state()
+            frames.update({f'{owner.snapshot_name}.{name}': df
+                           for name, df in owner_frames.items()})
+            objects.update({f'{owner.snapshot_name}.{name}': obj
+                            for name, obj in owner_objects.items()})
+
+        return snapshotStore(snapshot_dir).save(frames, objects)
+
+    def restore_snapshot(self, snapshot_dir='.snapshots',
+                         version=None) -> None:
+        '''
+        Restores the dataframes of a snapshot by memory-mapping its files,
+        along with the pipeline state, so finished stages are skipped.
+        A segmentation created later restores its part with its own
+        restore_snapshot method.
+
+        Args
+            snapshot_dir: directory of the snapshot versions,
+            default = '.snapshots'
+
+            version: string, default = None for the latest version
 
-        # Logical flags
-        self._long_event_initialized = False
-        self._created_segments = False
+        Returns
+            None
+        '''
+
+        frames, objects = snapshotStore(snapshot_dir).load(version)
+
+        for owner in self.pipeline.owner_objects():
+            prefix = f'{owner.snapshot_name}.'
+            owner._restore_state(
+                {name[len(prefix):]: df for name, df in frames.items()
+                 if name.startswith(prefix)},
+                {name[len(prefix):]: obj for name, obj in objects.items()
+                 if name.startswith(prefix)})
+
+        self.pipeline.load_state(objects['pipeline'])
+
+        logger.info("Restored processor from snapshot")
 
     # Method for running the queries and storing the results
-    def run_queries(self, test_=True) -> None:
+    @stage(outputs=['event_df', 'session_df', 'device_df', 'geo_df'],
+           rerun=['refresh_cache_'],
+           volatile=lambda incremental_dir_, **kwargs:
+           incremental_dir_ is not None)
+    def run_queries(self, test_=True, start_date_=None, end_date_=None,
+                    sample_frac_=None, concurrent_=False, combined_=False,
+                    refresh_cache_=False, incremental_dir_=None,
+                    typed_=False, dry_run_=False,
+                    metrics_log_=None) -> None:
         '''
         Method for running queries to retrieve
         customer data from GCP.
@@ -34,32 +234,181 @@ class ecommerceProcessor:
         Args
             test_: used to control whether the queries run
             return all data from all possible dates, or a
-            selection of a few tables for testing.
+            selection of a few tables for testing. Ignored when
+            a start or end date is given.
+
+            start_date_: date or string, default = None. First day
+            of events to load, None loads from the first shard.
+
+            end_date_: date or string, default = None. Last day of
+            events to load, None loads up to the latest shard.
+
+            sample_frac_: float, default = None. Loads a deterministic
+            sample of this fraction of users.
+
+            concurrent_: boolean, default = False. Runs the four
+            loader queries in parallel instead of one after another.
+
+            combined_: boolean, default = False. Reads the events
+            shards once for the session, device and geo data
+            instead of once per query.
+
+            refresh_cache_: boolean, default = False. Reruns the queries
+            even if the processor's cache holds their results.
+
+            incremental_dir_: directory, default = None. For the prod
+            queries, only loads shards missing from the results stored
+            in this directory and merges them in. Needs test_=False and
+            no start or end date.
+
+            typed_: boolean, default = False. Loads categorical ids and
+            dimensions, int8 funnel flags and datetime columns to cut
+            the memory of the loaded dataframes.
+
+            dry_run_: boolean, default = False. Records a dry-run
+            estimate of the bytes each query processes.
+
+            metrics_log_: file path, default = None. Appends the query
+            metrics stored in query_metrics to this JSON lines log.
 
         Returns
             None
         '''
 
-        if test_:
+        use_dates = start_date_ is not None or end_date_ is not None
+
+        if incremental_dir_ is not None and (test_ or use_dates):
+            raise ValueError('incremental_dir_ loads all prod shards, pass '
+                             'test_=False and no start or end date')
+
+        # The out of core aggregate covers other sessions than the new
+        # session_df, so plots fall back to session_df until it is rebuilt
+        self.agg_session_df = None
+
+        if test_ and not use_dates:
             logger.info("Running test queries")
+            start_date_, end_date_ = TEST_DATE_RANGE
+        elif incremental_dir_ is not None:
+            logger.info("Running incremental prod queries")
+
+            self.query_range = {'start_date': None, 'end_date': None,
+                                'sample_frac': None}
 
             (
-                self.event_df,
-                self.session_df,
-                self.device_df,
-                self.geo_df
-            ) = ecommerce_loader_test()
+                (
+                    self.event_df,
+                    self.session_df,
+                    self.device_df,
+                    self.geo_df
+                ),
+                self.query_metrics
+            ) = ecommerce_loader_incremental(
+                incremental_dir_,
+                backend=self.backend,
+                concurrent=concurrent_,
+                combined=combined_,
+                typed=typed_,
+                return_metrics=True,
+                metrics_log=metrics_log_,
+                dry_run=dry_run_)
+            return
+        elif use_dates:
+            logger.info("Running queries from %s to %s",
+                        start_date_ or 'the first shard',
+                        end_date_ or 'the latest shard')
         else:
             logger.info("Running prod queries")
 
+        self.query_range = {'start_date': start_date_, 'end_date': end_date_,
+                            'sample_frac': sample_frac_}
+
+        (
             (
                 self.event_df,
                 self.session_df,
                 self.device_df,
                 self.geo_df
-            ) = ecommerce_loader_prod()
+            ),
+            self.query_metrics
+        ) = ecommerce_loader(
+            start_date=start_date_,
+            end_date=end_date_,
+            sample_frac=sample_frac_,
+            backend=self.backend,
+            concurrent=concurrent_,
+            combined=combined_,
+            cache=self.cache,
+            refresh_cache=refresh_cache_,
+            typed=typed_,
+            return_metrics=True,
+            metrics_log=metrics_log_,
+            dry_run=dry_run_)
+
+    # Method for loading the raw funnel events for ordered funnels
+    @stage(outputs=['step_df'])
+    def run_step_query(self, test_=True, start_date_=None, end_date_=None,
+                       sample_frac_=None, typed_=False) -> None:
+        '''
+        Loads every funnel event with its user, session and timestamp.
+        Used by prep_ordered_funnel.
+
+        Args
+            test_: boolean, default = True. Loads the test date range
+            unless a start or end date is given
+
+            start_date_: date or string, default = None. First day to load
+
+            end_date_: date or string, default = None. Last day to load
+
+            sample_frac_: float, default = None. Loads a deterministic
+            sample of this fraction of users
+
+            typed_: boolean, default = False. Loads categorical ids and
+            event names
+
+        Returns
+            None
+        '''
+
+        if test_ and start_date_ is None and end_date_ is None:
+            start_date_, end_date_ = TEST_DATE_RANGE
+
+        self.step_df = ecommerce_loader_steps(start_date=start_date_,
+                                              end_date=end_date_,
+                                              sample_frac=sample_frac_,
+                                              backend=self.backend,
+                                              cache=self.cache,
+                                              typed=typed_)
+
+    # Method for funnels counting steps only when reached in order
+    @stage(inputs=['step_df'], outputs=['ordered_funnel_df'])
+    def prep_ordered_funnel(self, level='user', max_windows=None) -> None:
+        '''
+        Flags the steps each user or session reached in funnel order, so
+        for example a purchase without an earlier add to cart only counts
+        as a page view. Use funnel_rates(level='ordered') and
+        step_conversion(level='ordered') on the result.
+
+        Args
+            level: string, default = 'user'. Use 'session' for funnels
+            within each session
+
+            max_windows: default = None for no limit. Longest time between
+            consecutive steps, as seconds or strings like '30min', either
+            one value or a list of three
+
+        Returns
+            None
+        '''
+
+        self.ordered_funnel_df = ordered_funnel(self.step_df,
+                                                level=level,
+                                                max_windows=max_windows)
+
+        logger.info("Built the ordered funnel by %s", level)
 
     # Method to pivot the event data from wide to long
+    @stage(inputs=['event_df'], outputs=['long_event_df'])
     def prep_events(self, rename=True) -> None:
         '''
         Converts the events dataframe from wide to long for vis
@@ -72,31 +421,14 @@ class ecommerceProcessor:
             None
         '''
 
-        self.long_event_df = self.event_df.copy().melt(
-            id_vars=['user_pseudo_id',
-                     'first_event_date',
-                     'first_event_timestamp'])\
-            .rename(columns={'variable': 'event', 'value': 'occurence'})
-        self._long_event_initialized = True
-
-        # Converting event date to datetime
-        self.long_event_df['first_event_date'] = pd.to_datetime(
-            self.long_event_df['first_event_date'])
-
-        # Renaming events for clean plotting
-        if rename:
-            self.long_event_df['event'] = self.long_event_df['event']\
-                .map({'viewed_page':
-                      'Viewed Page',
-                      'added_to_cart':
-                      'Added to Cart',
-                      'began_checkout':
-                      'Began Checkout',
-                      'purchased':
-                      'Purchased'})
+        # Any other columns, like kmeans_cluster, are kept as ids
+        self.long_event_df = self._engine.to_long(self.event_df,
+                                                  rename=rename)
 
         logger.info("Converted events from wide to long")
 
+    @stage(inputs=['segments', 'funnel_cube'],
+           outputs=['heatmap_conversion_df'])
     def prep_segments_conversion_heatmap(self):
         '''
         Prepares segments conversion data for plotting in
@@ -109,18 +441,9 @@ class ecommerceProcessor:
             None
         '''
 
-        # Checking that segments have been created
-        if self._created_segments is False:
-            ValueError('Segments must be created first')
-
-        # Prepping a table for heatmap conversion
-        heatmap_conversion = self.long_event_df.copy()[['kmeans_cluster',
-                                                        'event',
-                                                        'occurence']]\
-            .pivot_table(columns='kmeans_cluster',
-                         index='event',
-                         values='occurence',
-                         aggfunc='mean').round(2)
+        # Prepping a table for heatmap conversion from the funnel cube
+        heatmap_conversion = self.funnel_cube\
+            .rates(by='kmeans_cluster').T.round(2)
 
         # Fixing index and column names
         heatmap_conversion.columns.name = None
@@ -132,7 +455,42 @@ class ecommerceProcessor:
 
         self.heatmap_conversion_df = heatmap_conversion
 
+    # Method to precompute the funnel counts used by the visualizations
+    @stage(inputs=['event_df', 'device_df', 'geo_df'],
+           optional=['segments'],
+           outputs=['funnel_cube'])
+    def prep_funnel_cube(self) -> None:
+        '''
+        Builds the funnel cube of users and users reaching each step by
+        first event date, segment, device category and country. Plots
+        and tables roll up the cube instead of re-aggregating the long
+        events table.
+
+        Args
+            None
+
+        Returns
+            None
+        '''
+
+        # Users are hash partitioned across the workers with the pandas
+        # engine, polars parallelizes the query itself
+        if self.executor is None or self.engine == 'polars':
+            self.funnel_cube = self._engine.build_funnel_cube(
+                self.event_df,
+                device_df=self.device_df,
+                geo_df=self.geo_df)
+        else:
+            self.funnel_cube = self.executor.funnel_cube(
+                self.event_df,
+                device_df=self.device_df,
+                geo_df=self.geo_df)
+
+        logger.info("Built the funnel cube with %s cells",
+                    self.funnel_cube.counts.shape[0])
+
     # Method to pivot the session conversion data from wide to long
+    @stage(inputs=['session_df'], outputs=['long_session_df'])
     def prep_session(self, rename=True) -> None:
         '''
         Converts the session dataframe from wide to long for vis.
@@ -146,33 +504,227 @@ class ecommerceProcessor:
             None
         '''
 
-        # Melting the session dataframe
-        self.long_session_df = self.session_df.copy().melt(
-            id_vars=['user_pseudo_id',
-                     'session',
-                     'first_event_date',
-                     'first_event_timestamp'])\
-            .rename(columns={'variable': 'event', 'value': 'occurence'})
-
-        # Converting event date to datetime
-        self.long_session_df['first_event_date'] = pd.to_datetime(
-            self.long_session_df['first_event_date'])
+        # Reshaping the session dataframe with compact types
+        self.long_session_df = self._engine.to_long(self.session_df,
+                                                    rename=rename)
 
         logger.info("Converted session from wide to long")
 
-        # Renaming events for clean plotting
-        if rename:
-            self.long_session_df['event'] = self.long_session_df['event']\
-                .map({'viewed_page':
-                      'Viewed Page',
-                      'added_to_cart':
-                      'Added to Cart',
-                      'began_checkout':
-                      'Began Checkout',
-                      'purchased':
-                      'Purchased'})
+    # Method to aggregate session conversion without loading session_df
+    @stage(outputs=['agg_session_df'], rerun=['refresh_'])
+    def prep_session_out_of_core(self,
+                                 parquet_path_='session_query.parquet',
+                                 batch_size_=100000,
+                                 refresh_=False) -> None:
+        '''
+        Counts sessions and sessions reaching each step by date, reading
+        the session query from Parquet one row group at a time. Memory
+        is bounded by the row group size instead of the number of
+        sessions. The query covers the dates and sample of the last
+        run_queries call. Used by plot_session_conversion_rate in place
+        of long_session_df.
+
+        Args
+            parquet_path_: string, default = 'session_query.parquet'.
+            Parquet file of the session query, such as the one kept by
+            incremental loads. It is streamed from the backend if missing,
+            or if its manifest shows another query, dates or shards
+
+            batch_size_: int, default = 100000. Rows per row group when
+            streaming the query to Parquet
+
+            refresh_: boolean, default = False. Streams the query again
+            even if the Parquet file exists
+
+        Returns
+            None
+        '''
+
+        if refresh_ or not parquet_export_matches(parquet_path_,
+                                                  'session_query',
+                                                  backend=self.backend,
+                                                  **self.query_range):
+            ecommerce_loader_to_parquet('session_query',
+                                        parquet_path_,
+                                        backend=self.backend,
+                                        batch_size=batch_size_,
+                                        **self.query_range)
+
+        accumulator = funnelAccumulator()
+
+        for chunk_df in read_row_groups(parquet_path_,
+                                        columns=['first_event_date'] +
+                                        FLAG_COLUMNS):
+            accumulator.update(chunk_df)
+
+        self.agg_session_df = accumulator.counts
+
+        logger.info("Aggregated sessions out of core")
+
+    # Helper picking the wide table of a funnel level
+    def _wide_df(self, level) -> pd.DataFrame:
+        wide_dfs = {'event': self.event_df,
+                    'session': self.session_df,
+                    'ordered': self.ordered_funnel_df}
+
+        if level not in wide_dfs:
+            raise ValueError(f"level must be one of {list(wide_dfs)}")
+
+        return wide_dfs[level]
+
+    # Methods for funnel rates computed on the wide flag columns
+    def funnel_rates(self, by=None, level='event') -> pd.DataFrame:
+        '''
+        Calculates the share of users or sessions reaching each step
+
+        Args
+            by: column to group by, default = None. For example
+            'first_event_date', or 'kmeans_cluster' once segments have
+            been added
+
+            level: string, default = 'event'. Use 'session' for the
+            session level conversion, or 'ordered' for the funnel from
+            prep_ordered_funnel
+
+        Returns
+            Pandas dataframe with one row per group and one column
+            per funnel step
+        '''
+
+        wide_df = self._wide_df(level)
+
+        return self._engine.funnel_rates(wide_df, by=by)
+
+    def step_conversion(self, by=None, level='event') -> pd.DataFrame:
+        '''
+        Calculates the share of users or sessions reaching each step out
+        of those reaching the previous step
+
+        Args
+            by: column to group by, default = None
+
+            level: string, default = 'event'. Use 'session' for the
+            session level conversion, or 'ordered' for the funnel from
+            prep_ordered_funnel
+
+        Returns
+            Pandas dataframe with one row per group and one column
+            per funnel step
+        '''
+
+        wide_df = self._wide_df(level)
+
+        return self._engine.step_conversion(wide_df, by=by)
+
+    # Method for retention and conversion of first session cohorts
+    def cohort_matrices(self, freq='week', step='purchased') -> tuple:
+        '''
+        Calculates cohort by period retention and conversion from the
+        sessions, where a user's cohort is the day, week or month of
+        their first session
+
+        Args
+            freq: string, default = 'week'. Use 'day' or 'month' for
+            other cohort lengths
+
+            step: funnel flag column counted as converting, default =
+            'purchased'
+
+        Returns
+            Tuple of the retention and conversion pandas dataframes, with
+            one row per cohort and one column per period since the cohort
+        '''
+
+        counts = cohort_counts(self.session_df, freq=freq, step=step)
+
+        return retention_matrix(counts), conversion_matrix(counts)
+
+    # Methods for the time taken between consecutive funnel steps
+    def step_latency(self, by=None, level='event',
+                     quantiles=(0.5, 0.9, 0.99)) -> pd.DataFrame:
+        '''
+        Estimates quantiles of the seconds between first reaching each
+        funnel step and the next, from mergeable sketches instead of
+        sorting every latency
+
+        Args
+            by: column to group by, default = None. For example
+            'first_event_date', or 'kmeans_cluster' once segments have
+            been added
+
+            level: string, default = 'event'. Use 'session' for the time
+            within sessions, or 'ordered' for steps reached in order
+
+            quantiles: list of floats, default = (0.5, 0.9, 0.99)
+
+        Returns
+            Pandas dataframe indexed by group and transition with the
+            count, the mean and one column per quantile
+        '''
+
+        wide_df = self._wide_df(level)
+
+        return latency_quantiles(wide_df, by=by, quantiles=quantiles)
+
+    def step_latency_histogram(self, by=None, level='event',
+                               bins=None) -> pd.DataFrame:
+        '''
+        Counts the users or sessions in each latency bin between
+        consecutive funnel steps
+
+        Args
+            by: column to group by, default = None
+
+            level: string, default = 'event'. Use 'session' or 'ordered'
+
+            bins: list of bin edges in seconds or timedelta strings,
+            default = None for latency_engine.LATENCY_BINS
+
+        Returns
+            Pandas dataframe indexed by group and transition with one
+            column of counts per bin
+        '''
+
+        wide_df = self._wide_df(level)
+
+        return latency_histogram(wide_df, by=by, bins=bins)
+
+    # Method to fold streamed query results into funnel counts
+    def stream_agg_conversion(self,
+                              query_name='event_query',
+                              batch_size=100000) -> funnelAccumulator:
+        '''
+        Aggregates funnel counts from the prod queries page by page, so
+        memory is bounded by the batch size rather than the full result.
+        For the event query this also sets agg_long_event_df.
+
+        Args
+            query_name: string, default = 'event_query'. Use
+            'session_query' for session level conversion
+
+            batch_size: int, default = 100000. Rows per streamed batch
+
+        Returns
+            funnelAccumulator with the running counts
+        '''
+
+        accumulator = funnelAccumulator()
+
+        for batch_df in ecommerce_loader_stream(query_name,
+                                                backend=self.backend,
+                                                batch_size=batch_size,
+                                                typed=True):
+            accumulator.update(batch_df)
+
+        if query_name == 'event_query':
+            self.agg_long_event_df = accumulator.agg_long()
+
+        logger.info("Aggregated streamed %s", query_name.replace('_', ' '))
+
+        return accumulator
 
     # Method to get aggregate conversions by event
+    @stage(inputs=['event_df'], outputs=['agg_long_event_df'])
     def prep_agg_conversion(self) -> None:
         '''
         Calculates aggregate event metrics for visualizations of total traffic.
@@ -186,15 +738,15 @@ class ecommerceProcessor:
             None
         '''
 
-        # Checking if events have been prepped
-        if self._long_event_initialized:
-            self.prep_events()
+        # Counting steps by date on the wide flags, without the long table
+        if self.executor is None or self.engine == 'polars':
+            counts = self._engine.funnel_counts(self.event_df,
+                                                by='first_event_date')
+        else:
+            counts = self.executor.funnel_counts(self.event_df,
+                                                 by='first_event_date')
 
-        self.agg_long_event_df = self.long_event_df\
-            .loc[:, ['first_event_date',
-                     'event',
-                     'occurence']]\
-            .groupby(['first_event_date', 'event']).sum().reset_index()
+        self.agg_long_event_df = counts_to_long(counts)
 
         logger.info("Aggregated events")
 
@@ -0,0 +1,192 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# Bucket replacing category values below the frequency threshold
+OTHER = 'other'
+
+
+class featureMatrix:
+    '''
+    Encoded clustering features of one row per user, held as a float32
+    CSR matrix with its row index and column names. One-hot columns take
+    one stored value per user instead of a dense int64 column per value.
+    '''
+
+    def __init__(self, matrix, index, feature_names) -> None:
+        self.matrix = sparse.csr_matrix(matrix, dtype=np.float32)
+        self.index = pd.Index(index)
+        self.feature_names = list(feature_names)
+
+    @property
+    def shape(self) -> tuple:
+        return self.matrix.shape
+
+    def __len__(self) -> int:
+        return self.matrix.shape[0]
+
+    def mean(self) -> pd.Series:
+        '''Returns the mean of every feature without densifying the matrix'''
+
+        return pd.Series(np.asarray(self.matrix.mean(axis=0)).ravel(),
+                         index=self.feature_names)
+
+    def take(self, rows) -> 'featureMatrix':
+        '''
+        Selects rows by position
+
+        Args
+            rows: array of row positions
+
+        Returns
+            featureMatrix of the selected rows
+        '''
+
+        return featureMatrix(self.matrix[rows], self.index[rows],
+                             self.feature_names)
+
+    def to_frame(self) -> pd.DataFrame:
+        '''Returns a dense float32 dataframe, for small samples only'''
+
+        return pd.DataFrame(self.matrix.toarray(),
+                            index=self.index,
+                            columns=self.feature_names)
+
+
+class featureEncoder:
+    '''
+    Encodes customer attributes for clustering. Categorical columns are
+    one-hot encoded after bucketing rare values into 'other', very high
+    cardinality columns are hashed into a fixed number of columns, and
+    numeric columns are standardized. The result is a sparse float32
+    matrix.
+    '''
+
+    def __init__(self, min_frac=0.05, hashed=None, n_hash_features=256,
+                 standardize=True) -> None:
+        # Share of rows a category needs to keep its own column
+        self.min_frac = min_frac
+
+        # Columns hashed instead of one-hot encoded, and columns per hash
+        self.hashed = list(hashed or [])
+        self.n_hash_features = n_hash_features
+
+        # Whether numeric columns are scaled to zero mean and unit variance
+        self.standardize = standardize
+
+        # Fitted state, per column
+        self.categories_ = {}
+        self.scales_ = {}
+        self.feature_names_ = []
+
+    def fit(self, df) -> 'featureEncoder':
+        '''
+        Learns the kept categories and numeric scales of each column
+
+        Args
+            df: pandas dataframe of the feature columns, indexed by user
+
+        Returns
+            The fitted featureEncoder
+        '''
+
+        self.categories_, self.scales_, self.feature_names_ = {}, {}, []
+
+        for col in df.columns:
+            values = df[col]
+
+            if col in self.hashed:
+                self.feature_names_ += [f'{col}_hash{i}'
+                                        for i in range(self.n_hash_features)]
+            elif pd.api.types.is_numeric_dtype(values) and \
+                    not pd.api.types.is_bool_dtype(values):
+                mean, std = values.mean(), values.std(ddof=0)
+                if not self.standardize:
+                    mean, std = 0.0, 1.0
+                self.scales_[col] = (float(mean),
+                                     float(std) if std > 0 else 1.0)
+                self.feature_names_.append(col)
+            else:
+                # Vectorized bucketing on the value counts, not every row
+                fracs = values.value_counts(normalize=True, dropna=True)
+                kept = fracs.index[fracs > self.min_frac]
+                categories = sorted(str(value) for value in kept)
+                if len(kept) < len(fracs):
+                    categories.append(OTHER)
+
+                self.categories_[col] = pd.Index(categories)
+                self.feature_names_ += [f'{col}_{value}'
+                                        for value in categories]
+
+        return self
+
+    def transform(self, df) -> featureMatrix:
+        '''
+        Encodes the columns the encoder was fitted on
+
+        Args
+            df: pandas dataframe of the feature columns, indexed by user
+
+        Returns
+            featureMatrix with one row per row of df
+        '''
+
+        n_rows = df.shape[0]
+        rows, cols, data = [], [], []
+        offset = 0
+
+        for col in df.columns:
+            values = df[col]
+
+            if col in self.hashed:
+                codes, uniques = pd.factorize(values)
+                hashes = pd.util.hash_array(
+                    np.asarray(uniques).astype(str).astype(object))
+                buckets = (hashes % np.uint64(self.n_hash_features))\
+                    .astype(np.int64)
+
+                present = np.flatnonzero(codes >= 0)
+                rows.append(present)
+                cols.append(offset + buckets[codes[present]])
+                data.append(np.ones(len(present), dtype=np.float32))
+                offset += self.n_hash_features
+
+            elif col in self.scales_:
+                mean, std = self.scales_[col]
+                scaled = (values.to_numpy(dtype=np.float64, na_value=mean) -
+                          mean) / std
+
+                rows.append(np.arange(n_rows))
+                cols.append(np.full(n_rows, offset))
+                data.append(scaled.astype(np.float32))
+                offset += 1
+
+            else:
+                categories = self.categories_[col]
+                codes, uniques = pd.factorize(values)
+
+                # Looking up each distinct value once, rare ones go to other
+                lookup = categories.get_indexer(
+                    np.asarray(uniques, dtype=object).astype(str))
+                if OTHER in categories:
+                    lookup[lookup < 0] = categories.get_loc(OTHER)
+
+                positions = np.append(lookup, -1)[codes]
+                present = np.flatnonzero(positions >= 0)
+                rows.append(present)
+                cols.append(offset + positions[present])
+                data.append(np.ones(len(present), dtype=np.float32))
+                offset += len(categories)
+
+        matrix = sparse.csr_matrix(
+            (np.concatenate(data) if data else np.zeros(0, np.float32),
+             (np.concatenate(rows) if rows else np.zeros(0, np.int64),
+              np.concatenate(cols) if cols else np.zeros(0, np.int64))),
+            shape=(n_rows, offset), dtype=np.float32)
+
+        return featureMatrix(matrix, df.index, self.feature_names_)
+
+    def fit_transform(self, df) -> featureMatrix:
+        '''Fits the encoder and encodes the same dataframe'''
+
+        return self.fit(df).transform(df)
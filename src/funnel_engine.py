@@ -0,0 +1,553 @@
+import numpy as np
+import pandas as pd
+from src.data_loader import FLAG_COLUMNS, STEP_TIMESTAMP_COLUMNS
+
+# Clean names of the funnel steps for plotting, in funnel order
+EVENT_LABELS = {'viewed_page': 'Viewed Page',
+                'added_to_cart': 'Added to Cart',
+                'began_checkout': 'Began Checkout',
+                'purchased': 'Purchased'}
+
+# Ordered categorical for the clean step names, keeping funnel order in plots
+EVENT_DTYPE = pd.CategoricalDtype(list(EVENT_LABELS.values()), ordered=True)
+
+
+# Helper to encode the grouping column as integer codes
+def group_codes(wide_df, by):
+    '''
+    Encodes the rows of a wide dataframe by group
+
+    Args
+        wide_df: pandas dataframe with one row per user or session
+
+        by: column to group by, or None for a single overall group
+
+    Returns
+        Tuple of integer codes per row and the index of the groups
+    '''
+
+    if by is None:
+        return np.zeros(wide_df.shape[0], dtype=np.intp), pd.Index(['All'])
+
+    codes, uniques = pd.factorize(wide_df[by], sort=True)
+
+    # Only the distinct dates need parsing, not every row
+    if by == 'first_event_date':
+        uniques = pd.to_datetime(uniques)
+
+    return codes, pd.Index(uniques, name=by)
+
+
+def funnel_counts(wide_df, by=None) -> pd.DataFrame:
+    '''
+    Counts the rows and the rows reaching each funnel step by group,
+    reducing the flag columns directly without reshaping to long.
+
+    Args
+        wide_df: pandas dataframe with the funnel flag columns, such as
+        ecommerceProcessor.event_df or session_df
+
+        by: column to group by, default = None. For example
+        'first_event_date' or 'kmeans_cluster'
+
+    Returns
+        Pandas dataframe with a 'total' column and one column per step
+    '''
+
+    codes, groups = group_codes(wide_df, by)
+
+    # Rows with a missing group are dropped, like in a groupby
+    valid = codes >= 0
+    codes = codes[valid]
+    flags = wide_df.loc[:, FLAG_COLUMNS].to_numpy()[valid]
+
+    counts = {'total': np.bincount(codes, minlength=len(groups))}
+    for i, step in enumerate(FLAG_COLUMNS):
+        counts[step] = np.bincount(codes,
+                                   weights=flags[:, i],
+                                   minlength=len(groups)).astype(np.int64)
+
+    return pd.DataFrame(counts, index=groups)
+
+
+def funnel_rates(wide_df, by=None, rename=True) -> pd.DataFrame:
+    '''
+    Calculates the share of rows reaching each funnel step by group
+
+    Args
+        wide_df: pandas dataframe with the funnel flag columns
+
+        by: column to group by, default = None for the overall rates
+
+        rename: boolean, default = True. Uses the clean step names
+
+    Returns
+        Pandas dataframe with one column per step
+    '''
+
+    return rates_from_counts(funnel_counts(wide_df, by), rename=rename)
+
+
+def rates_from_counts(counts, rename=True) -> pd.DataFrame:
+    '''
+    Divides the step counts by the total of each group
+
+    Args
+        counts: pandas dataframe from funnel_counts
+
+        rename: boolean, default = True. Uses the clean step names
+
+    Returns
+        Pandas dataframe with one column per step
+    '''
+
+    rates = counts.loc[:, FLAG_COLUMNS].div(counts['total'], axis=0)
+
+    return rates.rename(columns=EVENT_LABELS) if rename else rates
+
+
+def step_conversion(wide_df, by=None, rename=True) -> pd.DataFrame:
+    '''
+    Calculates step-to-step conversion, the share of rows reaching each
+    step out of the rows reaching the previous step. The first step is
+    relative to all rows.
+
+    Args
+        wide_df: pandas dataframe with the funnel flag columns
+
+        by: column to group by, default = None for the overall rates
+
+        rename: boolean, default = True. Uses the clean step names
+
+    Returns
+        Pandas dataframe with one column per step
+    '''
+
+    return step_conversion_from_counts(funnel_counts(wide_df, by),
+                                       rename=rename)
+
+
+def step_conversion_from_counts(counts, rename=True) -> pd.DataFrame:
+    '''
+    Divides the count of each step by the count of the previous step
+
+    Args
+        counts: pandas dataframe from funnel_counts
+
+        rename: boolean, default = True. Uses the clean step names
+
+    Returns
+        Pandas dataframe with one column per step
+    '''
+
+    reached = counts.loc[:, ['total'] + FLAG_COLUMNS].to_numpy(dtype=float)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        conversion = reached[:, 1:] / reached[:, :-1]
+
+    conversion = pd.DataFrame(conversion,
+                              index=counts.index,
+                              columns=FLAG_COLUMNS)
+
+    return conversion.rename(columns=EVENT_LABELS) if rename else conversion
+
+
+def counts_to_long(counts) -> pd.DataFrame:
+    '''
+    Converts funnel counts by date to the long format used for plotting
+    total conversion events over time.
+
+    Args
+        counts: pandas dataframe from funnel_counts grouped by
+        first_event_date
+
+    Returns
+        Pandas dataframe with first_event_date, event and occurence
+    '''
+
+    long_df = counts.loc[:, FLAG_COLUMNS]\
+        .rename(columns=EVENT_LABELS)\
+        .rename_axis('first_event_date')\
+        .reset_index()\
+        .melt(id_vars='first_event_date',
+              var_name='event',
+              value_name='occurence')
+
+    long_df['event'] = long_df['event'].astype(EVENT_DTYPE)
+
+    return long_df.sort_values(['first_event_date', 'event'],
+                               ignore_index=True)
+
+
+def to_long(wide_df, rename=True) -> pd.DataFrame:
+    '''
+    Reshapes a wide event or session table to one row per user or session
+    and funnel step, with compact types: an ordered categorical event,
+    int8 occurences and categorical user ids shared by all steps.
+
+    Args
+        wide_df: pandas dataframe with the funnel flag columns. Every
+        other column apart from the step timestamps is repeated for each
+        step
+
+        rename: boolean, default = True. Uses the clean step names
+
+    Returns
+        Pandas dataframe with the id columns, event and occurence, in
+        the same row order as melt
+    '''
+
+    n_rows = wide_df.shape[0]
+    n_steps = len(FLAG_COLUMNS)
+
+    long_cols = {}
+    for col in wide_df.columns:
+        # Step times are per row, not per step, and left out like flags
+        if col in FLAG_COLUMNS or col in STEP_TIMESTAMP_COLUMNS:
+            continue
+
+        values = wide_df[col]
+
+        # Parsing the n distinct rows once instead of every long row
+        if col == 'first_event_date':
+            values = pd.to_datetime(values)
+
+        # Categorical columns keep their categories, string ids are coded
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            long_cols[col] = pd.Categorical.from_codes(
+                np.tile(values.cat.codes.to_numpy(), n_steps),
+                dtype=values.dtype)
+        elif col == 'user_pseudo_id':
+            codes, categories = pd.factorize(values)
+            long_cols[col] = pd.Categorical.from_codes(
+                np.tile(codes, n_steps), categories=categories)
+        else:
+            long_cols[col] = np.tile(values.to_numpy(), n_steps)
+
+    if rename:
+        event_dtype = EVENT_DTYPE
+    else:
+        event_dtype = pd.CategoricalDtype(FLAG_COLUMNS, ordered=True)
+
+    long_cols['event'] = pd.Categorical.from_codes(
+        np.repeat(np.arange(n_steps), n_rows), dtype=event_dtype)
+
+    # Step-major order, all rows for the first step then the next
+    long_cols['occurence'] = wide_df.loc[:, FLAG_COLUMNS]\
+        .to_numpy(dtype=np.int8).T.ravel()
+
+    return pd.DataFrame(long_cols)
+
+
+# Dimensions of the funnel cube, the segment only once segments exist
+CUBE_DIMENSIONS = ['first_event_date', 'kmeans_cluster', 'category', 'country']
+
+# Value used for users without a device or geo row
+NOT_SET = '(not set)'
+
+
+# Helper resolving a per-session attribute to each user's first session
+def _first_session_value(session_df, col) -> pd.Series:
+    '''
+    Picks the value of a column in the first session of each user
+
+    Args
+        session_df: pandas dataframe with user_pseudo_id, session and
+        the column, such as ecommerceProcessor.device_df
+
+        col: column to resolve
+
+    Returns
+        Pandas series of the value indexed by user_pseudo_id
+    '''
+
+    first = session_df.loc[:, ['user_pseudo_id', 'session', col]]\
+        .sort_values(['user_pseudo_id', 'session'])\
+        .drop_duplicates('user_pseudo_id')
+
+    values = first[col].astype(object).where(first[col].notna(), NOT_SET)
+
+    return pd.Series(values.to_numpy(),
+                     index=first['user_pseudo_id'].astype(object),
+                     name=col)
+
+
+class funnelCube:
+    '''
+    Counts of users and of users reaching each funnel step by first event
+    date, segment, device category and country. The cube is built once
+    from the wide tables and every chart or table rolls it up, so changing
+    a filter never re-scans the per-user data.
+    '''
+
+    def __init__(self, counts) -> None:
+        # Dataframe indexed by the cube dimensions with a 'total' column
+        # and one column per funnel step
+        self.counts = counts
+
+    @property
+    def dimensions(self) -> list:
+        return list(self.counts.index.names)
+
+    def rollup(self, by=None, filters=None) -> pd.DataFrame:
+        '''
+        Sums the cube over every dimension not kept
+
+        Args
+            by: dimension or list of dimensions to keep, default = None
+            for a single overall row
+
+            filters: dictionary, default = None. Maps a dimension to a
+            value or list of values to keep before rolling up, for
+            example {'category': 'mobile'}
+
+        Returns
+            Pandas dataframe with a 'total' column and one column per step,
+            like funnel_counts
+        '''
+
+        counts = self.counts
+
+        for dim, values in (filters or {}).items():
+            if dim not in self.dimensions:
+                raise KeyError(f'{dim} is not a dimension of the cube')
+
+            if not isinstance(values, (list, tuple, set)):
+                values = [values]
+
+            counts = counts[counts.index.get_level_values(dim).isin(values)]
+
+        if by is None:
+            return counts.sum().to_frame('All').T
+
+        for dim in [by] if isinstance(by, str) else by:
+            if dim not in self.dimensions:
+                raise KeyError(f'{dim} is not a dimension of the cube')
+
+        return counts.groupby(level=by, observed=True, sort=True).sum()
+
+    def rates(self, by=None, filters=None, rename=True) -> pd.DataFrame:
+        '''
+        Calculates the share of users reaching each step from the cube
+
+        Args
+            by: dimension or list of dimensions to keep, default = None
+
+            filters: dictionary of dimension to values, default = None
+
+            rename: boolean, default = True. Uses the clean step names
+
+        Returns
+            Pandas dataframe with one column per step, like funnel_rates
+        '''
+
+        return rates_from_counts(self.rollup(by, filters), rename=rename)
+
+    def to_long(self, by=None, filters=None, rates=True) -> pd.DataFrame:
+        '''
+        Rolls up the cube into the long format used by the plots
+
+        Args
+            by: dimension or list of dimensions to keep, default = None
+
+            filters: dictionary of dimension to values, default = None
+
+            rates: boolean, default = True. Returns the share of users
+            reaching each step, otherwise the number of users
+
+        Returns
+            Pandas dataframe with the kept dimensions, an ordered
+            categorical event and occurence
+        '''
+
+        if rates:
+            wide = self.rates(by, filters)
+        else:
+            wide = self.rollup(by, filters).loc[:, FLAG_COLUMNS]\
+                .rename(columns=EVENT_LABELS)
+
+        id_vars = [] if by is None else ([by] if isinstance(by, str) else by)
+        if by is not None:
+            wide = wide.reset_index()
+
+        long_df = wide.melt(id_vars=id_vars,
+                            var_name='event',
+                            value_name='occurence')
+        long_df['event'] = long_df['event'].astype(EVENT_DTYPE)
+
+        return long_df.sort_values(id_vars + ['event'], ignore_index=True)
+
+
+def build_funnel_cube(event_df, device_df=None, geo_df=None) -> funnelCube:
+    '''
+    Builds the funnel cube from the wide events table. Device category and
+    country are taken from each user's first session, so every user is
+    counted once.
+
+    Args
+        event_df: pandas dataframe with one row per user and the funnel
+        flag columns, plus kmeans_cluster once segments have been added
+
+        device_df: pandas dataframe with the device category by session,
+        default = None to leave the category out of the cube
+
+        geo_df: pandas dataframe with the country by session,
+        default = None to leave the country out of the cube
+
+    Returns
+        funnelCube
+    '''
+
+    codes, uniques = pd.factorize(event_df['first_event_date'])
+    dims = {'first_event_date': pd.to_datetime(uniques)[codes]}
+
+    if 'kmeans_cluster' in event_df.columns:
+        dims['kmeans_cluster'] = event_df['kmeans_cluster'].to_numpy()
+
+    users = event_df['user_pseudo_id'].astype(object)
+    for col, session_df in [('category', device_df), ('country', geo_df)]:
+        if session_df is None:
+            continue
+
+        values = users.map(_first_session_value(session_df, col))
+        dims[col] = pd.Categorical(values.fillna(NOT_SET))
+
+    flags = event_df.loc[:, FLAG_COLUMNS].astype(np.int64)\
+        .assign(total=1)\
+        .loc[:, ['total'] + FLAG_COLUMNS]
+
+    counts = flags.groupby([dims[dim] for dim in CUBE_DIMENSIONS
+                            if dim in dims],
+                           observed=True,
+                           dropna=False)\
+        .sum()
+    counts.index.names = [dim for dim in CUBE_DIMENSIONS if dim in dims]
+
+    return funnelCube(counts)
+
+
+# GA4 event name of each funnel step, in funnel order
+STEP_EVENTS = {'page_view': 'viewed_page',
+               'add_to_cart': 'added_to_cart',
+               'begin_checkout': 'began_checkout',
+               'purchase': 'purchased'}
+
+
+# Helper turning step windows into microseconds per transition
+def _step_windows(max_windows) -> list:
+    if max_windows is None or np.isscalar(max_windows) or \
+            isinstance(max_windows, pd.Timedelta):
+        max_windows = [max_windows] * (len(FLAG_COLUMNS) - 1)
+
+    if len(max_windows) != len(FLAG_COLUMNS) - 1:
+        raise ValueError('max_windows needs one window per transition '
+                         f'between the {len(FLAG_COLUMNS)} steps')
+
+    windows = []
+    for window in max_windows:
+        if window is None:
+            windows.append(None)
+        elif isinstance(window, (str, pd.Timedelta)):
+            windows.append(pd.Timedelta(window) // pd.Timedelta('1us'))
+        else:
+            windows.append(int(window * 1000000))
+
+    return windows
+
+
+# Helper for the time each group first reached a step in order
+def _first_reached_time(group, timestamps, reached, n_groups) -> np.ndarray:
+    rows = np.flatnonzero(reached)
+
+    # Rows are sorted by group then time, the first of each group is the
+    # earliest
+    first = rows[np.r_[True, group[rows][1:] != group[rows][:-1]]] \
+        if len(rows) else rows
+
+    times = np.full(n_groups, np.nan)
+    times[group[first]] = timestamps[first]
+
+    return times
+
+
+def ordered_funnel(steps_df, level='user', max_windows=None) -> pd.DataFrame:
+    '''
+    Flags the funnel steps each user or session reached in order. A step
+    only counts if it happened after the previous step was reached, so a
+    purchase without an earlier add to cart does not count as converting
+    through the cart. The events are sorted once and every step is a
+    vectorized pass over the sorted arrays.
+
+    Args
+        steps_df: pandas dataframe from data_loader.ecommerce_loader_steps
+        with user_pseudo_id, session, event_date, event_timestamp and
+        event_name
+
+        level: string, default = 'user'. Use 'session' for funnels within
+        each session
+
+        max_windows: default = None for no limit. Longest time between
+        consecutive steps, either one value for every transition or a
+        list of three. Numbers are seconds, strings are parsed as
+        timedeltas like '30min'
+
+    Returns
+        Pandas dataframe with one row per user or session, its
+        first_event_date, the funnel flag columns and the time each step
+        was first reached in order, like the loader step timestamps
+    '''
+
+    keys = ['user_pseudo_id'] + (['session'] if level == 'session' else [])
+    windows = _step_windows(max_windows)
+
+    # Step number of each event, -1 for other events
+    name_codes, names = pd.factorize(steps_df['event_name'])
+    lookup = pd.Index(list(STEP_EVENTS)).get_indexer(np.asarray(names))
+    step = np.append(lookup, -1)[name_codes]
+
+    group = steps_df.groupby(keys, sort=False, observed=True).ngroup()\
+        .to_numpy()
+    timestamps = steps_df['event_timestamp'].to_numpy(dtype=np.int64)
+
+    # Sorting once by group, time and step, so ties keep funnel order
+    order = np.lexsort((step, timestamps, group))
+    step, timestamps, group = step[order], timestamps[order], group[order]
+
+    n_rows = len(order)
+    n_groups = group.max() + 1 if n_rows else 0
+    rows = np.arange(n_rows)
+
+    reached = step == 0
+    flags = {FLAG_COLUMNS[0]: np.zeros(n_groups, dtype=np.int8)}
+    flags[FLAG_COLUMNS[0]][group[reached]] = 1
+    times = {STEP_TIMESTAMP_COLUMNS[0]: _first_reached_time(
+        group, timestamps, reached, n_groups)}
+
+    for k, window in enumerate(windows, start=1):
+        # Latest event reaching the previous step, at or before each row
+        latest = np.maximum.accumulate(np.where(reached, rows, -1))
+
+        reached = (step == k) & (latest >= 0)
+        reached[reached] &= group[latest[reached]] == group[reached]
+
+        if window is not None:
+            reached[reached] &= timestamps[reached] - \
+                timestamps[latest[reached]] <= window
+
+        flags[FLAG_COLUMNS[k]] = np.zeros(n_groups, dtype=np.int8)
+        flags[FLAG_COLUMNS[k]][group[reached]] = 1
+        times[STEP_TIMESTAMP_COLUMNS[k]] = _first_reached_time(
+            group, timestamps, reached, n_groups)
+
+    # The first sorted row of each group holds its keys and first date
+    first = np.flatnonzero(np.r_[True, group[1:] != group[:-1]]) \
+        if n_rows else rows
+    funnel_df = steps_df.iloc[order[first]]\
+        .loc[:, keys + ['event_date']]\
+        .rename(columns={'event_date': 'first_event_date'})\
+        .reset_index(drop=True)
+
+    for col, values in {**flags, **times}.items():
+        funnel_df[col] = values
+
+    return funnel_df
@@ -0,0 +1,342 @@
+import numpy as np
+import pandas as pd
+from src.data_loader import FLAG_COLUMNS, STEP_TIMESTAMP_COLUMNS
+from src.funnel_engine import EVENT_LABELS, group_codes
+
+# Consecutive funnel steps whose latency is measured, in funnel order
+TRANSITIONS = list(zip(FLAG_COLUMNS[:-1], FLAG_COLUMNS[1:]))
+
+# Clean names of the transitions, ordered like the funnel in plots
+TRANSITION_LABELS = [f'{EVENT_LABELS[start]} -> {EVENT_LABELS[end]}'
+                     for start, end in TRANSITIONS]
+TRANSITION_DTYPE = pd.CategoricalDtype(TRANSITION_LABELS, ordered=True)
+
+# Default histogram bin edges, from zero to a week
+LATENCY_BINS = ['0s', '10s', '1min', '5min', '15min', '1h', '6h', '1D', '7D']
+
+
+# Helper reading a step time column as float microseconds, NaN if missing
+def _microseconds(values) -> np.ndarray:
+    if pd.api.types.is_datetime64_any_dtype(values):
+        missing = values.isna().to_numpy()
+        micros = values.to_numpy('datetime64[us]').view(np.int64)\
+            .astype(float)
+        micros[missing] = np.nan
+        return micros
+
+    return pd.to_numeric(values).to_numpy(dtype=float, na_value=np.nan)
+
+
+def step_latencies(wide_df) -> pd.DataFrame:
+    '''
+    Calculates the seconds between first reaching each funnel step and
+    first reaching the next step, by subtracting the step time columns.
+    Rows that skipped either step, or reached the next step before the
+    previous one, are missing.
+
+    Args
+        wide_df: pandas dataframe with the step timestamp columns, such as
+        ecommerceProcessor.event_df, session_df or ordered_funnel_df
+
+    Returns
+        Pandas dataframe with one float column of seconds per transition,
+        in the row order of wide_df
+    '''
+
+    missing = [col for col in STEP_TIMESTAMP_COLUMNS
+               if col not in wide_df.columns]
+    if missing:
+        raise KeyError(f'{missing} are missing, reload the data to get the '
+                       'step timestamps')
+
+    times = {col: _microseconds(wide_df[col])
+             for col in STEP_TIMESTAMP_COLUMNS}
+
+    latencies = {}
+    for label, (start, end) in zip(TRANSITION_LABELS, TRANSITIONS):
+        seconds = (times[f'{end}_timestamp'] -
+                   times[f'{start}_timestamp']) / 1e6
+
+        # NaN comparisons are False, so missing steps stay missing
+        seconds[~(seconds >= 0)] = np.nan
+        latencies[label] = seconds
+
+    return pd.DataFrame(latencies, index=wide_df.index)
+
+
+class quantileSketch:
+    '''
+    Mergeable sketch of latencies with a bounded relative error on every
+    quantile. Values are counted in logarithmic buckets, so memory depends
+    on the value range and accuracy rather than the number of values, no
+    sorting is needed, and sketches of separate batches or shards are
+    merged by adding their counts. One row of buckets is kept per group.
+    '''
+
+    def __init__(self, n_groups=1, relative_accuracy=0.01,
+                 min_value=1e-6, max_value=1e9) -> None:
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.max_value = max_value
+
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = np.log(self._gamma)
+        self._offset = int(np.floor(np.log(min_value) / self._log_gamma))
+        n_buckets = int(np.ceil(np.log(max_value) / self._log_gamma)) - \
+            self._offset
+
+        # Bucket 0 holds zero latencies, bucket b > 0 holds values up to
+        # gamma ** (b + offset)
+        self.counts = np.zeros((n_groups, n_buckets + 1), dtype=np.int64)
+        self.sums = np.zeros(n_groups)
+
+    @property
+    def n_groups(self) -> int:
+        return self.counts.shape[0]
+
+    @property
+    def count(self) -> np.ndarray:
+        return self.counts.sum(axis=1)
+
+    # Helper mapping values to their bucket
+    def _buckets(self, values) -> np.ndarray:
+        with np.errstate(divide='ignore'):
+            buckets = np.ceil(np.log(values) / self._log_gamma) - self._offset
+
+        buckets = np.clip(buckets, 1, self.counts.shape[1] - 1)
+
+        return np.where(values > 0, buckets, 0).astype(np.intp)
+
+    def update(self, values, groups=None) -> None:
+        '''
+        Adds values to the sketch, ignoring missing ones
+
+        Args
+            values: array of non-negative latencies
+
+            groups: array of the group code of each value, default = None
+            for the first group. Negative codes are ignored
+
+        Returns
+            None
+        '''
+
+        values = np.asarray(values, dtype=float)
+        groups = np.zeros(len(values), dtype=np.intp) if groups is None \
+            else np.asarray(groups, dtype=np.intp)
+
+        valid = ~np.isnan(values) & (groups >= 0)
+        values, groups = values[valid], groups[valid]
+
+        # One bincount over group and bucket pairs for all the groups
+        width = self.counts.shape[1]
+        self.counts += np.bincount(groups * width + self._buckets(values),
+                                   minlength=self.counts.size)\
+            .reshape(self.counts.shape)
+        self.sums += np.bincount(groups, weights=values,
+                                 minlength=self.n_groups)
+
+    def merge(self, other) -> 'quantileSketch':
+        '''
+        Adds the counts of another sketch with the same groups and accuracy
+
+        Args
+            other: quantileSketch
+
+        Returns
+            This quantileSketch
+        '''
+
+        if other.counts.shape != self.counts.shape or \
+                other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('Only sketches with the same groups and '
+                             'accuracy can be merged')
+
+        self.counts += other.counts
+        self.sums += other.sums
+
+        return self
+
+    def quantile(self, quantiles) -> np.ndarray:
+        '''
+        Estimates quantiles of every group
+
+        Args
+            quantiles: float or list of floats between 0 and 1
+
+        Returns
+            Numpy array of shape (groups, quantiles), NaN for empty groups
+        '''
+
+        quantiles = np.atleast_1d(np.asarray(quantiles, dtype=float))
+        counts = self.count
+        cumulative = np.cumsum(self.counts, axis=1)
+
+        # Representative value of each bucket, within the relative error
+        buckets = np.arange(self.counts.shape[1]) + self._offset
+        values = 2 * self._gamma ** buckets / (self._gamma + 1)
+        values[0] = 0
+
+        estimates = np.full((self.n_groups, len(quantiles)), np.nan)
+        for i, q in enumerate(quantiles):
+            rank = q * (counts - 1)
+            bucket = (cumulative > rank[:, None]).argmax(axis=1)
+            estimates[:, i] = np.where(counts > 0, values[bucket], np.nan)
+
+        return estimates
+
+    def mean(self) -> np.ndarray:
+        '''Returns the exact mean of every group, NaN for empty groups'''
+
+        counts = self.count
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(counts > 0, self.sums / counts, np.nan)
+
+
+def latency_sketches(wide_df, by=None, relative_accuracy=0.01) -> tuple:
+    '''
+    Sketches the step-to-step latencies of every group
+
+    Args
+        wide_df: pandas dataframe with the step timestamp columns
+
+        by: column to group by, default = None. For example
+        'first_event_date' or 'kmeans_cluster'
+
+        relative_accuracy: float, default = 0.01. Relative error of the
+        quantile estimates
+
+    Returns
+        Tuple of a dictionary of transition to quantileSketch and the
+        index of the groups
+    '''
+
+    codes, groups = group_codes(wide_df, by)
+    latencies = step_latencies(wide_df)
+
+    sketches = {}
+    for label in TRANSITION_LABELS:
+        sketch = quantileSketch(n_groups=len(groups),
+                                relative_accuracy=relative_accuracy)
+        sketch.update(latencies[label].to_numpy(), codes)
+        sketches[label] = sketch
+
+    return sketches, groups
+
+
+def quantiles_from_sketches(sketches, groups,
+                            quantiles=(0.5, 0.9, 0.99)) -> pd.DataFrame:
+    '''
+    Summarizes latency sketches into a table
+
+    Args
+        sketches: dictionary of transition to quantileSketch
+
+        groups: index of the groups of the sketches
+
+        quantiles: list of floats, default = (0.5, 0.9, 0.99)
+
+    Returns
+        Pandas dataframe indexed by group and transition with the count,
+        the mean and one column per quantile, in seconds
+    '''
+
+    frames = []
+    for label, sketch in sketches.items():
+        frame = pd.DataFrame(sketch.quantile(quantiles),
+                             columns=[f'p{q * 100:g}' for q in quantiles])
+        frame.insert(0, 'count', sketch.count)
+        frame.insert(1, 'mean', sketch.mean())
+        frame[groups.name or 'group'] = groups
+        frame['transition'] = pd.Categorical([label] * len(groups),
+                                             dtype=TRANSITION_DTYPE)
+        frames.append(frame)
+
+    return pd.concat(frames, ignore_index=True)\
+        .set_index([groups.name or 'group', 'transition'])\
+        .sort_index()
+
+
+def latency_quantiles(wide_df, by=None, quantiles=(0.5, 0.9, 0.99),
+                      relative_accuracy=0.01) -> pd.DataFrame:
+    '''
+    Estimates quantiles of the time between consecutive funnel steps
+
+    Args
+        wide_df: pandas dataframe with the step timestamp columns
+
+        by: column to group by, default = None for a single overall group
+
+        quantiles: list of floats, default = (0.5, 0.9, 0.99)
+
+        relative_accuracy: float, default = 0.01
+
+    Returns
+        Pandas dataframe indexed by group and transition with the count,
+        the mean and one column per quantile, in seconds
+    '''
+
+    sketches, groups = latency_sketches(wide_df, by, relative_accuracy)
+
+    return quantiles_from_sketches(sketches, groups, quantiles)
+
+
+# Helper turning bin edges into seconds and labels
+def _latency_bins(bins) -> tuple:
+    bins = LATENCY_BINS if bins is None else list(bins)
+
+    edges = np.array([pd.Timedelta(edge).total_seconds()
+                      if isinstance(edge, (str, pd.Timedelta))
+                      else float(edge) for edge in bins])
+    if np.any(np.diff(edges) <= 0):
+        raise ValueError('bins must be increasing')
+
+    names = [str(edge) for edge in bins]
+    labels = [f'{start}-{end}' for start, end in zip(names[:-1], names[1:])]
+    labels.append(f'{names[-1]}+')
+
+    return edges, labels
+
+
+def latency_histogram(wide_df, by=None, bins=None) -> pd.DataFrame:
+    '''
+    Counts the rows in each latency bin of every transition
+
+    Args
+        wide_df: pandas dataframe with the step timestamp columns
+
+        by: column to group by, default = None for a single overall group
+
+        bins: list of increasing bin edges, default = None for
+        LATENCY_BINS. Numbers are seconds, strings are parsed as
+        timedeltas like '15min'. The last bin is open ended
+
+    Returns
+        Pandas dataframe indexed by group and transition with one column
+        of counts per bin
+    '''
+
+    codes, groups = group_codes(wide_df, by)
+    edges, labels = _latency_bins(bins)
+    latencies = step_latencies(wide_df)
+
+    frames = []
+    for label in TRANSITION_LABELS:
+        seconds = latencies[label].to_numpy()
+        valid = ~np.isnan(seconds) & (seconds >= edges[0]) & (codes >= 0)
+
+        bin_codes = np.searchsorted(edges, seconds[valid], side='right') - 1
+        counts = np.bincount(codes[valid] * len(labels) + bin_codes,
+                             minlength=len(groups) * len(labels))\
+            .reshape(len(groups), len(labels))
+
+        frame = pd.DataFrame(counts, columns=labels)
+        frame[groups.name or 'group'] = groups
+        frame['transition'] = pd.Categorical([label] * len(groups),
+                                             dtype=TRANSITION_DTYPE)
+        frames.append(frame)
+
+    return pd.concat(frames, ignore_index=True)\
+        .set_index([groups.name or 'group', 'transition'])\
+        .sort_index()
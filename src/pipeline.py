@@ -0,0 +1,367 @@
+import functools
+import inspect
+import logging
+import weakref
+
+# Setting up a logger
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+# Decorator declaring a processor or segmentation method as a pipeline stage
+def stage(inputs=(), outputs=(), optional=(), modifies=(), rerun=(),
+          volatile=None, attributes=()):
+    '''
+    Declares a method as a stage of the pipeline. Calling the method runs
+    any missing or out of date upstream stages first, then skips the
+    method itself if it already ran with the same arguments on the same
+    versions of its inputs.
+
+    Args
+        inputs: list of artifact names the stage reads, or a function of
+        the method's arguments returning that list
+
+        outputs: list of artifact names the stage writes. An artifact is
+        an attribute of the object owning the stage, like event_df, or a
+        name for a change made in place, like segments
+
+        optional: list of artifact names the stage reads when they exist.
+        Their upstream stages are never run just for this stage, but a
+        new version still makes the stage out of date
+
+        modifies: list of artifact names produced by other stages that
+        this stage changes in place, like a column added to event_df.
+        Their versions are bumped so the stages reading them rerun,
+        apart from the stages upstream of this one
+
+        rerun: list of boolean parameter names, like refresh_, that make
+        the stage run even when it is up to date. They are recorded as
+        False, so downstream stages don't rerun it again
+
+        volatile: function of the method's arguments returning whether
+        the stage reads a source outside the pipeline that changes
+        between calls, like new daily shards. Direct calls then always
+        run the stage, stages reading its outputs reuse its last run
+
+        attributes: list of settings of the object owning the stage that
+        the stage reads, like n_centers_. Their values are recorded with
+        the arguments, so changing one makes the stage out of date
+
+    Returns
+        Decorator for the stage method
+    '''
+
+    def decorator(method):
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            return self.pipeline.call(self, method, args, kwargs)
+
+        wrapper.stage_spec = {'inputs': inputs,
+                              'outputs': list(outputs),
+                              'optional': list(optional),
+                              'modifies': list(modifies),
+                              'rerun': list(rerun),
+                              'volatile': volatile,
+                              'attributes': list(attributes)}
+
+        return wrapper
+
+    return decorator
+
+
+class pipelineDAG:
+    '''
+    Dependency graph of the processor and segmentation stages. Every
+    artifact carries a version that is bumped when its stage runs, or
+    when the attribute holding it is reassigned outside the pipeline, and
+    each stage remembers the arguments and input versions of its last
+    run, so a stage only reruns when something upstream changed.
+    '''
+
+    def __init__(self) -> None:
+        # Stage name to the object owning the stage method
+        self.stages = {}
+
+        # Artifact name to the stage producing it and the owning object
+        self.producers = {}
+        self.owners = {}
+
+        # Artifact name to version, bumped every time it is written
+        self.versions = {}
+
+        # Stage name to the arguments, settings and input versions of its
+        # last run
+        self.records = {}
+
+        # Artifact name to the object it held when its version was last
+        # set, to notice attributes reassigned outside the pipeline
+        self._identities = {}
+
+        # Stage name to the stages upstream of it in its last call
+        self._upstream = {}
+
+        # Stages on the current call stack, and stages already brought up
+        # to date during the current top-level call
+        self._running = []
+        self._checked = set()
+
+    def register(self, owner) -> None:
+        '''
+        Adds the stages declared on an object's class to the graph
+
+        Args
+            owner: ecommerceProcessor or customerSegmentation instance
+
+        Returns
+            None
+        '''
+
+        for name, member in inspect.getmembers(type(owner)):
+            spec = getattr(member, 'stage_spec', None)
+            if spec is None:
+                continue
+
+            self.stages[name] = owner
+            for artifact in spec['outputs']:
+                self.producers[artifact] = name
+                self.owners[artifact] = owner
+                self.versions.setdefault(artifact, 0)
+            for artifact in spec['modifies']:
+                self.versions.setdefault(artifact, 0)
+
+    def has_run(self, stage_name) -> bool:
+        '''Checks whether a stage has run since it was last invalidated'''
+
+        return stage_name in self.records
+
+    def invalidate(self, stage_name) -> None:
+        '''
+        Forgets the last run of a stage so its next call runs it again,
+        which in turn makes every downstream stage out of date
+
+        Args
+            stage_name: name of the stage method
+
+        Returns
+            None
+        '''
+
+        self.records.pop(stage_name, None)
+
+    def available(self, artifact) -> bool:
+        '''Checks whether an artifact holds a value'''
+
+        owner = self.owners.get(artifact)
+
+        if owner is not None and hasattr(owner, artifact):
+            return getattr(owner, artifact) is not None
+
+        return self.versions.get(artifact, 0) > 0
+
+    def owner_objects(self) -> list:
+        '''Lists the distinct objects owning stages, in registration order'''
+
+        owners = {}
+        for owner in self.stages.values():
+            owners.setdefault(id(owner), owner)
+
+        return list(owners.values())
+
+    def state(self) -> dict:
+        '''Returns the artifact versions and stage records, for snapshots'''
+
+        return {'versions': dict(self.versions),
+                'records': dict(self.records)}
+
+    def load_state(self, state) -> None:
+        '''
+        Restores artifact versions and stage records from a snapshot, so
+        stages whose outputs were restored are not run again
+
+        Args
+            state: dictionary from the state method
+
+        Returns
+            None
+        '''
+
+        self.versions.update(state['versions'])
+        self.records.update(state['records'])
+
+        # The restored values are the ones the records were taken on
+        self._identities = {}
+
+    # Helper remembering the object an artifact attribute holds
+    def _remember(self, artifact) -> None:
+        owner = self.owners.get(artifact)
+        if owner is None or not hasattr(owner, artifact):
+            return
+
+        value = getattr(owner, artifact)
+        try:
+            ref = weakref.ref(value)
+        except TypeError:
+            ref = None
+
+        # A weak reference can't match a new object that reuses the id
+        self._identities[artifact] = (ref, id(value))
+
+    def version(self, artifact) -> int:
+        '''
+        Returns the version of an artifact, bumping it first if the
+        attribute holding it was reassigned since the version was set
+
+        Args
+            artifact: artifact name
+
+        Returns
+            Int version
+        '''
+
+        owner = self.owners.get(artifact)
+        seen = self._identities.get(artifact)
+
+        if owner is not None and hasattr(owner, artifact):
+            if seen is None:
+                self._remember(artifact)
+            else:
+                value = getattr(owner, artifact)
+                ref, value_id = seen
+                same = ref() is value if ref is not None \
+                    else id(value) == value_id
+
+                if not same:
+                    logger.info("%s was reassigned, stages reading it "
+                                "are out of date", artifact)
+                    self.versions[artifact] = \
+                        self.versions.get(artifact, 0) + 1
+                    self._remember(artifact)
+
+        return self.versions.get(artifact, 0)
+
+    def _spec(self, owner, method_name) -> dict:
+        return getattr(type(owner), method_name).stage_spec
+
+    def _resolve(self, artifact, required=True) -> None:
+        '''Brings the stage producing an artifact up to date'''
+
+        stage_name = self.producers.get(artifact)
+
+        if stage_name is None:
+            if required and not self.available(artifact):
+                raise ValueError(f'{artifact} is not available, the stage '
+                                 'producing it has not been set up')
+            return
+
+        record = self.records.get(stage_name)
+
+        if record is None:
+            # Values set directly on the object are used as they are
+            if not required or self.available(artifact):
+                return
+
+            logger.info("Running %s to create %s", stage_name, artifact)
+            getattr(self.stages[stage_name], stage_name)()
+        else:
+            # Rerunning with the last arguments, skipped if still fresh
+            getattr(self.stages[stage_name], stage_name)(**record['params'])
+
+    def call(self, owner, method, args, kwargs):
+        '''
+        Runs a stage method through the graph
+
+        Args
+            owner: object the stage belongs to
+
+            method: undecorated stage method
+
+            args, kwargs: arguments of the call
+
+        Returns
+            Result of the method, or None when the stage is skipped
+        '''
+
+        name = method.__name__
+        spec = self._spec(owner, name)
+
+        bound = inspect.signature(method).bind(owner, *args, **kwargs)
+        bound.apply_defaults()
+        params = {key: value for key, value in bound.arguments.items()
+                  if key != 'self'}
+
+        # Flags forcing a run are not part of the recorded arguments
+        forced = any(params.get(key) for key in spec['rerun'])
+        if spec['volatile'] is not None and not self._running:
+            forced = forced or bool(spec['volatile'](**params))
+        record_params = dict(params, **{key: False for key in spec['rerun']
+                                        if key in params})
+        settings = {key: getattr(owner, key, None)
+                    for key in spec['attributes']}
+
+        inputs = spec['inputs']
+        if callable(inputs):
+            inputs = inputs(**params)
+        inputs = list(inputs)
+
+        if name in self._running:
+            raise RuntimeError(f'Cycle in the pipeline at {name}')
+
+        # Upstream stages shared by several inputs are only checked once
+        if not self._running:
+            self._checked = set()
+        elif name in self._checked:
+            return None
+
+        self._running.append(name)
+        try:
+            for artifact in inputs:
+                self._resolve(artifact)
+            for artifact in spec['optional']:
+                self._resolve(artifact, required=False)
+
+            input_versions = {artifact: self.version(artifact)
+                              for artifact in inputs + spec['optional']}
+
+            upstream = set()
+            for artifact in input_versions:
+                producer = self.producers.get(artifact)
+                if producer is not None and producer != name:
+                    upstream |= {producer} | self._upstream.get(producer,
+                                                                set())
+            self._upstream[name] = upstream
+
+            record = self.records.get(name)
+            if record is not None and not forced and \
+                    record['params'] == record_params and \
+                    record.get('attributes', {}) == settings and \
+                    record['inputs'] == input_versions and \
+                    all(self.available(out) for out in spec['outputs']):
+                log = logger.info if len(self._running) == 1 \
+                    else logger.debug
+                log("Skipping %s, already up to date", name)
+                self._checked.add(name)
+                return None
+
+            result = method(owner, *args, **kwargs)
+        finally:
+            self._running.pop()
+
+        self._checked.add(name)
+
+        self.records[name] = {'params': record_params,
+                              'attributes': settings,
+                              'inputs': input_versions}
+
+        for artifact in spec['outputs'] + spec['modifies']:
+            self.versions[artifact] = self.versions.get(artifact, 0) + 1
+            self._remember(artifact)
+
+            # Changes made in place derive from the upstream stages, so
+            # they don't make those stages, or this one, out of date
+            for upstream_name in upstream | {name}:
+                record = self.records.get(upstream_name)
+                if record is not None and artifact in record['inputs']:
+                    record['inputs'][artifact] = self.versions[artifact]
+
+        return result
@@ -0,0 +1,246 @@
+import numpy as np
+import pandas as pd
+from src.data_loader import FLAG_COLUMNS, STEP_TIMESTAMP_COLUMNS
+from src.funnel_engine import (EVENT_DTYPE,
+                               NOT_SET,
+                               CUBE_DIMENSIONS,
+                               funnelCube,
+                               rates_from_counts,
+                               step_conversion_from_counts)
+
+
+# Helper importing polars only when the engine is used
+def import_polars():
+    try:
+        import polars as pl
+    except ImportError as e:
+        raise ImportError('The polars engine requires polars, '
+                          'install it with `pip install polars`') from e
+
+    return pl
+
+
+# Helper starting a lazy query from a pandas or polars table
+def _lazy(df, cols=None):
+    pl = import_polars()
+
+    if isinstance(df, pl.LazyFrame):
+        lf = df
+    elif isinstance(df, pl.DataFrame):
+        lf = df.lazy()
+    else:
+        lf = pl.from_pandas(df if cols is None else df.loc[:, cols]).lazy()
+
+    if cols is not None:
+        lf = lf.select(cols)
+
+    # Ids and dimensions are joined and grouped as plain strings
+    schema = lf.collect_schema()
+    return lf.with_columns([pl.col(col).cast(pl.String)
+                            for col in schema.names()
+                            if schema[col] == pl.Categorical])
+
+
+# Helper parsing YYYYMMDD strings, dates are left as they are
+def _parse_dates(values) -> pd.Series:
+    return pd.to_datetime(pd.Series(values))
+
+
+def _step_counts(pl):
+    return [pl.len().cast(pl.Int64).alias('total')] + \
+        [pl.col(step).cast(pl.Int64).sum().alias(step)
+         for step in FLAG_COLUMNS]
+
+
+def funnel_counts(wide_df, by=None) -> pd.DataFrame:
+    '''
+    Polars version of funnel_engine.funnel_counts, as a lazy multi-threaded
+    group by over the flag columns.
+
+    Args
+        wide_df: pandas or polars dataframe with the funnel flag columns
+
+        by: column to group by, default = None for a single overall group
+
+    Returns
+        Pandas dataframe with a 'total' column and one column per step
+    '''
+
+    pl = import_polars()
+
+    if by is None:
+        counts = _lazy(wide_df, FLAG_COLUMNS)\
+            .select(_step_counts(pl))\
+            .collect()
+
+        return pd.DataFrame({col: counts[col].to_numpy()
+                             for col in counts.columns},
+                            index=pd.Index(['All']))
+
+    counts = _lazy(wide_df, [by] + FLAG_COLUMNS)\
+        .filter(pl.col(by).is_not_null())\
+        .group_by(by)\
+        .agg(_step_counts(pl))\
+        .sort(by)\
+        .collect()
+
+    # Only the distinct dates need parsing, like the pandas engine
+    groups = counts[by].to_pandas()
+    if by == 'first_event_date':
+        groups = _parse_dates(groups)
+
+    return pd.DataFrame({col: counts[col].to_numpy()
+                         for col in ['total'] + FLAG_COLUMNS},
+                        index=pd.Index(groups, name=by))
+
+
+def funnel_rates(wide_df, by=None, rename=True) -> pd.DataFrame:
+    '''Polars version of funnel_engine.funnel_rates'''
+
+    return rates_from_counts(funnel_counts(wide_df, by), rename=rename)
+
+
+def step_conversion(wide_df, by=None, rename=True) -> pd.DataFrame:
+    '''Polars version of funnel_engine.step_conversion'''
+
+    return step_conversion_from_counts(funnel_counts(wide_df, by),
+                                       rename=rename)
+
+
+def to_long(wide_df, rename=True) -> pd.DataFrame:
+    '''
+    Polars version of funnel_engine.to_long. The flag columns are stacked
+    by a lazy concatenation of one select per step, and the ids are coded
+    in order of first appearance so the result matches the pandas engine.
+
+    Args
+        wide_df: pandas dataframe with the funnel flag columns
+
+        rename: boolean, default = True. Uses the clean step names
+
+    Returns
+        Pandas dataframe with the id columns, event and occurence
+    '''
+
+    pl = import_polars()
+
+    n_steps = len(FLAG_COLUMNS)
+    id_cols = [col for col in wide_df.columns
+               if col not in FLAG_COLUMNS + STEP_TIMESTAMP_COLUMNS]
+
+    # Categorical columns already hold codes and keep their categories
+    coded = [col for col in id_cols
+             if isinstance(wide_df[col].dtype, pd.CategoricalDtype)]
+    factorized = [col for col in id_cols
+                  if col == 'user_pseudo_id' and col not in coded]
+
+    lf = _lazy(wide_df.loc[:, [col for col in id_cols if col not in coded] +
+                           FLAG_COLUMNS]).with_row_index('row')
+
+    schema = lf.collect_schema()
+
+    ids = []
+    for col in id_cols:
+        if col in coded:
+            continue
+
+        if col in factorized:
+            # Codes numbering each value by the row it first appears in
+            ids.append((pl.col('row').min().over(col)
+                        .rank('dense').cast(pl.Int64) - 1).alias(col))
+        elif col == 'first_event_date' and schema[col] == pl.String:
+            ids.append(pl.col(col).str.to_datetime('%Y%m%d', time_unit='us'))
+        else:
+            ids.append(pl.col(col))
+
+    long_lf = pl.concat([lf.select(ids + [pl.col(step).cast(pl.Int8)
+                                          .alias('occurence')])
+                         for step in FLAG_COLUMNS])
+
+    uniques = {col: lf.select(pl.col(col).unique(maintain_order=True))
+               for col in factorized}
+    long_pl, *unique_pl = pl.collect_all([long_lf] + list(uniques.values()))
+
+    long_cols = {}
+    for col in id_cols:
+        if col in coded:
+            long_cols[col] = pd.Categorical.from_codes(
+                np.tile(wide_df[col].cat.codes.to_numpy(), n_steps),
+                dtype=wide_df[col].dtype)
+        elif col in factorized:
+            categories = unique_pl[factorized.index(col)][col].to_pandas()
+            long_cols[col] = pd.Categorical.from_codes(
+                long_pl[col].to_numpy(), categories=categories.rename(None))
+        else:
+            long_cols[col] = long_pl[col].to_pandas().to_numpy()
+
+    if rename:
+        event_dtype = EVENT_DTYPE
+    else:
+        event_dtype = pd.CategoricalDtype(FLAG_COLUMNS, ordered=True)
+
+    long_cols['event'] = pd.Categorical.from_codes(
+        np.repeat(np.arange(n_steps), wide_df.shape[0]),
+        dtype=event_dtype)
+    long_cols['occurence'] = long_pl['occurence'].to_numpy()
+
+    return pd.DataFrame(long_cols)
+
+
+def build_funnel_cube(event_df, device_df=None, geo_df=None) -> funnelCube:
+    '''
+    Polars version of funnel_engine.build_funnel_cube. The first session
+    value of each user is found with a sort and a distinct, and joined to
+    the users as a hash join.
+
+    Args
+        event_df: pandas dataframe with one row per user
+
+        device_df: pandas dataframe of devices by session, default = None
+
+        geo_df: pandas dataframe of locations by session, default = None
+
+    Returns
+        funnelCube
+    '''
+
+    pl = import_polars()
+
+    dims = [dim for dim in CUBE_DIMENSIONS if dim in event_df.columns]
+    lf = _lazy(event_df, ['user_pseudo_id'] + dims + FLAG_COLUMNS)
+
+    for col, session_df in [('category', device_df), ('country', geo_df)]:
+        if session_df is None:
+            continue
+
+        first = _lazy(session_df, ['user_pseudo_id', 'session', col])\
+            .sort(['user_pseudo_id', 'session'], maintain_order=True)\
+            .unique('user_pseudo_id', keep='first', maintain_order=True)\
+            .select(['user_pseudo_id', col])
+
+        lf = lf.join(first, on='user_pseudo_id', how='left')\
+            .with_columns(pl.col(col).fill_null(NOT_SET))
+        dims.append(col)
+
+    counts = lf.group_by(dims)\
+        .agg(_step_counts(pl))\
+        .sort(dims, nulls_last=True)\
+        .collect()
+
+    levels = []
+    for dim in dims:
+        values = counts[dim].to_pandas()
+
+        if dim == 'first_event_date':
+            values = _parse_dates(values)
+        elif dim in ('category', 'country'):
+            values = pd.Categorical(values)
+
+        levels.append(values)
+
+    index = pd.MultiIndex.from_arrays(levels, names=dims) \
+        if len(dims) > 1 else pd.Index(levels[0], name=dims[0])
+
+    return funnelCube(pd.DataFrame({col: counts[col].to_numpy()
+                                    for col in ['total'] + FLAG_COLUMNS},
+                                   index=index))
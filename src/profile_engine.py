@@ -0,0 +1,155 @@
+import numpy as np
+import pandas as pd
+
+# Per-session attributes resolved to one value per user, by source table
+GEO_COLUMNS = ['continent', 'country', 'region', 'city']
+DEVICE_COLUMNS = ['category', 'mobile_brand_name', 'operating_system']
+
+
+def attribute_counts(session_df, cols) -> pd.DataFrame:
+    '''
+    Counts the sessions of each user with each combination of attribute
+    values, in one hash group by. Partial counts of separate batches are
+    combined with merge_attribute_counts.
+
+    Args
+        session_df: pandas dataframe with user_pseudo_id, session and the
+        attribute columns, such as ecommerceProcessor.geo_df
+
+        cols: list of attribute columns, resolved together so a user's
+        city always belongs to their country
+
+    Returns
+        Pandas dataframe with user_pseudo_id, the attribute columns, the
+        number of sessions and the first session of each combination
+    '''
+
+    return session_df\
+        .groupby(['user_pseudo_id'] + cols,
+                 observed=True, dropna=False, sort=False)['session']\
+        .agg(sessions='size', first_session='min')\
+        .reset_index()
+
+
+def merge_attribute_counts(partials, cols) -> pd.DataFrame:
+    '''
+    Combines attribute counts of separate batches of sessions
+
+    Args
+        partials: list of pandas dataframes from attribute_counts
+
+        cols: list of attribute columns
+
+    Returns
+        Pandas dataframe like attribute_counts
+    '''
+
+    return pd.concat(partials, ignore_index=True)\
+        .groupby(['user_pseudo_id'] + cols,
+                 observed=True, dropna=False, sort=False)\
+        .agg(sessions=('sessions', 'sum'),
+             first_session=('first_session', 'min'))\
+        .reset_index()
+
+
+# Helper keeping the rows holding the best value of each user
+def _keep_best(keep, user_codes, values, n_users, largest) -> np.ndarray:
+    best = np.full(n_users, -np.inf if largest else np.inf)
+    ufunc = np.maximum if largest else np.minimum
+    ufunc.at(best, user_codes[keep], values[keep])
+
+    return keep & (values == best[user_codes])
+
+
+def pick_attributes(counts, cols, rule='mode', prefix=None) -> pd.DataFrame:
+    '''
+    Resolves each user to a single combination of attribute values. Ties
+    are broken by the earliest session, then by first appearance, with a
+    few linear passes over the counts and no sorting.
+
+    Args
+        counts: pandas dataframe from attribute_counts
+
+        cols: list of attribute columns
+
+        rule: string, default = 'mode'. 'mode' picks the values seen in
+        the most sessions, 'first' the values of the first session
+
+        prefix: string, default = None. Names the count columns, like
+        'geo' for geo_sessions and geo_values
+
+    Returns
+        Pandas dataframe indexed by user_pseudo_id with the attribute
+        columns, the number of sessions with the picked values and the
+        number of distinct combinations seen
+    '''
+
+    if rule not in ('mode', 'first'):
+        raise ValueError("rule must be 'mode' or 'first'")
+
+    user_codes, users = pd.factorize(counts['user_pseudo_id'])
+    n_users = len(users)
+
+    sessions = counts['sessions'].to_numpy(dtype=float)
+    first_session = np.nan_to_num(
+        counts['first_session'].to_numpy(dtype=float), nan=np.inf)
+    order = np.arange(counts.shape[0], dtype=float)
+
+    keep = np.ones(counts.shape[0], dtype=bool)
+    if rule == 'mode':
+        keep = _keep_best(keep, user_codes, sessions, n_users, True)
+    keep = _keep_best(keep, user_codes, first_session, n_users, False)
+    keep = _keep_best(keep, user_codes, order, n_users, False)
+
+    prefix = f'{prefix}_' if prefix else ''
+    picked = counts.loc[keep, ['user_pseudo_id'] + cols]\
+        .set_index('user_pseudo_id')
+    picked[f'{prefix}sessions'] = counts.loc[keep, 'sessions'].to_numpy()
+    picked[f'{prefix}values'] = np.bincount(user_codes,
+                                            minlength=n_users)[
+        user_codes[keep]]
+
+    return picked
+
+
+def build_customer_profiles(event_df, geo_df=None, device_df=None,
+                            rule='mode') -> pd.DataFrame:
+    '''
+    Builds one row per user with their first event date and a single geo
+    and device profile. Each side table is reduced to one row per user
+    before it is joined on the user index, so users seen in several
+    cities or on several devices are never duplicated.
+
+    Args
+        event_df: pandas dataframe with one row per user and
+        first_event_date
+
+        geo_df: pandas dataframe of locations by session, or geo counts
+        from attribute_counts, default = None
+
+        device_df: pandas dataframe of devices by session, or device
+        counts from attribute_counts, default = None
+
+        rule: string, default = 'mode'. See pick_attributes
+
+    Returns
+        Pandas dataframe with one row per user of event_df
+    '''
+
+    customer_df = event_df.loc[:, ['user_pseudo_id', 'first_event_date']]\
+        .drop_duplicates('user_pseudo_id')\
+        .reset_index(drop=True)
+
+    for prefix, cols, session_df in [('geo', GEO_COLUMNS, geo_df),
+                                     ('device', DEVICE_COLUMNS, device_df)]:
+        if session_df is None:
+            continue
+
+        counts = session_df if 'sessions' in session_df.columns \
+            else attribute_counts(session_df, cols)
+        picked = pick_attributes(counts, cols, rule=rule, prefix=prefix)
+
+        # Index aligned join, picked holds at most one row per user
+        customer_df = customer_df.join(picked, on='user_pseudo_id')
+
+    return customer_df
@@ -0,0 +1,177 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+import pandas as pd
+
+# Setting up a logger
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class queryCache:
+    '''
+    On-disk cache of query results stored as Parquet files. Results are
+    keyed by the normalized SQL text and the table suffix range they
+    cover, expire after a TTL and are evicted least recently used first
+    once the cache grows past its size limit.
+    '''
+
+    def __init__(self, cache_dir='.query_cache',
+                 ttl_seconds=24 * 60 * 60,
+                 max_bytes=2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # Helper to make the key insensitive to formatting of the SQL
+    @staticmethod
+    def normalize_sql(sql) -> str:
+        '''
+        Strips comments and collapses whitespace in a SQL statement
+
+        Args
+            sql: string SQL statement
+
+        Returns
+            Normalized SQL string
+        '''
+
+        sql = re.sub(r'--[^\n]*', ' ', sql)
+        sql = re.sub(r'\s+', ' ', sql).strip()
+
+        return sql.rstrip(';').strip()
+
+    def key(self, sql, suffix_range=None, variant=None) -> str:
+        '''
+        Builds the content-addressed key of a query
+
+        Args
+            sql: string SQL statement
+
+            suffix_range: tuple of the first and last table suffixes read
+            by the query, default = None for queries over all shards
+
+            variant: string, default = None. Distinguishes different
+            conversions of the same query results, like typed frames
+
+        Returns
+            Hex digest used as the cache file name
+        '''
+
+        suffixes = '*' if suffix_range is None else '-'.join(suffix_range)
+        content = f'{suffixes}\n{variant}\n{self.normalize_sql(sql)}'
+
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def _path(self, key) -> str:
+        return os.path.join(self.cache_dir, f'{key}.parquet')
+
+    def get(self, key):
+        '''
+        Loads a cached result if it exists and has not expired
+
+        Args
+            key: cache key from the key method
+
+        Returns
+            Pandas dataframe, or None on a cache miss
+        '''
+
+        path = self._path(key)
+
+        try:
+            written = os.path.getmtime(path)
+        except FileNotFoundError:
+            return None
+
+        if time.time() - written > self.ttl_seconds:
+            logger.info("Cached result %s expired", key[:12])
+            self._remove(path)
+            return None
+
+        result = pd.read_parquet(path)
+
+        # Access time tracks recency for eviction, mtime stays the write time
+        os.utime(path, (time.time(), written))
+
+        return result
+
+    def put(self, key, df) -> None:
+        '''
+        Stores a result and evicts old entries if the cache is too large
+
+        Args
+            key: cache key from the key method
+
+            df: pandas dataframe to store
+
+        Returns
+            None
+        '''
+
+        path = self._path(key)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+
+        # Writing to a temporary file so readers never see partial results
+        df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+
+        self.evict()
+
+    def evict(self) -> None:
+        '''
+        Removes expired entries, then least recently used entries until
+        the cache fits within max_bytes.
+
+        Args
+            None
+
+        Returns
+            None
+        '''
+
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith('.parquet'):
+                    continue
+
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+
+                if time.time() - stat.st_mtime > self.ttl_seconds:
+                    self._remove(path)
+                else:
+                    entries.append((stat.st_atime, stat.st_size, path))
+
+            total_bytes = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total_bytes <= self.max_bytes:
+                    break
+
+                self._remove(path)
+                total_bytes -= size
+                logger.info("Evicted cached result %s", path)
+
+    def clear(self) -> None:
+        '''Removes every cached result'''
+
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.parquet'):
+                self._remove(os.path.join(self.cache_dir, name))
+
+    @staticmethod
+    def _remove(path) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
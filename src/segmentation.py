@@ -1,7 +1,23 @@
 import logging
 import pandas as pd
 from src.data_processor import ecommerceProcessor
-from functools import reduce
+from src.data_loader import ecommerce_loader_stream
+from src.cluster_engine import (feature_chunks_match,
+                                fit_minibatch_kmeans,
+                                iter_row_chunks,
+                                predict_chunks,
+                                read_feature_chunks,
+                                select_k,
+                                write_feature_chunks)
+from src.cohort_engine import assign_cohorts
+from src.feature_engine import featureEncoder
+from src.pipeline import stage
+from src.profile_engine import (DEVICE_COLUMNS,
+                                GEO_COLUMNS,
+                                attribute_counts,
+                                build_customer_profiles,
+                                merge_attribute_counts)
+from src.snapshot import snapshotStore
 from sklearn.cluster import KMeans
 
 # Setting up a logger
@@ -12,68 +28,210 @@ logger = logging.getLogger(__name__)
 class customerSegmentation:
     '''Class for segmenting ecommerce customers'''
 
+    # Name, dataframes and fitted objects of the segmentation in snapshots
+    snapshot_name = 'segmentation'
+    snapshot_frames = ['customer_df', 'heatmap_df', 'fit_report']
+    snapshot_objects = ['encoder', 'cluster_features', 'k_means']
+
     def __init__(self, processor, n_centers_=10):
         self.processor = processor
         self.customer_df = None
-        self.cluster_df = None
-        self._kmeans_created_ = False
+        self.encoder = None
+        self.cluster_features = None
         self.n_centers_ = n_centers_
         self.k_means = None
+        self.fit_report = None
+        self.k_selection = None
+        self.k_models = {}
         self.heatmap_df = None
 
-    def prep_segment_data(self) -> None:
+        # Version of the features the k_models were fitted on
+        self._k_models_version = None
+
+        # Adding the segmentation stages to the processor's pipeline
+        self.pipeline = processor.pipeline
+        self.pipeline.register(self)
+
+    @stage(inputs=lambda batch_size_, **kwargs: [] if batch_size_ is not None
+           else ['event_df', 'geo_df', 'device_df'],
+           outputs=['customer_df'])
+    def prep_segment_data(self, batch_size_=None,
+                          attribute_rule_='mode') -> None:
         '''
-        Creates dataframe to work from to segment customers
+        Creates dataframe to work from to segment customers, with one row
+        per user
 
         Args
+            batch_size_: int, default = None. Streams the prod queries
+            in batches of this many rows and keeps only session counts
+            per user attribute, instead of using the processor dataframes
+
+            attribute_rule_: string, default = 'mode'. Picks each user's
+            geo and device from the most frequent values across their
+            sessions, or 'first' for those of their first session
+
+        Returns
             None
+        '''
+
+        if batch_size_ is not None:
+            event_for_join = self._fold_distinct('event_query',
+                                                 ['user_pseudo_id',
+                                                  'first_event_date'],
+                                                 batch_size_)
+            geo_for_join = self._fold_attribute_counts('geo_query',
+                                                       GEO_COLUMNS,
+                                                       batch_size_)
+            device_for_join = self._fold_attribute_counts('device_query',
+                                                          DEVICE_COLUMNS,
+                                                          batch_size_)
+        else:
+            event_for_join = self.processor.event_df
+            geo_for_join = self.processor.geo_df
+            device_for_join = self.processor.device_df
+
+        # One row per user, geo and device resolved to a single profile
+        self.customer_df = build_customer_profiles(event_for_join,
+                                                   geo_df=geo_for_join,
+                                                   device_df=device_for_join,
+                                                   rule=attribute_rule_)
+
+        logger.info("Successfully prepped customer dataframe")
+
+    # Helpers for the frames and objects stored in snapshots
+    def _snapshot_state(self) -> tuple:
+        return ({attr: getattr(self, attr) for attr in self.snapshot_frames},
+                {attr: getattr(self, attr) for attr in self.snapshot_objects})
+
+    def _restore_state(self, frames, objects) -> None:
+        for attr in self.snapshot_frames:
+            setattr(self, attr, frames.get(attr))
+        for attr in self.snapshot_objects:
+            setattr(self, attr, objects.get(attr))
+
+    def save_snapshot(self, snapshot_dir='.snapshots') -> str:
+        '''
+        Saves the segmentation along with its processor, see
+        ecommerceProcessor.save_snapshot
+
+        Args
+            snapshot_dir: directory of the snapshot versions,
+            default = '.snapshots'
+
+        Returns
+            Name of the saved version
+        '''
+
+        return self.processor.save_snapshot(snapshot_dir)
+
+    def restore_snapshot(self, snapshot_dir='.snapshots',
+                         version=None) -> None:
+        '''
+        Restores the segmentation dataframes and KMeans model of a
+        snapshot, after the processor was restored from it
+
+        Args
+            snapshot_dir: directory of the snapshot versions,
+            default = '.snapshots'
+
+            version: string, default = None for the latest version
 
         Returns
             None
         '''
 
-        # Ensuring the processsor has data
-        if self.processor.event_df is None:
-            self.processor.run_queries()
-            logger.info("No processor initialized, running setup")
+        names = [f'{self.snapshot_name}.{attr}'
+                 for attr in self.snapshot_frames + self.snapshot_objects]
+        frames, objects = snapshotStore(snapshot_dir).load(version, names)
 
-        # Prepping event table for join
-        event_for_join = self.processor.event_df\
-            .copy().loc[:, ['user_pseudo_id',
-                            'first_event_date']]
+        prefix = f'{self.snapshot_name}.'
+        self._restore_state(
+            {name[len(prefix):]: df for name, df in frames.items()},
+            {name[len(prefix):]: obj for name, obj in objects.items()})
 
-        # Prepping geo table for join
-        geo_for_join = self.processor.geo_df\
-            .copy().loc[:, ['user_pseudo_id',
-                            'continent',
-                            'country',
-                            'region',
-                            'city']].drop_duplicates()
+        logger.info("Restored segmentation from snapshot")
 
-        # Prepping device table for join
-        device_for_join = self.processor.device_df\
-            .copy().loc[:, ['user_pseudo_id',
-                            'category',
-                            'mobile_brand_name',
-                            'operating_system']].drop_duplicates()
+    # Helper to fold streamed query batches into attribute counts
+    def _fold_attribute_counts(self, query_name, cols,
+                               batch_size) -> pd.DataFrame:
+        '''
+        Streams a prod query and counts the sessions of each user with
+        each combination of attribute values
 
-        dfs_to_join = [event_for_join, geo_for_join, device_for_join]
+        Args
+            query_name: name of the loader query to stream
 
-        self.customer_df = reduce(lambda left, right:
-                                  left.merge(right,
-                                             on='user_pseudo_id',
-                                             how='left'),
-                                  dfs_to_join)
+            cols: list of attribute columns
 
-        logger.info("Successfully prepped customer dataframe")
+            batch_size: int, rows per streamed batch
+
+        Returns
+            Pandas dataframe from profile_engine.attribute_counts
+        '''
+
+        counts = None
+
+        for batch_df in ecommerce_loader_stream(
+                query_name,
+                backend=self.processor.backend,
+                batch_size=batch_size):
+            batch_counts = attribute_counts(batch_df, cols)
+
+            if counts is None:
+                counts = batch_counts
+            else:
+                counts = merge_attribute_counts([counts, batch_counts],
+                                                cols)
+
+        return counts
+
+    # Helper to fold streamed query batches into distinct rows
+    def _fold_distinct(self, query_name, cols, batch_size) -> pd.DataFrame:
+        '''
+        Streams a prod query and keeps the distinct rows of some columns
+
+        Args
+            query_name: name of the loader query to stream
+
+            cols: list of columns to keep
+
+            batch_size: int, rows per streamed batch
+
+        Returns
+            Pandas dataframe of the distinct rows, empty if the query
+            returned no rows
+        '''
+
+        distinct = None
+
+        for batch_df in ecommerce_loader_stream(
+                query_name,
+                backend=self.processor.backend,
+                batch_size=batch_size):
+            batch_distinct = batch_df.loc[:, cols].drop_duplicates()
+
+            if distinct is None:
+                distinct = batch_distinct
+            else:
+                distinct = pd.concat([distinct, batch_distinct],
+                                     ignore_index=True).drop_duplicates()
+
+        if distinct is None:
+            return pd.DataFrame(columns=cols)
+
+        return distinct.reset_index(drop=True)
 
     # Getting time-based cohorts
-    def get_time_cohorts(self) -> None:
+    @stage(inputs=['customer_df'], outputs=['cohorts'],
+           modifies=['customer_df'])
+    def get_time_cohorts(self, freq_='week') -> None:
         '''
         Preps data and does conversions needed for time cohorts.
 
         Args
-            None
+            freq_: string, default = 'week'. Adds a 'day', 'week' or
+            'month' column numbering each user's first event period from
+            1, for use in prep_clustering_data
 
         Returns
             None
@@ -82,75 +240,214 @@ class customerSegmentation:
         self.customer_df['first_event_date'] = pd.to_datetime(
             self.customer_df['first_event_date'])
 
-        min_date = self.customer_df['first_event_date'].min()
-
-        self.customer_df['week'] = self.customer_df['first_event_date']\
-            .apply(lambda x: ((x - min_date).days // 7) + 1)
+        # Datetime arithmetic on the whole column instead of a row apply
+        self.customer_df[freq_] = assign_cohorts(
+            self.customer_df['first_event_date'], freq=freq_) + 1
 
     # Prepating data for clustering
+    @stage(inputs=['customer_df', 'cohorts'], outputs=['cluster_features'])
     def prep_clustering_data(self, cols=['user_pseudo_id',
                                          'continent',
                                          'country',
                                          'category',
-                                         'week']) -> None:
+                                         'week'],
+                             min_frac_=0.05,
+                             hashed_cols_=None,
+                             n_hash_features_=256) -> None:
 
         '''
-        Method for preparing data for clustering to id segments
+        Method for preparing data for clustering to id segments. Builds a
+        sparse float32 feature matrix instead of dense dummies, so high
+        cardinality columns like city or mobile_brand_name can be added.
 
         Args
             cols: list of strings of columns to use in k-means
-            clustering to identify customer segments
+            clustering to identify customer segments, starting with
+            user_pseudo_id
+
+            min_frac_: float, default = 0.05. Categories found in a
+            smaller share of users are bucketed as 'other'
+
+            hashed_cols_: list of columns, default = None. Hashed into
+            n_hash_features_ columns each instead of one column per value
+
+            n_hash_features_: int, default = 256. Columns per hashed column
 
         Returns
             None
         '''
 
-        if self.customer_df is None:
-            self.prep_segment_data()
-            logger.info('No customer DF, prepping for clustering')
+        selected_cluster = self.customer_df.loc[:, cols]\
+            .set_index('user_pseudo_id')
+
+        # Numeric columns like week are standardized, the others one-hot
+        self.encoder = featureEncoder(min_frac=min_frac_,
+                                      hashed=hashed_cols_,
+                                      n_hash_features=n_hash_features_)
+        self.cluster_features = self.encoder.fit_transform(selected_cluster)
 
-        # Selecting columns with error handling
-        if 'week' not in self.customer_df.columns:
-            self.get_time_cohorts()
+        logger.info('Successfully prepped segmentation data with %s features',
+                    self.cluster_features.shape[1])
 
-        clust_backbone = self.customer_df.loc[:, cols]
+    # K-Means clustering
+    @stage(inputs=['cluster_features'], outputs=['k_means'],
+           attributes=['n_centers_'])
+    def create_kmeans(self, n_centers_=None, mini_batch_=False,
+                      chunk_rows_=10000, max_epochs_=10, tol_=1e-3,
+                      chunk_dir_=None, random_state_=None) -> None:
+        '''
+        Method to identify customer segments using kmeans clustering. The
+        mini-batch mode fits MiniBatchKMeans chunk by chunk with
+        partial_fit, so memory stays bounded by the chunk size at prod
+        scale. The inertia of each fit is kept in fit_report. When
+        select_k fitted the same number of clusters on the current
+        features, the fit starts from the centers of that sample fit.
 
-        # Only selecting countries that appear a fixed number of times
-        country_frac = clust_backbone['country']\
-            .value_counts() / clust_backbone['country'].count()
+        Args
+            n_centers_: int, default = None. Number of clusters, the
+            n_centers_ attribute when None
 
-        clust_backbone['country'] = clust_backbone['country']\
-            .apply(lambda x: x if country_frac[x] > 0.05 else 'other')
+            mini_batch_: boolean, default = False. Fits MiniBatchKMeans on
+            chunks of users instead of KMeans on all of them at once
 
-        # Selecting final columns and creating dummies
-        selected_cluster = clust_backbone.set_index('user_pseudo_id')
+            chunk_rows_: int, default = 10000. Users per chunk
 
-        self.cluster_df = pd.get_dummies(selected_cluster,
-                                         dtype=int,
-                                         columns=['continent',
-                                                  'country',
-                                                  'category'])
-        logger.info('Successfully prepped segmentation data')
+            max_epochs_: int, default = 10. Most passes over the users in
+            the mini-batch mode
 
-    # K-Means clustering
-    def create_kmeans(self) -> None:
+            tol_: float, default = 1e-3. Relative center shift between
+            passes under which the mini-batch fit has converged
+
+            chunk_dir_: string, default = None. Directory the features are
+            streamed from in the mini-batch mode. Chunks already in the
+            directory are reused if their manifest matches the current
+            features and chunk_rows_, otherwise they are rewritten
+
+            random_state_: int, default = None. Seed of the initialization
+
+        Returns
+            None
+        '''
+
+        if n_centers_ is None:
+            n_centers_ = self.n_centers_
+
+        # Starting from the centers of the select_k fit on a sample
+        sweep = self.k_models.get(n_centers_) \
+            if self._k_models_version == \
+            self.pipeline.version('cluster_features') else None
+        init = sweep.cluster_centers_ if sweep is not None \
+            else 'k-means++'
+
+        if sweep is not None:
+            logger.info('Starting from the select_k centers for k = %s',
+                        n_centers_)
+
+        if not mini_batch_:
+            # KMeans fits the sparse float32 matrix directly
+            self.k_means = KMeans(n_clusters=n_centers_, init=init,
+                                  n_init=1 if sweep is not None else 'auto',
+                                  random_state=random_state_)
+            self.customer_df['kmeans_cluster'] = self.k_means\
+                .fit_predict(self.cluster_features.matrix)
+            self.fit_report = pd.DataFrame(
+                {'rows': [len(self.cluster_features)],
+                 'iterations': [self.k_means.n_iter_],
+                 'inertia': [self.k_means.inertia_]})
+
+            logger.info('Fitted KMeans in %s iterations, inertia %.4g',
+                        self.k_means.n_iter_, self.k_means.inertia_)
+            return
+
+        if chunk_dir_ is None:
+            def chunks():
+                return iter_row_chunks(self.cluster_features, chunk_rows_)
+        else:
+            # Chunks of other features, or another chunk size, are rewritten
+            if not feature_chunks_match(chunk_dir_, self.cluster_features,
+                                        chunk_rows_):
+                write_feature_chunks(self.cluster_features, chunk_dir_,
+                                     chunk_rows_)
+
+            def chunks():
+                return read_feature_chunks(chunk_dir_)
+
+        self.k_means, self.fit_report = fit_minibatch_kmeans(
+            chunks, n_centers_, max_epochs=max_epochs_, tol=tol_,
+            random_state=random_state_, init=init)
+
+        # Labels are assigned chunk by chunk as well
+        self.customer_df['kmeans_cluster'] = predict_chunks(self.k_means,
+                                                            chunks())
+
+    # Comparing numbers of clusters before picking n_centers_
+    def select_k(self, k_values_=range(2, 16), sample_size_=100000,
+                 strata_col_='country', silhouette_size_=10000,
+                 n_workers_=None, cache_dir_='.model_cache',
+                 random_state_=0, apply_=False) -> pd.DataFrame:
         '''
-        Method to identify customer segments using kmeans clustering
+        Method that fits KMeans for a range of k in parallel on a
+        stratified sample of the clustering features. Fitted models are
+        cached by the hash of the sampled features and k, so repeated
+        sweeps only fit new values of k. They are kept in k_models, and
+        create_kmeans starts from their centers for the same k.
 
         Args
-            None
+            k_values_: iterable of ints, default = range(2, 16). Numbers of
+            clusters to compare
+
+            sample_size_: int, default = 100000. Users fitted for every k
+
+            strata_col_: string, default = 'country'. Column of
+            customer_df the sample keeps the shares of, None for a simple
+            random sample
+
+            silhouette_size_: int, default = 10000. Users the silhouette is
+            computed on
+
+            n_workers_: int, default = None for one process per CPU
+
+            cache_dir_: string, default = '.model_cache'. Directory of the
+            fitted models, None to disable the cache
+
+            random_state_: int, default = 0. Seed of the sample and fits
+
+            apply_: boolean, default = False. Sets n_centers_ to the k
+            with the highest silhouette, so the next create_kmeans call
+            fits it
 
         Returns
-            None
+            Pandas dataframe indexed by k with the inertia, silhouette,
+            Davies-Bouldin index, fit seconds and cache hits
         '''
 
-        self.k_means = KMeans(n_clusters=self.n_centers_)
-        self.customer_df['kmeans_cluster'] = self.k_means\
-            .fit_predict(self.cluster_df)
+        if self.cluster_features is None:
+            raise ValueError('Run prep_clustering_data before select_k')
 
-        self._kmeans_created_ = True
+        # customer_df rows are in the same order as the feature rows
+        strata = self.customer_df[strata_col_].astype(str) \
+            if strata_col_ is not None else None
+
+        self.k_selection, self.k_models = select_k(
+            self.cluster_features,
+            k_values=k_values_,
+            sample_size=sample_size_,
+            strata=strata,
+            silhouette_size=silhouette_size_,
+            n_workers=n_workers_,
+            cache_dir=cache_dir_,
+            random_state=random_state_)
+        self._k_models_version = self.pipeline.version('cluster_features')
+
+        if apply_:
+            self.n_centers_ = int(self.k_selection['silhouette'].idxmax())
+            logger.info('Picked %s clusters by silhouette', self.n_centers_)
+
+        return self.k_selection
 
     # Method for adding clusters to the long events dataframe
+    @stage(inputs=['k_means', 'event_df'], outputs=['segments'],
+           modifies=['event_df', 'long_event_df'])
     def add_customer_segments(self) -> None:
         '''
         Method that adds customer segments from kmeans to specified dataframes
@@ -162,26 +459,27 @@ class customerSegmentation:
             None
         '''
 
-        # Checking the k-means workflow has been completed
-        if not self._kmeans_created_:
-            raise Exception('K-Means workflow must be completed first')
+        # Adding the k-means column to the wide events for the funnel rates
+        clusters = self.customer_df\
+            .drop_duplicates('user_pseudo_id')\
+            .set_index('user_pseudo_id')['kmeans_cluster']
+        self.processor.event_df['kmeans_cluster'] = self.processor\
+            .event_df['user_pseudo_id'].map(clusters)
+
+        # The long events table is only updated if it has been built
+        if self.processor.long_event_df is not None:
 
-        # Dropping the existing k-means column if it's in the dataframe
-        if 'kmeans_cluster' in self.processor.long_event_df.columns:
-            self.processor.long_event_df.drop(columns='kmeans_cluster',
-                                              inplace=True)
-            logger.info('Dropping existing kmeans column')
+            # Dropping the existing k-means column if it's in the dataframe
+            if 'kmeans_cluster' in self.processor.long_event_df.columns:
+                self.processor.long_event_df.drop(columns='kmeans_cluster',
+                                                  inplace=True)
+                logger.info('Dropping existing kmeans column')
 
-        # Adding the k-means column to long events
-        self.processor.long_event_df = pd.merge(
-            self.processor.long_event_df.copy(),
-            self.customer_df.loc[:, ['user_pseudo_id',
-                                     'kmeans_cluster']],
-            on='user_pseudo_id',
-            how='left')
+            # Mapping keeps the compact categorical ids of the long table
+            self.processor.long_event_df['kmeans_cluster'] = self.processor\
+                .long_event_df['user_pseudo_id'].map(clusters)
 
-        self.processor.created_segments = True
-        logger.info("Added segments to long events table")
+        logger.info("Added segments to the events tables")
 
     # Method to describe the segments created from k-means
     def describe_segments(self):
@@ -196,15 +494,15 @@ class customerSegmentation:
         '''
 
         # Caculating the means of each fetaure in creating the clusters
-        means = self.cluster_df.mean()
+        means = self.cluster_features.mean()
 
         # Creating a datafrmae of the centroids of each cluster
         centroid_df = pd.DataFrame(self.k_means.cluster_centers_,
-                                   columns=self.cluster_df.columns)
+                                   columns=self.cluster_features.feature_names)
 
         # Taking the difference of each centroid versus the mean
-        cluster_diff_df = centroid_df.apply(lambda x: x - means, axis=1)
-        cluster_diff_df['center'] = [i for i in range(0, self.n_centers_)]
+        cluster_diff_df = centroid_df - means
+        cluster_diff_df['center'] = [i for i in range(0, len(centroid_df))]
 
         # Adding the heatmap df as an attribute
         self.heatmap_df = cluster_diff_df.set_index('center').T
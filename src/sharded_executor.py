@@ -0,0 +1,206 @@
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from src.funnel_engine import build_funnel_cube, funnel_counts, funnelCube
+
+# Setting up a logger
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+# Helper assigning each row to a shard from a stable hash of the user id
+def hash_partition(user_ids, n_shards) -> np.ndarray:
+    '''
+    Assigns rows to shards by hashing their user id, so the rows of a user
+    land in the same shard in every table
+
+    Args
+        user_ids: pandas series of user_pseudo_id, string or categorical
+
+        n_shards: int, number of shards
+
+    Returns
+        Numpy array of the shard of each row
+    '''
+
+    # Hashing each distinct id once, then looking the hashes up by code
+    codes, uniques = pd.factorize(user_ids)
+    hashes = pd.util.hash_array(np.asarray(uniques, dtype=object))
+
+    return (hashes % np.uint64(n_shards)).astype(np.int64)[codes]
+
+
+# Helper loading one shard of a table written by shardedExecutor.share
+def _load_shard(handle, shard) -> pd.DataFrame:
+    path, offsets = handle
+
+    # Memory-mapping the file, the slice is read without copying
+    with pa.memory_map(path) as source:
+        table = pa.ipc.open_file(source).read_all()
+
+    return table.slice(offsets[shard],
+                       offsets[shard + 1] - offsets[shard]).to_pandas()
+
+
+# Partial aggregations run by the worker processes
+def _shard_funnel_counts(handles, shard, by=None) -> pd.DataFrame:
+    return funnel_counts(_load_shard(handles['event_df'], shard), by=by)
+
+
+def _shard_funnel_cube(handles, shard) -> pd.DataFrame:
+    frames = {name: _load_shard(handle, shard)
+              for name, handle in handles.items()}
+
+    return build_funnel_cube(frames['event_df'],
+                             device_df=frames.get('device_df'),
+                             geo_df=frames.get('geo_df')).counts
+
+
+class shardedExecutor:
+    '''
+    Runs per-user aggregations on hash partitions of the users in a
+    process pool. Input tables are written once as Arrow IPC files that
+    the workers memory-map, instead of pickling dataframes to each worker,
+    and the partial results are summed back together.
+    '''
+
+    def __init__(self, n_workers=None, n_shards=None, tmp_dir=None) -> None:
+        self.n_workers = n_workers or os.cpu_count()
+        self.n_shards = n_shards or self.n_workers
+        self.tmp_dir = tmp_dir
+
+    def share(self, frames, directory) -> dict:
+        '''
+        Writes tables grouped by shard to Arrow IPC files for the workers
+
+        Args
+            frames: dictionary of name to pandas dataframe with a
+            user_pseudo_id column
+
+            directory: directory to write the files to
+
+        Returns
+            Dictionary of name to the file path and the row offset of
+            each shard in the file
+        '''
+
+        handles = {}
+        for name, df in frames.items():
+            shards = hash_partition(df['user_pseudo_id'], self.n_shards)
+
+            # Stable sort keeps the original row order within each shard
+            order = np.argsort(shards, kind='stable')
+            offsets = np.concatenate([[0], np.cumsum(
+                np.bincount(shards, minlength=self.n_shards))])
+
+            table = pa.Table.from_pandas(df.iloc[order],
+                                         preserve_index=False)
+            path = os.path.join(directory, f'{name}.arrow')
+            with pa.OSFile(path, 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+
+            handles[name] = (path, offsets)
+
+        return handles
+
+    def map_shards(self, task, frames, **kwargs) -> list:
+        '''
+        Runs a task on every shard of the tables in the process pool
+
+        Args
+            task: module level function taking the shared handles, the
+            shard number and the keyword arguments
+
+            frames: dictionary of name to pandas dataframe
+
+        Returns
+            List of the partial results of each shard
+        '''
+
+        with tempfile.TemporaryDirectory(dir=self.tmp_dir) as directory:
+            handles = self.share(frames, directory)
+
+            with ProcessPoolExecutor(max_workers=self.n_workers) as pool:
+                futures = [pool.submit(task, handles, shard, **kwargs)
+                           for shard in range(self.n_shards)]
+                partials = [future.result() for future in futures]
+
+        logger.info("Ran %s on %s shards", task.__name__, self.n_shards)
+
+        return partials
+
+    # Helper summing partial counts that share index and columns
+    @staticmethod
+    def _sum_partials(partials) -> pd.DataFrame:
+        reference = next((partial for partial in partials
+                          if partial.shape[0] > 0), partials[0])
+        levels = reference.index.names
+        counts = pd.concat(partials)\
+            .groupby(level=levels if len(levels) > 1 else 0,
+                     observed=True, sort=True, dropna=False)\
+            .sum()
+
+        # Restoring categorical levels lost when concatenating shards
+        if isinstance(counts.index, pd.MultiIndex):
+            counts.index = counts.index.set_levels([
+                pd.CategoricalIndex(level)
+                if isinstance(reference.index.levels[i], pd.CategoricalIndex)
+                else level
+                for i, level in enumerate(counts.index.levels)])
+
+        return counts.astype(np.int64)
+
+    def funnel_counts(self, event_df, by=None) -> pd.DataFrame:
+        '''
+        Sharded equivalent of funnel_engine.funnel_counts
+
+        Args
+            event_df: pandas dataframe with user_pseudo_id and the funnel
+            flag columns
+
+            by: column to group by, default = None
+
+        Returns
+            Pandas dataframe with a 'total' column and one column per step
+        '''
+
+        partials = self.map_shards(_shard_funnel_counts,
+                                   {'event_df': event_df},
+                                   by=by)
+
+        if by is None:
+            return sum(partials)
+
+        return self._sum_partials(partials)
+
+    def funnel_cube(self, event_df, device_df=None, geo_df=None):
+        '''
+        Sharded equivalent of funnel_engine.build_funnel_cube. Users are
+        hash partitioned the same way in every table, so each shard holds
+        all the sessions of its users.
+
+        Args
+            event_df: pandas dataframe with one row per user
+
+            device_df: pandas dataframe of devices by session, default = None
+
+            geo_df: pandas dataframe of locations by session, default = None
+
+        Returns
+            funnelCube
+        '''
+
+        frames = {'event_df': event_df}
+        if device_df is not None:
+            frames['device_df'] = device_df
+        if geo_df is not None:
+            frames['geo_df'] = geo_df
+
+        partials = self.map_shards(_shard_funnel_cube, frames)
+
+        return funnelCube(self._sum_partials(partials))
@@ -0,0 +1,152 @@
+import json
+import logging
+import os
+import pickle
+import shutil
+import time
+import pyarrow as pa
+
+# Setting up a logger
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class snapshotStore:
+    '''
+    Versioned snapshots of dataframes and fitted objects on disk. Every
+    save writes a new version directory with one uncompressed Arrow IPC
+    (Feather v2) file per dataframe, so loading memory-maps the files and
+    numeric columns are used without copying. Other objects, like a
+    fitted KMeans model, are pickled next to them.
+    '''
+
+    def __init__(self, snapshot_dir='.snapshots') -> None:
+        self.snapshot_dir = snapshot_dir
+
+        os.makedirs(snapshot_dir, exist_ok=True)
+
+    def versions(self) -> list:
+        '''Lists the saved versions, oldest first'''
+
+        # Interrupted saves leave vNNNN.tmp directories, never versions
+        return sorted(name for name in os.listdir(self.snapshot_dir)
+                      if name.startswith('v') and name[1:].isdigit() and
+                      os.path.isfile(os.path.join(self.snapshot_dir, name,
+                                                  'manifest.json')))
+
+    def _path(self, version) -> str:
+        if version is None:
+            versions = self.versions()
+            if not versions:
+                raise FileNotFoundError(
+                    f'No snapshots saved in {self.snapshot_dir}')
+            version = versions[-1]
+
+        return os.path.join(self.snapshot_dir, version)
+
+    def save(self, frames, objects=None) -> str:
+        '''
+        Writes a new snapshot version
+
+        Args
+            frames: dictionary of name to pandas dataframe. None values
+            are skipped
+
+            objects: dictionary of name to picklable object, default = None
+
+        Returns
+            Name of the new version
+        '''
+
+        versions = self.versions()
+        number = int(versions[-1][1:]) + 1 if versions else 1
+        version = f'v{number:04d}'
+
+        path = self._path(version)
+        tmp_path = f'{path}.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        manifest = {'created': time.time(), 'frames': {}, 'objects': []}
+
+        for name, df in frames.items():
+            if df is None:
+                continue
+
+            table = pa.Table.from_pandas(df)
+            with pa.OSFile(os.path.join(tmp_path, f'{name}.arrow'),
+                           'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+
+            manifest['frames'][name] = list(df.shape)
+
+        for name, obj in (objects or {}).items():
+            if obj is None:
+                continue
+
+            with open(os.path.join(tmp_path, f'{name}.pkl'), 'wb') as f:
+                pickle.dump(obj, f)
+
+            manifest['objects'].append(name)
+
+        with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+        # Renaming the finished directory so loads never see partial saves
+        os.replace(tmp_path, path)
+
+        logger.info("Saved snapshot %s with %s frames",
+                    version, len(manifest['frames']))
+
+        return version
+
+    def load(self, version=None, names=None, memory_map=True) -> tuple:
+        '''
+        Loads a snapshot version
+
+        Args
+            version: string, default = None for the latest version
+
+            names: list of frame and object names to load, default = None
+            for all of them
+
+            memory_map: boolean, default = True. Memory-maps the frame
+            files instead of reading them into memory
+
+        Returns
+            Tuple of a dictionary of name to pandas dataframe and a
+            dictionary of name to object
+        '''
+
+        path = self._path(version)
+
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+
+        if names is not None:
+            manifest['frames'] = [name for name in manifest['frames']
+                                  if name in names]
+            manifest['objects'] = [name for name in manifest['objects']
+                                   if name in names]
+
+        frames = {}
+        for name in manifest['frames']:
+            file_path = os.path.join(path, f'{name}.arrow')
+            source = pa.memory_map(file_path) if memory_map \
+                else pa.OSFile(file_path)
+
+            with source:
+                table = pa.ipc.open_file(source).read_all()
+
+            # One block per column keeps mapped numeric columns uncopied
+            frames[name] = table.to_pandas(split_blocks=True)
+
+        objects = {}
+        for name in manifest['objects']:
+            with open(os.path.join(path, f'{name}.pkl'), 'rb') as f:
+                objects[name] = pickle.load(f)
+
+        logger.info("Loaded snapshot %s", os.path.basename(path))
+
+        return frames, objects
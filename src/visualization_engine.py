@@ -2,6 +2,7 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
+from src.funnel_engine import EVENT_DTYPE, rates_from_counts
 
 
 class ecommerceViz:
@@ -21,6 +22,13 @@ class ecommerceViz:
 
         return mask
 
+    # Helper function bringing the funnel cube up to date before plotting
+    def cube_(self):
+
+        self.processor.prep_funnel_cube()
+
+        return self.processor.funnel_cube
+
     '''
     -------------Section for overall event conversion-------------
     '''
@@ -28,7 +36,8 @@ class ecommerceViz:
     def plot_conversion_rate(self,
                              remove_pageview=False,
                              plot_segments=False,
-                             col_wrap=5) -> None:
+                             col_wrap=5,
+                             filters=None) -> None:
         '''
         Plots overall event conversion rates in bar charts.
 
@@ -42,14 +51,13 @@ class ecommerceViz:
             col_wrap: int, default = 5. Number of columns to wrap if
             plotting customer segments
 
+            filters: dictionary, default = None. Maps a cube dimension
+            like 'category' or 'country' to the values to plot
+
         Returns
             None
         '''
 
-        # Calling the helper method for removing the pageview event
-        row_mask = self.remove_pageview_(self.processor.long_event_df,
-                                         remove_pageview)
-
         # Adding logic for dynamic plotting of customer segments
         if plot_segments:
 
@@ -57,7 +65,16 @@ class ecommerceViz:
             if not self.processor.created_segments:
                 raise ValueError("No segments in long dataframe")
 
-            grid = sns.FacetGrid(data=self.processor.long_event_df[row_mask],
+            rates_df = self.cube_().to_long(by='kmeans_cluster',
+                                            filters=filters)
+        else:
+            rates_df = self.cube_().to_long(filters=filters)
+
+        # Calling the helper method for removing the pageview event
+        row_mask = self.remove_pageview_(rates_df, remove_pageview)
+
+        if plot_segments:
+            grid = sns.FacetGrid(data=rates_df[row_mask],
                                  col='kmeans_cluster',
                                  col_wrap=col_wrap,
                                  hue='event',
@@ -77,7 +94,7 @@ class ecommerceViz:
             sns.set_theme()
             sns.barplot(x='event',
                         y='occurence',
-                        data=self.processor.long_event_df[row_mask],
+                        data=rates_df[row_mask],
                         hue='event',
                         palette='Greens')
             plt.title('Event Conversion Rates')
@@ -97,16 +114,11 @@ class ecommerceViz:
         '''
 
         # Method to ensure segments have been created before attempting to plot
-        if self.processor._created_segments is False:
-            ValueError('Kmeans Segments Not Created')
-
-        return self.processor.long_event_df.loc[:, ['kmeans_cluster',
-                                                    'event',
-                                                    'occurence']]\
-            .pivot_table(index='kmeans_cluster',
-                         columns='event',
-                         values='occurence',
-                         aggfunc='mean')\
+        if not self.processor.created_segments:
+            raise ValueError('Kmeans Segments Not Created')
+
+        return self.cube_().rates(by='kmeans_cluster')\
+            .rename_axis(columns='event')\
             .round(3)
 
     def create_segment_conversion_heatmap(self,
@@ -139,7 +151,9 @@ class ecommerceViz:
         plt.show()
 
     # Method for plotting conversion over time
-    def plot_conversion_rates_over_time(self, remove_pageview=False) -> None:
+    def plot_conversion_rates_over_time(self,
+                                        remove_pageview=False,
+                                        filters=None) -> None:
         '''
         Plots customer conversion rates over time
 
@@ -147,17 +161,22 @@ class ecommerceViz:
             remove_pageview: boolean, default = False. Removes the pageview
             step from the visualization to not overly expand the y-axis
 
+            filters: dictionary, default = None. Maps a cube dimension
+            like 'category' or 'country' to the values to plot
+
         Returns
             None
         '''
 
+        rates_df = self.cube_().to_long(by='first_event_date',
+                                        filters=filters)
+
         # Calling the helper method for removing the pageview event
-        row_mask = self.remove_pageview_(self.processor.long_event_df,
-                                         remove_pageview)
+        row_mask = self.remove_pageview_(rates_df, remove_pageview)
 
         # Adding the code for creating the plots
         sns.set_theme()
-        sns.lineplot(data=self.processor.long_event_df[row_mask],
+        sns.lineplot(data=rates_df[row_mask],
                      x='first_event_date',
                      y='occurence',
                      hue='event')
@@ -167,7 +186,9 @@ class ecommerceViz:
         plt.show()
 
     # Method to plot aggregate conversion rates over time
-    def plot_conversion_events_over_time(self, remove_pageview=False) -> None:
+    def plot_conversion_events_over_time(self,
+                                         remove_pageview=False,
+                                         filters=None) -> None:
         '''
         Plots total conversion events over time
 
@@ -175,16 +196,22 @@ class ecommerceViz:
             remove_pageview: boolean, default = False. Removes the pageview
             step from the visualization to not overly expand the y-axis
 
+            filters: dictionary, default = None. Maps a cube dimension
+            like 'category' or 'country' to the values to plot
+
         Returns
             None, generates chart
         '''
 
+        events_df = self.cube_().to_long(by='first_event_date',
+                                         filters=filters,
+                                         rates=False)
+
         # Calling the helper method for removing the pageview event
-        row_mask = self.remove_pageview_(self.processor.agg_long_event_df,
-                                         remove_pageview)
+        row_mask = self.remove_pageview_(events_df, remove_pageview)
 
         sns.set_theme()
-        sns.lineplot(data=self.processor.agg_long_event_df[row_mask],
+        sns.lineplot(data=events_df[row_mask],
                      x='first_event_date',
                      y='occurence',
                      hue='event')
@@ -198,16 +225,41 @@ class ecommerceViz:
     '''
     # Method to plot session conversion
     def plot_session_conversion_rate(self, remove_pageview=False):
+        '''
+        Plots session conversion rates in a bar chart. Uses the out of
+        core aggregate from prep_session_out_of_core when it was built
+        after the last run_queries, otherwise the in-memory session
+        dataframe.
+
+        Args
+            remove_pageview: boolean to remove the pageview step from
+            the visualization to not overly expand the y-axis
+
+        Returns
+            None
+        '''
+
+        if self.processor.agg_session_df is not None:
+            counts = self.processor.agg_session_df.sum().to_frame('All').T
+            rates = rates_from_counts(counts)
+        elif self.processor.session_df is not None:
+            rates = self.processor.funnel_rates(level='session')
+        else:
+            raise ValueError('No session data, run run_queries or '
+                             'prep_session_out_of_core first')
+
+        rates_df = rates.melt(var_name='event', value_name='occurence')
+        rates_df['event'] = rates_df['event'].astype(EVENT_DTYPE)
 
         # Calling the helper method for removing the pageview event
-        row_mask = self.remove_pageview_(self.processor.long_session_df,
-                                         remove_pageview)
+        row_mask = self.remove_pageview_(rates_df, remove_pageview)
 
         # Creating plots
-        sns.set_them()
+        sns.set_theme()
         sns.barplot(x='event',
                     y='occurence',
-                    data=self.processor.long_session_df[row_mask],
+                    data=rates_df[row_mask],
+                    hue='event',
                     palette='Greens')
         plt.title('Session Conversion Rates')
         plt.ylabel('Conversion Rate')
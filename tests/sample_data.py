@@ -0,0 +1,93 @@
+import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Schema of the GA4 export columns used by the loader queries
+EVENT_SCHEMA = pa.schema([
+    ('event_date', pa.string()),
+    ('event_timestamp', pa.int64()),
+    ('event_name', pa.string()),
+    ('event_params', pa.list_(pa.struct([
+        ('key', pa.string()),
+        ('value', pa.struct([('string_value', pa.string()),
+                             ('int_value', pa.int64())]))]))),
+    ('user_pseudo_id', pa.string()),
+    ('device', pa.struct([('category', pa.string()),
+                          ('mobile_brand_name', pa.string()),
+                          ('operating_system', pa.string())])),
+    ('geo', pa.struct([('continent', pa.string()),
+                       ('country', pa.string()),
+                       ('region', pa.string()),
+                       ('city', pa.string())]))])
+
+DEVICES = {'desktop': ('desktop', 'Google', 'Windows'),
+           'mobile': ('mobile', 'Apple', 'iOS')}
+
+GEOS = {'us': ('Americas', 'United States', 'California', 'San Jose'),
+        'ca': ('Americas', 'Canada', 'Ontario', 'Toronto'),
+        'in': ('Asia', 'India', 'Karnataka', 'Bengaluru')}
+
+# (shard, user, session, seconds into the day, event, device, geo)
+SAMPLE_EVENTS = [
+    ('20210129', 'u1', 101, 10, 'session_start', 'desktop', 'us'),
+    ('20210129', 'u1', 101, 20, 'page_view', 'desktop', 'us'),
+    ('20210129', 'u1', 101, 30, 'add_to_cart', 'desktop', 'us'),
+    ('20210130', 'u1', 102, 40, 'page_view', 'mobile', 'us'),
+    ('20210130', 'u1', 102, 50, 'add_to_cart', 'mobile', 'us'),
+    ('20210130', 'u1', 102, 60, 'begin_checkout', 'mobile', 'us'),
+    ('20210130', 'u1', 102, 70, 'purchase', 'mobile', 'us'),
+    ('20210130', 'u2', 201, 15, 'page_view', 'mobile', 'ca'),
+    ('20210130', 'u2', 201, 25, 'scroll', 'mobile', 'ca'),
+    ('20210130', 'u3', 301, 35, 'page_view', 'desktop', 'in'),
+    ('20210130', 'u3', 301, 45, 'add_to_cart', 'desktop', 'in'),
+    ('20210131', 'u3', 302, 55, 'purchase', 'desktop', 'in'),
+    ('20210131', 'u4', 401, 65, 'page_view', 'desktop', 'us'),
+    ('20210131', 'u4', 401, 75, 'add_to_cart', 'desktop', 'us'),
+    ('20210131', 'u4', 401, 85, 'begin_checkout', 'desktop', 'us'),
+    ('20210131', 'u5', 501, 95, 'page_view', 'mobile', 'ca'),
+]
+
+# Microseconds at midnight UTC of each shard date
+SHARD_START = {'20210129': 1611878400000000,
+               '20210130': 1611964800000000,
+               '20210131': 1612051200000000}
+
+
+def write_sample_shards(parquet_dir, events=SAMPLE_EVENTS):
+    '''
+    Writes a small synthetic GA4 export as events_YYYYMMDD.parquet shards
+
+    Args
+        parquet_dir: directory to write the shards to
+
+        events: list of event tuples, default = SAMPLE_EVENTS
+
+    Returns
+        Sorted list of the shard suffixes written
+    '''
+
+    rows_by_shard = {}
+    for shard, user, session, seconds, name, device, geo in events:
+        rows_by_shard.setdefault(shard, []).append({
+            'event_date': shard,
+            'event_timestamp': SHARD_START[shard] + seconds * 1000000,
+            'event_name': name,
+            'event_params': [
+                {'key': 'ga_session_id',
+                 'value': {'string_value': None, 'int_value': session}},
+                {'key': 'page_title',
+                 'value': {'string_value': 'Home', 'int_value': None}}],
+            'user_pseudo_id': user,
+            'device': dict(zip(['category',
+                                'mobile_brand_name',
+                                'operating_system'], DEVICES[device])),
+            'geo': dict(zip(['continent',
+                             'country',
+                             'region',
+                             'city'], GEOS[geo]))})
+
+    for shard, rows in rows_by_shard.items():
+        pq.write_table(pa.Table.from_pylist(rows, schema=EVENT_SCHEMA),
+                       os.path.join(parquet_dir, f'events_{shard}.parquet'))
+
+    return sorted(rows_by_shard)
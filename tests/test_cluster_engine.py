@@ -0,0 +1,224 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from scipy import sparse
+from sklearn.metrics import davies_bouldin_score
+from src.data_loader import duckdbBackend
+from src.data_processor import ecommerceProcessor
+from src.segmentation import customerSegmentation
+from src.cluster_engine import (_davies_bouldin,
+                                feature_chunks_match,
+                                features_key,
+                                fit_minibatch_kmeans,
+                                iter_row_chunks,
+                                predict_chunks,
+                                read_feature_chunks,
+                                select_k,
+                                stratified_sample,
+                                write_feature_chunks)
+from tests.sample_data import write_sample_shards
+
+
+class TestClusterEngine(unittest.TestCase):
+
+    def setUp(self):
+        """Builds sparse features of three well separated groups"""
+        rng = np.random.default_rng(0)
+        centers = np.array([[5, 0, 0], [0, 5, 0], [0, 0, 5]],
+                           dtype=np.float32)
+        self.groups = rng.integers(0, 3, 3000)
+        dense = centers[self.groups] + \
+            rng.normal(0, 0.1, (3000, 3)).astype(np.float32)
+        self.matrix = sparse.csr_matrix(dense)
+        self.chunk_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.chunk_dir, ignore_errors=True)
+
+    def test_minibatch_recovers_groups(self):
+        '''Test the chunked fit converges and finds the groups'''
+        k_means, report = fit_minibatch_kmeans(
+            lambda: iter_row_chunks(self.matrix, 500), 3,
+            max_epochs=20, tol=1e-3, random_state=0)
+
+        self.assertLess(report['center_shift'].iloc[-1], 1e-3)
+        self.assertTrue((report['rows'] == 3000).all())
+        self.assertLess(len(report), 20)
+
+        labels = predict_chunks(k_means, iter_row_chunks(self.matrix, 500))
+        self.assertEqual(len(labels), 3000)
+
+        # Every true group maps to a single cluster
+        for group in range(3):
+            self.assertEqual(len(np.unique(labels[self.groups == group])), 1)
+
+        self.assertAlmostEqual(report['inertia'].iloc[-1],
+                               -k_means.score(self.matrix), delta=1.0)
+
+    def test_chunks_from_disk(self):
+        '''Test chunks written to disk read back in row order'''
+        paths = write_feature_chunks(self.matrix, self.chunk_dir, 700)
+
+        self.assertEqual(len(paths), 5)
+        self.assertTrue(all(os.path.isfile(path) for path in paths))
+
+        restored = sparse.vstack(list(read_feature_chunks(self.chunk_dir)))
+        self.assertEqual((restored != self.matrix).nnz, 0)
+
+        k_means, report = fit_minibatch_kmeans(
+            lambda: read_feature_chunks(self.chunk_dir), 3,
+            max_epochs=5, random_state=0)
+        self.assertEqual(k_means.cluster_centers_.shape, (3, 3))
+
+        # Other features or chunk sizes don't match the written chunks
+        self.assertTrue(feature_chunks_match(self.chunk_dir, self.matrix,
+                                             700))
+        self.assertFalse(feature_chunks_match(self.chunk_dir, self.matrix,
+                                              500))
+        self.assertFalse(feature_chunks_match(self.chunk_dir,
+                                              self.matrix[:2000], 700))
+
+        # Rewriting removes the chunks of the earlier features
+        write_feature_chunks(self.matrix[:2000], self.chunk_dir, 1000)
+        restored = sparse.vstack(list(read_feature_chunks(self.chunk_dir)))
+        self.assertEqual(restored.shape[0], 2000)
+
+    def test_stratified_sample(self):
+        '''Test every stratum keeps its share and rare ones are kept'''
+        strata = np.array(['US'] * 900 + ['IN'] * 99 + ['FR'])
+        rows = stratified_sample(strata, 100, random_state=0)
+
+        self.assertTrue((np.diff(rows) > 0).all())
+        values, counts = np.unique(strata[rows], return_counts=True)
+        self.assertEqual(dict(zip(values, counts)),
+                         {'US': 90, 'IN': 10, 'FR': 1})
+        self.assertEqual(len(stratified_sample(strata, 5000)), 1000)
+
+    def test_davies_bouldin_matches_sklearn(self):
+        '''Test the sparse Davies-Bouldin index matches sklearn'''
+        labels = np.random.default_rng(1).integers(0, 4, 3000)
+
+        # sklearn averages the float32 rows in float32
+        np.testing.assert_allclose(
+            _davies_bouldin(self.matrix, labels, 4),
+            davies_bouldin_score(self.matrix.toarray(), labels), rtol=1e-4)
+
+    def test_select_k_caches_models(self):
+        '''Test the sweep scores each k and reuses cached fits'''
+        report, models = select_k(self.matrix, k_values=[2, 3, 4],
+                                  sample_size=1000, strata=self.groups,
+                                  silhouette_size=500, n_workers=2,
+                                  cache_dir=self.chunk_dir)
+
+        self.assertEqual(report.index.tolist(), [2, 3, 4])
+        self.assertFalse(report['cached'].any())
+        self.assertEqual(report['silhouette'].idxmax(), 3)
+        self.assertEqual(report['davies_bouldin'].idxmin(), 3)
+        self.assertTrue(report['inertia'].is_monotonic_decreasing)
+        self.assertEqual(len(os.listdir(self.chunk_dir)), 3)
+
+        cached, cached_models = select_k(self.matrix, k_values=[3, 5],
+                                         sample_size=1000,
+                                         strata=self.groups,
+                                         silhouette_size=500, n_workers=2,
+                                         cache_dir=self.chunk_dir)
+
+        self.assertEqual(cached['cached'].tolist(), [True, False])
+        self.assertAlmostEqual(cached.loc[3, 'inertia'],
+                               report.loc[3, 'inertia'])
+        np.testing.assert_array_equal(
+            cached_models[3].cluster_centers_,
+            models[3].cluster_centers_)
+
+        # A different feature set gets its own key
+        self.assertNotEqual(features_key(self.matrix),
+                            features_key(self.matrix[:10]))
+
+
+class TestSegmentationChunks(unittest.TestCase):
+
+    def setUp(self):
+        """Preps segmentation features over local sample shards"""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        write_sample_shards(self.tmp_dir.name)
+        self.chunk_dir = os.path.join(self.tmp_dir.name, 'chunks')
+
+        processor = ecommerceProcessor(
+            backend=duckdbBackend(self.tmp_dir.name))
+        processor.run_queries(test_=False)
+        self.segmentation = customerSegmentation(processor, n_centers_=2)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_reprepped_features_rewrite_chunks(self):
+        '''Test re-prepped features are not fitted from stale chunks'''
+        self.segmentation.create_kmeans(mini_batch_=True, chunk_rows_=2,
+                                        chunk_dir_=self.chunk_dir,
+                                        random_state_=0)
+        self.assertEqual(self.segmentation.k_means.n_features_in_, 8)
+
+        self.segmentation.prep_clustering_data(
+            cols=['user_pseudo_id', 'country', 'week'])
+        self.segmentation.create_kmeans(mini_batch_=True, chunk_rows_=2,
+                                        chunk_dir_=self.chunk_dir,
+                                        random_state_=0)
+
+        features = self.segmentation.cluster_features
+        self.assertEqual(self.segmentation.k_means.n_features_in_,
+                         features.shape[1])
+        self.assertTrue(feature_chunks_match(self.chunk_dir, features, 2))
+        np.testing.assert_array_equal(
+            self.segmentation.customer_df['kmeans_cluster'],
+            self.segmentation.k_means.predict(features.matrix))
+
+    def test_changed_n_centers_refits(self):
+        '''Test a new number of clusters makes the fit out of date'''
+        self.segmentation.create_kmeans(random_state_=0)
+        self.assertEqual(self.segmentation.k_means.n_clusters, 2)
+
+        self.segmentation.n_centers_ = 3
+        self.segmentation.create_kmeans(random_state_=0)
+        self.assertEqual(self.segmentation.k_means.n_clusters, 3)
+
+        self.segmentation.describe_segments()
+        self.assertEqual(self.segmentation.heatmap_df.columns.tolist(),
+                         [0, 1, 2])
+
+        # An explicit number of clusters overrides the attribute
+        self.segmentation.create_kmeans(n_centers_=2, random_state_=0)
+        self.assertEqual(self.segmentation.k_means.n_clusters, 2)
+
+    def test_selected_k_refits_from_sweep(self):
+        '''Test the picked k is fitted from the centers of the sweep'''
+        self.segmentation.prep_clustering_data()
+        report = self.segmentation.select_k(
+            k_values_=[2, 3], sample_size_=100, strata_col_=None,
+            silhouette_size_=100, n_workers_=1,
+            cache_dir_=os.path.join(self.tmp_dir.name, 'models'),
+            apply_=True)
+
+        best = report['silhouette'].idxmax()
+        self.assertEqual(self.segmentation.n_centers_, best)
+
+        self.segmentation.create_kmeans(random_state_=0)
+        k_means = self.segmentation.k_means
+        self.assertEqual(k_means.n_clusters, best)
+        np.testing.assert_array_equal(
+            k_means.init, self.segmentation.k_models[best].cluster_centers_)
+
+        self.segmentation.describe_segments()
+        self.assertEqual(self.segmentation.heatmap_df.columns.tolist(),
+                         list(range(best)))
+
+        # Sweep centers of other features are not used
+        self.segmentation.prep_clustering_data(
+            cols=['user_pseudo_id', 'country', 'week'])
+        self.segmentation.create_kmeans(random_state_=0)
+        self.assertEqual(self.segmentation.k_means.init, 'k-means++')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+import numpy as np
+import pandas as pd
+from src.cohort_engine import (assign_cohorts,
+                               cohort_counts,
+                               conversion_matrix,
+                               retention_matrix)
+
+
+class TestCohortEngine(unittest.TestCase):
+
+    def setUp(self):
+        """Builds sessions of three users over three weeks"""
+        self.session_df = pd.DataFrame(
+            [('a', '20210101', 0), ('a', '20210109', 1),
+             ('a', '20210110', 0), ('b', '20210108', 0),
+             ('b', '20210120', 1), ('c', '20210101', 0)],
+            columns=['user_pseudo_id', 'first_event_date', 'purchased'])
+
+    def test_assign_cohorts(self):
+        '''Test periods match the per-row date arithmetic'''
+        dates = pd.Series(['20210131', '20210201', '20210215', None])
+
+        np.testing.assert_array_equal(assign_cohorts(dates, 'day'),
+                                      [0, 1, 15, -1])
+        np.testing.assert_array_equal(assign_cohorts(dates, 'week'),
+                                      [0, 0, 2, -1])
+        np.testing.assert_array_equal(assign_cohorts(dates, 'month'),
+                                      [0, 1, 1, -1])
+
+    def test_retention_and_conversion(self):
+        '''Test each user counts once per period of their cohort'''
+        counts = cohort_counts(self.session_df, freq='week')
+        retention = retention_matrix(counts)
+        conversion = conversion_matrix(counts)
+
+        first, second = pd.to_datetime(['2021-01-01', '2021-01-08'])
+        self.assertEqual(counts.loc[(first, 0), 'users'], 2)
+        self.assertEqual(list(retention.loc[first]), [1.0, 0.5, 0.0])
+        self.assertEqual(list(conversion.loc[first]), [0.0, 0.5, 0.0])
+        self.assertEqual(conversion.loc[second, 1], 1.0)
+
+        # Periods after the last date are missing, not zero
+        self.assertTrue(np.isnan(retention.loc[second, 2]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,280 @@
+import os
+import tempfile
+import unittest
+import pandas as pd
+from unittest import mock
+from src.data_loader import (TEST_DATE_RANGE,
+                             bigqueryBackend,
+                             duckdbBackend,
+                             get_backend,
+                             set_backend,
+                             ecommerce_loader,
+                             ecommerce_loader_prod,
+                             ecommerce_loader_test,
+                             ecommerce_loader_incremental,
+                             ecommerce_loader_steps,
+                             ecommerce_loader_stream)
+from src.data_processor import ecommerceProcessor
+from tests.sample_data import write_sample_shards, SAMPLE_EVENTS
+
+
+class TestDuckdbLoader(unittest.TestCase):
+
+    def setUp(self):
+        """Writes sample shards and points a local backend at them"""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        write_sample_shards(self.tmp_dir.name)
+        self.backend = duckdbBackend(self.tmp_dir.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_positional_return_dict(self):
+        '''Test the test loader keeps return_dict as its first argument'''
+        results = ecommerce_loader_test(True, self.backend)
+
+        self.assertEqual(set(results), {'event_query', 'session_query',
+                                        'device_query', 'geo_query'})
+        pd.testing.assert_frame_equal(
+            results['session_query'],
+            ecommerce_loader(*TEST_DATE_RANGE, return_dict=True,
+                             backend=self.backend)['session_query'])
+
+    def test_prod_loader(self):
+        '''Test the prod queries run against the local backend'''
+        results = ecommerce_loader_prod(return_dict=True,
+                                        backend=self.backend)
+
+        event_df = results['event_query'].set_index('user_pseudo_id')
+
+        # One row per user with the funnel flags aggregated
+        self.assertEqual(sorted(event_df.index),
+                         ['u1', 'u2', 'u3', 'u4', 'u5'])
+        self.assertEqual(event_df.loc['u1', 'first_event_date'], '20210129')
+        self.assertEqual(event_df.loc['u1', 'purchased'], 1)
+        self.assertEqual(event_df.loc['u2', 'added_to_cart'], 0)
+
+        # One row per user and session for the session level queries
+        self.assertEqual(results['session_query'].shape[0], 7)
+        self.assertEqual(results['device_query'].shape[0], 7)
+        self.assertEqual(set(results['geo_query'].columns),
+                         {'user_pseudo_id', 'session', 'continent',
+                          'country', 'region', 'city'})
+
+    def test_date_range_loader(self):
+        '''Test the loader only reads shards within the date range'''
+        results = ecommerce_loader('2021-01-30', '20210130',
+                                   return_dict=True,
+                                   backend=self.backend)
+
+        self.assertEqual(sorted(results['event_query']['user_pseudo_id']),
+                         ['u1', 'u2', 'u3'])
+        self.assertEqual(set(results['session_query']['first_event_date']),
+                         {'20210130'})
+        self.assertEqual(set(results['device_query']['session']),
+                         {102, 201, 301})
+
+    def test_sampled_loader(self):
+        '''Test user sampling keeps the same users in every query'''
+        results = ecommerce_loader(sample_frac=0.5,
+                                   return_dict=True,
+                                   backend=self.backend)
+
+        users = set(results['event_query']['user_pseudo_id'])
+        self.assertLess(len(users), 5)
+        for name in ['session_query', 'device_query', 'geo_query']:
+            self.assertLessEqual(set(results[name]['user_pseudo_id']), users)
+
+    def test_loader_metrics(self):
+        '''Test metrics are recorded for each query and logged'''
+        log_path = os.path.join(self.tmp_dir.name, 'metrics.jsonl')
+        _, metrics = ecommerce_loader_prod(return_metrics=True,
+                                           metrics_log=log_path,
+                                           dry_run=True,
+                                           backend=self.backend)
+
+        metrics_df = metrics.to_frame().set_index('query')
+        self.assertEqual(sorted(metrics_df.index),
+                         ['device_query', 'event_query',
+                          'geo_query', 'session_query'])
+        self.assertEqual(metrics_df.loc['session_query', 'rows'], 7)
+        self.assertTrue((metrics_df['memory_bytes'] > 0).all())
+        self.assertTrue((metrics_df['execution_seconds'] >= 0).all())
+        self.assertTrue((metrics_df['download_seconds'] >= 0).all())
+
+        with open(log_path) as f:
+            self.assertEqual(len(f.readlines()), 4)
+
+    def test_concurrent_loader(self):
+        '''Test the concurrent mode returns the same frames'''
+        serial = ecommerce_loader_prod(return_dict=True,
+                                       backend=self.backend)
+        concurrent = ecommerce_loader_prod(return_dict=True,
+                                           backend=self.backend,
+                                           concurrent=True)
+
+        self.assertEqual(list(serial), list(concurrent))
+        for name, frame in serial.items():
+            pd.testing.assert_frame_equal(
+                frame.sort_values(list(frame.columns))
+                .reset_index(drop=True),
+                concurrent[name].sort_values(list(frame.columns))
+                .reset_index(drop=True))
+
+    def test_combined_loader(self):
+        '''Test the single-scan mode matches the separate queries'''
+        separate = ecommerce_loader_prod(return_dict=True,
+                                         backend=self.backend)
+        combined = ecommerce_loader_prod(return_dict=True,
+                                         backend=self.backend,
+                                         combined=True)
+
+        for name in ['session_query', 'device_query', 'geo_query']:
+            expected = separate[name]
+            result = combined[name].loc[:, expected.columns]
+            pd.testing.assert_frame_equal(
+                result.sort_values(['user_pseudo_id', 'session'])
+                .reset_index(drop=True),
+                expected.sort_values(['user_pseudo_id', 'session'])
+                .reset_index(drop=True),
+                check_dtype=False)
+
+    def test_incremental_loader(self):
+        '''Test merging new shards matches a full reload'''
+        with tempfile.TemporaryDirectory() as shard_dir:
+            state_dir = os.path.join(shard_dir, 'state')
+            backend = duckdbBackend(shard_dir)
+
+            # Loading the first two shards, then the last one on its own
+            write_sample_shards(shard_dir, [event for event in SAMPLE_EVENTS
+                                            if event[0] != '20210131'])
+            ecommerce_loader_incremental(state_dir, backend=backend)
+
+            write_sample_shards(shard_dir)
+            with open(os.path.join(state_dir, 'manifest.json')) as f:
+                self.assertNotIn('20210131', f.read())
+            incremental = ecommerce_loader_incremental(state_dir,
+                                                       return_dict=True,
+                                                       backend=backend)
+
+        full = ecommerce_loader_prod(return_dict=True, backend=self.backend)
+
+        for name, expected in full.items():
+            keys = list(expected.columns[:2])
+            pd.testing.assert_frame_equal(
+                incremental[name].sort_values(keys).reset_index(drop=True),
+                expected.sort_values(keys).reset_index(drop=True),
+                check_dtype=False)
+
+    def test_typed_loader(self):
+        '''Test the typed mode returns compact dtypes with equal values'''
+        default = ecommerce_loader_prod(return_dict=True,
+                                        backend=self.backend)
+        typed = ecommerce_loader_prod(return_dict=True,
+                                      backend=self.backend,
+                                      typed=True,
+                                      combined=True)
+
+        event_df = typed['event_query']
+        self.assertIsInstance(event_df['user_pseudo_id'].dtype,
+                              pd.CategoricalDtype)
+        self.assertEqual(event_df['purchased'].dtype, 'int8')
+        self.assertTrue(pd.api.types.is_datetime64_any_dtype(
+            event_df['first_event_date']))
+        self.assertIsInstance(typed['geo_query']['country'].dtype,
+                              pd.CategoricalDtype)
+
+        expected = default['session_query']
+        result = typed['session_query'].astype({
+            'user_pseudo_id': str,
+            'first_event_date': 'datetime64[ns]'})
+        expected = expected.assign(
+            first_event_date=pd.to_datetime(expected['first_event_date']))
+        pd.testing.assert_frame_equal(
+            result.loc[:, ['user_pseudo_id', 'session', 'first_event_date',
+                           'viewed_page', 'purchased']]
+            .sort_values(['user_pseudo_id', 'session'])
+            .reset_index(drop=True),
+            expected.loc[:, ['user_pseudo_id', 'session', 'first_event_date',
+                             'viewed_page', 'purchased']]
+            .sort_values(['user_pseudo_id', 'session'])
+            .reset_index(drop=True),
+            check_dtype=False)
+
+    def test_stream_loader(self):
+        '''Test streamed batches add up to the full result'''
+        batches = list(ecommerce_loader_stream('session_query',
+                                               backend=self.backend,
+                                               batch_size=3))
+
+        self.assertTrue(all(batch.shape[0] <= 3 for batch in batches))
+        self.assertEqual(sum(batch.shape[0] for batch in batches), 7)
+
+    def test_step_loader(self):
+        '''Test the raw funnel events keep their order and sessions'''
+        step_df = ecommerce_loader_steps(backend=self.backend)
+        u3 = step_df[step_df['user_pseudo_id'] == 'u3']\
+            .sort_values('event_timestamp')
+
+        self.assertEqual(set(step_df['event_name']),
+                         {'page_view', 'add_to_cart',
+                          'begin_checkout', 'purchase'})
+        self.assertEqual(list(u3['event_name']),
+                         ['page_view', 'add_to_cart', 'purchase'])
+        self.assertEqual(list(u3['session']), [301, 301, 302])
+
+    def test_step_timestamps(self):
+        '''Test the loader returns the first time of each step'''
+        results = ecommerce_loader_prod(return_dict=True,
+                                        backend=self.backend)
+        event_df = results['event_query'].set_index('user_pseudo_id')
+
+        self.assertEqual(event_df.loc['u1', 'added_to_cart_timestamp'] -
+                         event_df.loc['u1', 'viewed_page_timestamp'],
+                         10000000)
+        self.assertTrue(pd.isna(event_df.loc['u3',
+                                             'began_checkout_timestamp']))
+
+        processor = ecommerceProcessor(backend=self.backend)
+        processor.run_queries(combined_=True)
+        latency = processor.step_latency(level='session')\
+            .loc[('All', 'Viewed Page -> Added to Cart')]
+
+        # Three test range sessions add to cart after ten seconds
+        self.assertEqual(latency['count'], 3)
+        self.assertAlmostEqual(latency['p50'], 10, delta=0.1)
+
+    def test_processor_offline(self):
+        '''Test the processor runs queries through an injected backend'''
+        processor = ecommerceProcessor(backend=self.backend)
+        processor.run_queries()
+        processor.prep_events()
+
+        self.assertGreater(processor.long_event_df.shape[0], 0)
+
+
+class TestBackendSetup(unittest.TestCase):
+
+    def tearDown(self):
+        set_backend(None)
+
+    def test_lazy_client(self):
+        '''Test the BigQuery client is only created on first use'''
+        backend = bigqueryBackend()
+        self.assertIsNone(backend._client)
+
+        with mock.patch('google.cloud.bigquery.Client') as client:
+            self.assertIs(backend.client, backend.client)
+            client.assert_called_once_with(project=backend.project)
+
+    def test_swapped_backend(self):
+        '''Test loaders use the shared backend that was swapped in'''
+        self.assertIsInstance(get_backend(), bigqueryBackend)
+
+        backend = mock.Mock()
+        set_backend(backend)
+        self.assertIs(get_backend(), backend)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,12 @@
+import os
+import tempfile
 import unittest
 import pandas as pd
+from unittest import mock
+from src.data_loader import duckdbBackend, ecommerce_loader_to_parquet
 from src.data_processor import ecommerceProcessor
+from src.funnel_engine import funnel_counts
+from tests.sample_data import write_sample_shards
 
 
 class TestEcommerceProcessor(unittest.TestCase):
@@ -47,5 +53,120 @@ class TestEcommerceProcessor(unittest.TestCase):
         self.assertGreater(self.obj.long_session_df.shape[0], 0)
 
 
+class TestEcommerceProcessorOffline(unittest.TestCase):
+
+    def setUp(self):
+        """Runs the prod queries against local sample shards"""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        write_sample_shards(self.tmp_dir.name)
+        self.obj = ecommerceProcessor(backend=duckdbBackend(self.tmp_dir.name))
+        self.obj.run_queries(test_=False)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_stream_agg_conversion(self):
+        '''Test streamed aggregates match the in-memory aggregation'''
+        self.obj.prep_events()
+        self.obj.prep_agg_conversion()
+        expected = self.obj.agg_long_event_df
+
+        accumulator = self.obj.stream_agg_conversion(batch_size=2)
+
+        pd.testing.assert_frame_equal(
+            self.obj.agg_long_event_df,
+            expected.sort_values(['first_event_date', 'event'],
+                                 ignore_index=True),
+            check_dtype=False)
+        self.assertAlmostEqual(accumulator.conversion_rates()['Purchased'],
+                               self.obj.event_df['purchased'].mean())
+
+    def test_incremental_metrics(self):
+        '''Test incremental loads record their own query metrics'''
+        state_dir = os.path.join(self.tmp_dir.name, 'state')
+        self.obj.run_queries(test_=False, incremental_dir_=state_dir)
+
+        metrics = self.obj.query_metrics.to_frame()
+        self.assertEqual(sorted(metrics['query']),
+                         ['device_query', 'event_query', 'geo_query',
+                          'session_query'])
+        self.assertEqual(
+            metrics.set_index('query').loc['event_query', 'rows'],
+            self.obj.event_df.shape[0])
+
+        with self.assertRaises(ValueError):
+            self.obj.run_queries(incremental_dir_=state_dir)
+
+    def test_session_out_of_core(self):
+        '''Test row group aggregates match the in-memory session counts'''
+        path = os.path.join(self.tmp_dir.name, 'session_query.parquet')
+        self.obj.prep_session_out_of_core(parquet_path_=path, batch_size_=2)
+
+        expected = funnel_counts(self.obj.session_df, by='first_event_date')
+        pd.testing.assert_frame_equal(
+            self.obj.agg_session_df.loc[:, expected.columns], expected,
+            check_dtype=False)
+
+        # The spilled file is reused by later runs
+        self.assertTrue(os.path.exists(path))
+
+    def test_session_out_of_core_refresh(self):
+        '''Test refresh_ streams the query again on an identical call'''
+        path = os.path.join(self.tmp_dir.name, 'session_query.parquet')
+        self.obj.prep_session_out_of_core(parquet_path_=path)
+
+        with mock.patch('src.data_processor.ecommerce_loader_to_parquet',
+                        wraps=ecommerce_loader_to_parquet) as loader:
+            self.obj.prep_session_out_of_core(parquet_path_=path)
+            self.assertEqual(loader.call_count, 0)
+
+            self.obj.prep_session_out_of_core(parquet_path_=path,
+                                              refresh_=True)
+            self.obj.prep_session_out_of_core(parquet_path_=path,
+                                              refresh_=True)
+            self.assertEqual(loader.call_count, 2)
+
+        # New query results replace the aggregate used by the plots
+        self.obj.run_queries()
+        self.assertIsNone(self.obj.agg_session_df)
+
+    def test_session_out_of_core_provenance(self):
+        '''Test a file of another range or other shards is streamed again'''
+        path = os.path.join(self.tmp_dir.name, 'session_query.parquet')
+        self.obj.prep_session_out_of_core(parquet_path_=path)
+
+        with mock.patch('src.data_processor.ecommerce_loader_to_parquet',
+                        wraps=ecommerce_loader_to_parquet) as loader:
+            # The dates of run_queries are streamed, not the whole range
+            self.obj.run_queries(test_=False, end_date_='20210130')
+            self.obj.prep_session_out_of_core(parquet_path_=path)
+            self.assertEqual(loader.call_count, 1)
+
+            expected = funnel_counts(self.obj.session_df,
+                                     by='first_event_date')
+            pd.testing.assert_frame_equal(
+                self.obj.agg_session_df.loc[:, expected.columns], expected,
+                check_dtype=False)
+
+            # A new shard makes the file of the full range stale
+            os.remove(os.path.join(self.tmp_dir.name,
+                                   'events_20210131.parquet'))
+            self.obj.run_queries(test_=False, refresh_cache_=True)
+            self.obj.prep_session_out_of_core(parquet_path_=path)
+            write_sample_shards(self.tmp_dir.name)
+            self.obj.run_queries(test_=False, refresh_cache_=True)
+            self.obj.prep_session_out_of_core(parquet_path_=path)
+            self.assertEqual(loader.call_count, 3)
+            self.assertIn('20210131', self.obj.agg_session_df.index)
+
+            # The session results of incremental loads are read as they are
+            state_dir = os.path.join(self.tmp_dir.name, 'state')
+            self.obj.run_queries(test_=False, incremental_dir_=state_dir)
+            self.obj.prep_session_out_of_core(
+                parquet_path_=os.path.join(state_dir,
+                                           'session_query.parquet'))
+            self.assertEqual(loader.call_count, 3)
+
+
 if __name__ == "__main__":
     unittest.main()
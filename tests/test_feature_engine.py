@@ -0,0 +1,56 @@
+import unittest
+import numpy as np
+import pandas as pd
+from src.feature_engine import featureEncoder
+
+
+class TestFeatureEngine(unittest.TestCase):
+
+    def setUp(self):
+        """Builds customer attributes with rare and many-valued columns"""
+        rng = np.random.default_rng(0)
+        n_users = 1000
+
+        self.df = pd.DataFrame({
+            'country': rng.choice(['US', 'IN', 'CA', 'FR'], n_users,
+                                  p=[0.6, 0.3, 0.08, 0.02]),
+            'city': [f'city{i}' for i in rng.integers(0, 400, n_users)],
+            'week': rng.integers(1, 10, n_users)},
+            index=pd.Index([f'u{i}' for i in range(n_users)],
+                           name='user_pseudo_id'))
+
+    def test_matches_bucketed_dummies(self):
+        '''Test one-hot columns match get_dummies after bucketing'''
+        encoder = featureEncoder(min_frac=0.05, hashed=['city'],
+                                 n_hash_features=32)
+        features = encoder.fit_transform(self.df)
+
+        self.assertEqual(features.matrix.dtype, np.float32)
+        self.assertEqual(features.shape, (1000, 4 + 32 + 1))
+
+        fracs = self.df['country'].value_counts(normalize=True)
+        bucketed = self.df['country'].where(
+            self.df['country'].map(fracs) > 0.05, 'other')
+        expected = pd.get_dummies(bucketed, prefix='country', dtype=float)
+
+        encoded = features.to_frame()
+        pd.testing.assert_frame_equal(encoded.loc[:, expected.columns],
+                                      expected, check_dtype=False)
+
+        # Every user has one hashed city and a standardized week
+        np.testing.assert_array_equal(
+            encoded.filter(like='city_hash').sum(axis=1), 1)
+        self.assertAlmostEqual(encoded['week'].mean(), 0, places=5)
+        self.assertAlmostEqual(encoded['week'].std(ddof=0), 1, places=5)
+
+    def test_transform_new_rows(self):
+        '''Test unseen values are bucketed with the fitted columns'''
+        encoder = featureEncoder().fit(self.df.loc[:, ['country']])
+        features = encoder.transform(pd.DataFrame({'country': ['DE', 'US']}))
+
+        self.assertEqual(features.to_frame().loc[0, 'country_other'], 1)
+        self.assertEqual(features.to_frame().loc[1, 'country_US'], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
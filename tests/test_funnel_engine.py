@@ -0,0 +1,164 @@
+import unittest
+import numpy as np
+import pandas as pd
+from src.funnel_engine import (build_funnel_cube,
+                               funnel_counts,
+                               funnel_rates,
+                               ordered_funnel,
+                               step_conversion,
+                               to_long)
+
+
+class TestFunnelEngine(unittest.TestCase):
+
+    def setUp(self):
+        """Builds a random wide event table"""
+        rng = np.random.default_rng(0)
+        n_users = 500
+
+        self.wide_df = pd.DataFrame({
+            'user_pseudo_id': [f'u{i}' for i in range(n_users)],
+            'first_event_date': rng.choice(['20210130', '20210131'],
+                                           n_users),
+            'kmeans_cluster': rng.integers(0, 3, n_users),
+            'viewed_page': rng.integers(0, 2, n_users),
+            'added_to_cart': rng.integers(0, 2, n_users),
+            'began_checkout': rng.integers(0, 2, n_users),
+            'purchased': rng.integers(0, 2, n_users)})
+
+    def test_rates_match_long_format(self):
+        '''Test wide rates match the means over the melted table'''
+        long_df = self.wide_df.melt(
+            id_vars=['user_pseudo_id', 'first_event_date', 'kmeans_cluster'],
+            var_name='event',
+            value_name='occurence')
+        expected = long_df.pivot_table(index='kmeans_cluster',
+                                       columns='event',
+                                       values='occurence',
+                                       aggfunc='mean')
+
+        rates = funnel_rates(self.wide_df, by='kmeans_cluster',
+                             rename=False)
+
+        pd.testing.assert_frame_equal(rates, expected.loc[:, rates.columns],
+                                      check_names=False)
+
+    def test_counts_by_date(self):
+        '''Test counts by date are keyed by real dates'''
+        counts = funnel_counts(self.wide_df, by='first_event_date')
+
+        self.assertEqual(list(counts.index),
+                         list(pd.to_datetime(['2021-01-30', '2021-01-31'])))
+        self.assertEqual(counts['total'].sum(), self.wide_df.shape[0])
+        self.assertEqual(counts['purchased'].sum(),
+                         self.wide_df['purchased'].sum())
+
+    def test_step_conversion(self):
+        '''Test each step is relative to the previous step'''
+        conversion = step_conversion(self.wide_df, rename=False)
+        sums = self.wide_df.loc[:, ['viewed_page', 'added_to_cart']].sum()
+
+        self.assertAlmostEqual(conversion.loc['All', 'viewed_page'],
+                               sums['viewed_page'] / self.wide_df.shape[0])
+        self.assertAlmostEqual(conversion.loc['All', 'added_to_cart'],
+                               sums['added_to_cart'] / sums['viewed_page'])
+
+    def test_compact_long_format(self):
+        '''Test the long builder matches melt with compact types'''
+        long_df = to_long(self.wide_df)
+        expected = self.wide_df.melt(
+            id_vars=['user_pseudo_id', 'first_event_date', 'kmeans_cluster'],
+            var_name='event',
+            value_name='occurence')
+
+        self.assertEqual(long_df['occurence'].dtype, 'int8')
+        self.assertIsInstance(long_df['user_pseudo_id'].dtype,
+                              pd.CategoricalDtype)
+        self.assertEqual(list(long_df['event'].cat.categories),
+                         ['Viewed Page', 'Added to Cart',
+                          'Began Checkout', 'Purchased'])
+        self.assertTrue(long_df['event'].cat.ordered)
+
+        np.testing.assert_array_equal(long_df['occurence'],
+                                      expected['occurence'])
+        np.testing.assert_array_equal(long_df['user_pseudo_id'].astype(str),
+                                      expected['user_pseudo_id'])
+        self.assertTrue((long_df['first_event_date'] ==
+                         pd.to_datetime(expected['first_event_date'])).all())
+
+        # Categorical ids keep their values and categories
+        typed_df = self.wide_df.astype({'user_pseudo_id': 'category'})
+        typed_long = to_long(typed_df)
+
+        self.assertEqual(typed_long['user_pseudo_id'].dtype,
+                         typed_df['user_pseudo_id'].dtype)
+        np.testing.assert_array_equal(
+            typed_long['user_pseudo_id'].astype(str),
+            expected['user_pseudo_id'])
+
+    def test_cube_rollups(self):
+        '''Test cube rollups match counts on the wide table'''
+        rng = np.random.default_rng(1)
+        device_df = pd.DataFrame({
+            'user_pseudo_id': np.repeat(self.wide_df['user_pseudo_id'], 2),
+            'session': rng.integers(0, 1000, 2 * self.wide_df.shape[0]),
+            'category': rng.choice(['desktop', 'mobile'],
+                                   2 * self.wide_df.shape[0])})
+        cube = build_funnel_cube(self.wide_df, device_df=device_df)
+
+        pd.testing.assert_frame_equal(
+            cube.rollup('kmeans_cluster'),
+            funnel_counts(self.wide_df, by='kmeans_cluster'),
+            check_dtype=False)
+
+        # Users are counted once, in the category of their first session
+        first = device_df.sort_values('session')\
+            .drop_duplicates('user_pseudo_id')
+        mobile = self.wide_df[self.wide_df['user_pseudo_id'].isin(
+            first.loc[first['category'] == 'mobile', 'user_pseudo_id'])]
+
+        self.assertEqual(cube.rollup().loc['All', 'total'],
+                         self.wide_df.shape[0])
+        pd.testing.assert_frame_equal(
+            cube.rates(by='first_event_date',
+                       filters={'category': 'mobile'}),
+            funnel_rates(mobile, by='first_event_date'),
+            check_names=False)
+
+    def test_ordered_funnel(self):
+        '''Test steps only count when reached after the previous step'''
+        steps_df = pd.DataFrame(
+            [('a', 1, 1, 'page_view'), ('a', 1, 2, 'add_to_cart'),
+             ('a', 1, 3, 'begin_checkout'), ('a', 2, 4, 'purchase'),
+             ('b', 1, 1, 'purchase'), ('b', 1, 2, 'page_view'),
+             ('c', 1, 0, 'page_view'), ('c', 1, 1, 'add_to_cart'),
+             ('c', 1, 100, 'add_to_cart'), ('c', 1, 105, 'begin_checkout')],
+            columns=['user_pseudo_id', 'session', 'seconds', 'event_name'])
+        steps_df['event_date'] = '20210130'
+        steps_df['event_timestamp'] = steps_df['seconds'] * 1000000
+
+        flags = ['viewed_page', 'added_to_cart', 'began_checkout',
+                 'purchased']
+        users = ordered_funnel(steps_df).set_index('user_pseudo_id')
+
+        self.assertEqual(list(users.loc['a', flags]), [1, 1, 1, 1])
+        self.assertEqual(list(users.loc['b', flags]), [1, 0, 0, 0])
+        self.assertEqual(list(users.loc['c', flags]), [1, 1, 1, 0])
+
+        # The purchase of a is in another session
+        sessions = ordered_funnel(steps_df, level='session')
+        self.assertEqual(sessions.shape[0], 4)
+        self.assertEqual(sessions['purchased'].sum(), 0)
+
+        # The later add to cart of c is within 10 seconds of checkout
+        windowed = ordered_funnel(steps_df, max_windows=[None, 10, None])\
+            .set_index('user_pseudo_id')
+        self.assertEqual(windowed.loc['c', 'began_checkout'], 1)
+
+        windowed = ordered_funnel(steps_df, max_windows='10s')\
+            .set_index('user_pseudo_id')
+        self.assertEqual(windowed.loc['c', 'began_checkout'], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
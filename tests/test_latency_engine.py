@@ -0,0 +1,98 @@
+import unittest
+import numpy as np
+import pandas as pd
+from src.funnel_engine import ordered_funnel
+from src.latency_engine import (latency_histogram,
+                                latency_quantiles,
+                                quantileSketch,
+                                step_latencies)
+
+
+class TestLatencyEngine(unittest.TestCase):
+
+    def setUp(self):
+        """Builds a wide table with random step times"""
+        rng = np.random.default_rng(0)
+        n_users = 2000
+
+        start = 1611964800000000 + rng.integers(0, 10 ** 10, n_users)
+        gaps = rng.lognormal(4, 1.5, (n_users, 3)) * 1e6
+        times = np.column_stack([start, start[:, None] + gaps.cumsum(axis=1)])
+
+        # Later steps are only reached by some users
+        reached = np.cumprod(rng.random((n_users, 4)) < 0.7, axis=1)
+        times = np.where(reached == 1, times, np.nan)
+
+        self.wide_df = pd.DataFrame({
+            'user_pseudo_id': [f'u{i}' for i in range(n_users)],
+            'kmeans_cluster': rng.integers(0, 3, n_users),
+            'viewed_page_timestamp': times[:, 0],
+            'added_to_cart_timestamp': times[:, 1],
+            'began_checkout_timestamp': times[:, 2],
+            'purchased_timestamp': times[:, 3]})
+        self.gaps = np.where(reached[:, 1:] == 1, gaps / 1e6, np.nan)
+
+    def test_quantiles_within_accuracy(self):
+        '''Test sketch quantiles are within the relative accuracy'''
+        quantiles = latency_quantiles(self.wide_df, by='kmeans_cluster',
+                                      relative_accuracy=0.01)
+        cart = quantiles.xs('Viewed Page -> Added to Cart',
+                            level='transition')
+
+        for cluster in range(3):
+            gaps = self.gaps[self.wide_df['kmeans_cluster'] == cluster, 0]
+            gaps = gaps[~np.isnan(gaps)]
+
+            self.assertEqual(cart.loc[cluster, 'count'], len(gaps))
+            self.assertAlmostEqual(cart.loc[cluster, 'mean'], gaps.mean())
+            for q in [0.5, 0.9]:
+                exact = np.quantile(gaps, q, method='lower')
+                self.assertLessEqual(
+                    abs(cart.loc[cluster, f'p{q * 100:g}'] - exact),
+                    0.01 * exact + 1e-9)
+
+    def test_sketches_merge(self):
+        '''Test merged batch sketches match one sketch of all values'''
+        gaps = self.gaps[:, 2]
+        whole = quantileSketch()
+        whole.update(gaps)
+
+        merged = quantileSketch()
+        for batch in np.array_split(gaps, 4):
+            batch_sketch = quantileSketch()
+            batch_sketch.update(batch)
+            merged.merge(batch_sketch)
+
+        np.testing.assert_array_equal(merged.counts, whole.counts)
+        np.testing.assert_array_equal(merged.quantile([0.5, 0.99]),
+                                      whole.quantile([0.5, 0.99]))
+
+    def test_histogram_counts(self):
+        '''Test histogram bins add up to the measured latencies'''
+        histogram = latency_histogram(self.wide_df, bins=[0, 60, '1h'])
+        latencies = step_latencies(self.wide_df)
+
+        self.assertEqual(list(histogram.columns), ['0-60', '60-1h', '1h+'])
+        np.testing.assert_array_equal(histogram.sum(axis=1).to_numpy(),
+                                      latencies.notna().sum().to_numpy())
+        self.assertEqual(histogram.iloc[0]['0-60'],
+                         (latencies.iloc[:, 0] < 60).sum())
+
+    def test_ordered_step_times(self):
+        '''Test the ordered funnel keeps the time each step was reached'''
+        steps_df = pd.DataFrame(
+            [('a', 1, 5, 'add_to_cart'), ('a', 1, 10, 'page_view'),
+             ('a', 1, 30, 'add_to_cart'), ('a', 1, 40, 'add_to_cart')],
+            columns=['user_pseudo_id', 'session', 'seconds', 'event_name'])
+        steps_df['event_date'] = '20210130'
+        steps_df['event_timestamp'] = steps_df['seconds'] * 1000000
+
+        latencies = step_latencies(ordered_funnel(steps_df))
+
+        # The cart before the page view does not count
+        self.assertEqual(latencies.iloc[0, 0], 20)
+        self.assertTrue(latencies.iloc[0, 1:].isna().all())
+
+
+if __name__ == "__main__":
+    unittest.main()
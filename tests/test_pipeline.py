@@ -0,0 +1,133 @@
+import os
+import tempfile
+import unittest
+import pandas as pd
+from src.data_loader import duckdbBackend
+from src.data_processor import ecommerceProcessor
+from src.segmentation import customerSegmentation
+from tests.sample_data import write_sample_shards, SAMPLE_EVENTS
+
+
+class TestPipelineDAG(unittest.TestCase):
+
+    def setUp(self):
+        """Creates a processor over local sample shards"""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        write_sample_shards(self.tmp_dir.name)
+        self.obj = ecommerceProcessor(backend=duckdbBackend(self.tmp_dir.name))
+        self.obj.run_queries(test_=False)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_stage_runs_once(self):
+        '''Test a stage is skipped until its inputs or arguments change'''
+        self.obj.prep_events()
+        version = self.obj.pipeline.versions['long_event_df']
+
+        self.obj.prep_events()
+        self.assertEqual(self.obj.pipeline.versions['long_event_df'], version)
+
+        self.obj.prep_events(rename=False)
+        self.assertEqual(self.obj.pipeline.versions['long_event_df'],
+                         version + 1)
+
+    def test_upstream_change_invalidates(self):
+        '''Test new query results rerun only the stages reading them'''
+        self.obj.prep_events()
+        self.obj.prep_session()
+        versions = dict(self.obj.pipeline.versions)
+
+        self.obj.run_queries(start_date_='20210130')
+        self.obj.prep_events()
+        self.obj.prep_session()
+
+        self.assertEqual(set(self.obj.event_df['first_event_date']),
+                         {'20210130', '20210131'})
+        self.assertEqual(self.obj.pipeline.versions['long_event_df'],
+                         versions['long_event_df'] + 1)
+        self.assertEqual(self.obj.pipeline.versions['long_session_df'],
+                         versions['long_session_df'] + 1)
+        self.assertEqual(self.obj.pipeline.versions['funnel_cube'],
+                         versions['funnel_cube'])
+
+    def test_repeated_loads_pick_up_new_shards(self):
+        '''Test refreshing and incremental loads rerun on identical calls'''
+        for load_args in [{'refresh_cache_': True},
+                          {'incremental_dir_': 'state'}]:
+            with tempfile.TemporaryDirectory() as shard_dir:
+                write_sample_shards(shard_dir,
+                                    [event for event in SAMPLE_EVENTS
+                                     if event[0] != '20210131'])
+                processor = ecommerceProcessor(
+                    backend=duckdbBackend(shard_dir))
+                if 'incremental_dir_' in load_args:
+                    load_args['incremental_dir_'] = os.path.join(shard_dir,
+                                                                 'state')
+
+                processor.run_queries(test_=False, **load_args)
+                processor.prep_session()
+                self.assertNotIn('20210131',
+                                 set(processor.session_df['first_event_date']))
+
+                # A new daily shard arrives and the same call is repeated
+                write_sample_shards(shard_dir)
+                processor.run_queries(test_=False, **load_args)
+                self.assertIn('20210131',
+                              set(processor.session_df['first_event_date']))
+
+                # Stages reading the loads rerun on the new data, but
+                # don't load again themselves
+                version = processor.pipeline.versions['session_df']
+                processor.prep_session()
+                self.assertEqual(processor.pipeline.versions['session_df'],
+                                 version)
+                self.assertIn(pd.Timestamp('20210131'), set(
+                    processor.long_session_df['first_event_date']))
+
+    def test_reassigned_input_reruns(self):
+        '''Test reassigning an artifact outside the pipeline reruns readers'''
+        self.obj.prep_events()
+        n_rows = self.obj.long_event_df.shape[0]
+
+        self.obj.event_df = self.obj.event_df.iloc[:1]
+        self.obj.prep_events()
+
+        self.assertEqual(self.obj.long_event_df.shape[0], 4)
+        self.assertGreater(n_rows, 4)
+
+        # Unchanged inputs are still skipped
+        version = self.obj.pipeline.versions['long_event_df']
+        self.obj.prep_events()
+        self.assertEqual(self.obj.pipeline.versions['long_event_df'], version)
+
+    def test_in_place_segments_rerun_readers(self):
+        '''Test stages reading event_df rerun after segments are added'''
+        customerSegmentation(self.obj, n_centers_=2)
+        self.obj.prep_events()
+        self.assertNotIn('kmeans_cluster', self.obj.long_event_df.columns)
+
+        self.obj.prep_segments_conversion_heatmap()
+        self.obj.prep_events()
+        self.assertIn('kmeans_cluster', self.obj.long_event_df.columns)
+
+        # Adding the segments doesn't make the segments stage out of date
+        version = self.obj.pipeline.versions['event_df']
+        self.obj.prep_segments_conversion_heatmap()
+        self.assertEqual(self.obj.pipeline.versions['event_df'], version)
+
+    def test_segments_resolve_upstream(self):
+        '''Test downstream stages run the segmentation stages they need'''
+        with self.assertRaises(ValueError):
+            self.obj.prep_segments_conversion_heatmap()
+
+        customerSegmentation(self.obj, n_centers_=2)
+        self.obj.prep_segments_conversion_heatmap()
+
+        self.assertTrue(self.obj.created_segments)
+        self.assertIn('kmeans_cluster', self.obj.event_df.columns)
+        self.assertEqual(list(self.obj.heatmap_conversion_df.columns), [0, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+import importlib.util
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from src import funnel_engine, polars_engine
+from src.data_loader import duckdbBackend
+from src.data_processor import ecommerceProcessor
+from tests.sample_data import write_sample_shards
+
+
+@unittest.skipIf(importlib.util.find_spec('polars') is None,
+                 'polars is not installed')
+class TestPolarsEngine(unittest.TestCase):
+
+    def setUp(self):
+        """Builds random user and session tables, plain and typed"""
+        rng = np.random.default_rng(0)
+        n_users = 1000
+        users = pd.Series([f'u{i}' for i in rng.integers(0, 800, n_users)])
+
+        self.event_df = pd.DataFrame({
+            'user_pseudo_id': users,
+            'first_event_date': rng.choice(['20210130', '20210131'],
+                                           n_users),
+            'kmeans_cluster': rng.integers(0, 3, n_users),
+            'viewed_page': rng.integers(0, 2, n_users),
+            'added_to_cart': rng.integers(0, 2, n_users),
+            'began_checkout': rng.integers(0, 2, n_users),
+            'purchased': rng.integers(0, 2, n_users)})
+        self.typed_df = self.event_df.astype({
+            'user_pseudo_id': 'category',
+            'first_event_date': 'datetime64[ms]',
+            'viewed_page': 'int8',
+            'added_to_cart': 'int8',
+            'began_checkout': 'int8',
+            'purchased': 'int8'})
+        self.device_df = pd.DataFrame({
+            'user_pseudo_id': np.repeat(users, 2),
+            'session': rng.integers(0, 100, 2 * n_users),
+            'category': rng.choice(['desktop', 'mobile', None],
+                                   2 * n_users)})
+
+    def test_counts_parity(self):
+        '''Test funnel counts, rates and step conversion match pandas'''
+        for wide_df in [self.event_df, self.typed_df]:
+            for by in [None, 'first_event_date', 'kmeans_cluster']:
+                for name in ['funnel_counts', 'funnel_rates',
+                             'step_conversion']:
+                    pd.testing.assert_frame_equal(
+                        getattr(polars_engine, name)(wide_df, by=by),
+                        getattr(funnel_engine, name)(wide_df, by=by))
+
+    def test_long_parity(self):
+        '''Test the long format matches pandas, dtypes included'''
+        for wide_df in [self.event_df, self.typed_df]:
+            for rename in [True, False]:
+                pd.testing.assert_frame_equal(
+                    polars_engine.to_long(wide_df, rename=rename),
+                    funnel_engine.to_long(wide_df, rename=rename))
+
+    def test_cube_parity(self):
+        '''Test the funnel cube matches pandas'''
+        for wide_df in [self.event_df, self.typed_df]:
+            pd.testing.assert_frame_equal(
+                polars_engine.build_funnel_cube(
+                    wide_df, device_df=self.device_df).counts,
+                funnel_engine.build_funnel_cube(
+                    wide_df, device_df=self.device_df).counts)
+
+    def test_processor_parity(self):
+        '''Test the processor stages match with either engine'''
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            write_sample_shards(tmp_dir)
+            processors = [ecommerceProcessor(backend=duckdbBackend(tmp_dir),
+                                             engine=engine)
+                          for engine in ['pandas', 'polars']]
+
+            for obj in processors:
+                obj.run_queries(test_=False)
+                obj.prep_events()
+                obj.prep_session()
+                obj.prep_agg_conversion()
+                obj.prep_funnel_cube()
+
+        pandas_obj, polars_obj = processors
+        for attr in ['long_event_df', 'long_session_df',
+                     'agg_long_event_df']:
+            pd.testing.assert_frame_equal(getattr(polars_obj, attr),
+                                          getattr(pandas_obj, attr))
+        pd.testing.assert_frame_equal(polars_obj.funnel_cube.counts,
+                                      pandas_obj.funnel_cube.counts)
+        pd.testing.assert_frame_equal(polars_obj.step_conversion(),
+                                      pandas_obj.step_conversion())
+
+
+if __name__ == "__main__":
+    unittest.main()
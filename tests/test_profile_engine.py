@@ -0,0 +1,63 @@
+import unittest
+import pandas as pd
+from src.profile_engine import (attribute_counts,
+                                build_customer_profiles,
+                                merge_attribute_counts,
+                                pick_attributes)
+
+
+class TestProfileEngine(unittest.TestCase):
+
+    def setUp(self):
+        """Builds users seen on several devices"""
+        self.event_df = pd.DataFrame({
+            'user_pseudo_id': ['a', 'b', 'c'],
+            'first_event_date': ['20210130', '20210130', '20210131']})
+
+        self.device_df = pd.DataFrame(
+            [('a', 1, 'desktop', 'Google', 'Windows'),
+             ('a', 2, 'mobile', 'Apple', 'iOS'),
+             ('a', 3, 'mobile', 'Apple', 'iOS'),
+             ('b', 5, 'mobile', 'Apple', 'iOS'),
+             ('b', 4, 'tablet', 'Apple', 'iOS')],
+            columns=['user_pseudo_id', 'session', 'category',
+                     'mobile_brand_name', 'operating_system'])
+
+    def test_one_row_per_user(self):
+        '''Test users on several devices get the most frequent device'''
+        customer_df = build_customer_profiles(self.event_df,
+                                              device_df=self.device_df)
+        profiles = customer_df.set_index('user_pseudo_id')
+
+        self.assertEqual(customer_df.shape[0], self.event_df.shape[0])
+        self.assertEqual(profiles.loc['a', 'category'], 'mobile')
+        self.assertEqual(profiles.loc['a', 'device_sessions'], 2)
+        self.assertEqual(profiles.loc['a', 'device_values'], 2)
+
+        # Ties go to the earliest session, users without sessions stay
+        self.assertEqual(profiles.loc['b', 'category'], 'tablet')
+        self.assertTrue(pd.isna(profiles.loc['c', 'category']))
+
+    def test_first_rule(self):
+        '''Test the first rule picks the device of the first session'''
+        cols = ['category', 'mobile_brand_name', 'operating_system']
+        picked = pick_attributes(attribute_counts(self.device_df, cols),
+                                 cols, rule='first')
+
+        self.assertEqual(picked.loc['a', 'category'], 'desktop')
+        self.assertEqual(picked.loc['b', 'category'], 'tablet')
+
+    def test_merged_batches(self):
+        '''Test counts of separate batches add up to the full counts'''
+        cols = ['category', 'mobile_brand_name', 'operating_system']
+        merged = merge_attribute_counts(
+            [attribute_counts(self.device_df.iloc[:2], cols),
+             attribute_counts(self.device_df.iloc[2:], cols)], cols)
+
+        pd.testing.assert_frame_equal(
+            pick_attributes(merged, cols),
+            pick_attributes(attribute_counts(self.device_df, cols), cols))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import tempfile
+import time
+import unittest
+import pandas as pd
+from unittest import mock
+from src.data_loader import duckdbBackend, ecommerce_loader_prod
+from src.query_cache import queryCache
+from tests.sample_data import write_sample_shards
+
+
+class TestQueryCache(unittest.TestCase):
+
+    def setUp(self):
+        """Creates an empty cache in a temporary directory"""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = queryCache(os.path.join(self.tmp_dir.name, 'cache'))
+        self.df = pd.DataFrame({'user_pseudo_id': ['u1', 'u2'],
+                                'purchased': [1, 0]})
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_key_normalization(self):
+        '''Test formatting does not change the key but suffixes do'''
+        key = self.cache.key('SELECT 1\n  FROM t -- comment\n;')
+
+        self.assertEqual(key, self.cache.key('SELECT 1 FROM t'))
+        self.assertNotEqual(key, self.cache.key('SELECT 1 FROM t',
+                                                ('20210101', '20210107')))
+
+    def test_ttl_expiry(self):
+        '''Test expired results are treated as misses'''
+        key = self.cache.key('SELECT 1')
+        self.cache.put(key, self.df)
+
+        pd.testing.assert_frame_equal(self.cache.get(key), self.df)
+
+        self.cache.ttl_seconds = 0
+        time.sleep(0.01)
+        self.assertIsNone(self.cache.get(key))
+
+    def test_lru_eviction(self):
+        '''Test the least recently used result is evicted first'''
+        keys = [self.cache.key(f'SELECT {i}') for i in range(3)]
+        for i, key in enumerate(keys):
+            self.cache.put(key, self.df)
+            path = os.path.join(self.cache.cache_dir, f'{key}.parquet')
+            os.utime(path, (i, time.time()))
+
+        # Reading the first result makes the second the oldest
+        self.cache.get(keys[0])
+        self.cache.max_bytes = 2 * os.path.getsize(path)
+        self.cache.evict()
+
+        self.assertIsNotNone(self.cache.get(keys[0]))
+        self.assertIsNone(self.cache.get(keys[1]))
+        self.assertIsNotNone(self.cache.get(keys[2]))
+
+    def test_loader_uses_cache(self):
+        '''Test cached loader results skip the backend'''
+        write_sample_shards(self.tmp_dir.name)
+        backend = duckdbBackend(self.tmp_dir.name)
+
+        first = ecommerce_loader_prod(return_dict=True, backend=backend,
+                                      cache=self.cache)
+
+        with mock.patch.object(backend, 'query') as query:
+            cached = ecommerce_loader_prod(return_dict=True,
+                                           backend=backend,
+                                           cache=self.cache)
+            query.assert_not_called()
+
+        pd.testing.assert_frame_equal(first['event_query'],
+                                      cached['event_query'],
+                                      check_dtype=False)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from src.data_loader import duckdbBackend
+from src.data_processor import ecommerceProcessor
+from src.funnel_engine import build_funnel_cube, funnel_counts
+from src.sharded_executor import hash_partition, shardedExecutor
+from tests.sample_data import write_sample_shards
+
+
+class TestShardedExecutor(unittest.TestCase):
+
+    def setUp(self):
+        """Builds random user and session tables"""
+        rng = np.random.default_rng(0)
+        n_users = 1000
+        users = pd.Series([f'u{i}' for i in range(n_users)])
+
+        self.event_df = pd.DataFrame({
+            'user_pseudo_id': users,
+            'first_event_date': rng.choice(['20210130', '20210131'],
+                                           n_users),
+            'viewed_page': rng.integers(0, 2, n_users),
+            'added_to_cart': rng.integers(0, 2, n_users),
+            'began_checkout': rng.integers(0, 2, n_users),
+            'purchased': rng.integers(0, 2, n_users)})
+        self.device_df = pd.DataFrame({
+            'user_pseudo_id': np.repeat(users, 2),
+            'session': rng.integers(0, 10000, 2 * n_users),
+            'category': rng.choice(['desktop', 'mobile', None],
+                                   2 * n_users)})
+
+        self.executor = shardedExecutor(n_workers=2, n_shards=3)
+
+    def test_partition_is_stable(self):
+        '''Test a user gets the same shard whatever the id encoding'''
+        users = self.event_df['user_pseudo_id']
+
+        np.testing.assert_array_equal(
+            hash_partition(users, 3),
+            hash_partition(users.astype('category'), 3))
+
+    def test_matches_serial(self):
+        '''Test sharded aggregations are identical to the serial ones'''
+        pd.testing.assert_frame_equal(
+            self.executor.funnel_counts(self.event_df,
+                                        by='first_event_date'),
+            funnel_counts(self.event_df, by='first_event_date'))
+
+        pd.testing.assert_frame_equal(
+            self.executor.funnel_cube(self.event_df,
+                                      device_df=self.device_df).counts,
+            build_funnel_cube(self.event_df,
+                              device_df=self.device_df).counts)
+
+    def test_processor_workers(self):
+        '''Test the processor gives the same results with workers'''
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            write_sample_shards(tmp_dir)
+            serial = ecommerceProcessor(backend=duckdbBackend(tmp_dir))
+            sharded = ecommerceProcessor(backend=duckdbBackend(tmp_dir),
+                                         n_workers=2)
+
+            for obj in [serial, sharded]:
+                obj.run_queries(test_=False)
+                obj.prep_agg_conversion()
+                obj.prep_funnel_cube()
+
+        pd.testing.assert_frame_equal(sharded.agg_long_event_df,
+                                      serial.agg_long_event_df)
+        pd.testing.assert_frame_equal(sharded.funnel_cube.counts,
+                                      serial.funnel_cube.counts)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from src.data_loader import duckdbBackend
+from src.data_processor import ecommerceProcessor
+from src.segmentation import customerSegmentation
+from src.snapshot import snapshotStore
+from tests.sample_data import write_sample_shards
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        """Runs the processor and segmentation over local sample shards"""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        write_sample_shards(self.tmp_dir.name)
+        self.snapshot_dir = os.path.join(self.tmp_dir.name, 'snapshots')
+
+        self.processor = ecommerceProcessor(
+            backend=duckdbBackend(self.tmp_dir.name))
+        self.segmentation = customerSegmentation(self.processor,
+                                                 n_centers_=2)
+        self.processor.prep_events()
+        self.processor.prep_segments_conversion_heatmap()
+
+        # Adding the segments changed event_df, the long events follow
+        self.processor.prep_events()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_versions(self):
+        '''Test every save adds a version and loads default to the latest'''
+        store = snapshotStore(self.snapshot_dir)
+        store.save({'df': pd.DataFrame({'a': [1, 2]})})
+        store.save({'df': pd.DataFrame({'a': [3]})})
+
+        self.assertEqual(store.versions(), ['v0001', 'v0002'])
+        self.assertEqual(store.load()[0]['df']['a'].tolist(), [3])
+        self.assertEqual(store.load('v0001')[0]['df']['a'].tolist(), [1, 2])
+
+    def test_interrupted_save(self):
+        '''Test a partial save directory is not taken for a version'''
+        store = snapshotStore(self.snapshot_dir)
+        store.save({'df': pd.DataFrame({'a': [1]})})
+
+        # A save stopped after its manifest was written, before the rename
+        partial = os.path.join(self.snapshot_dir, 'v0002.tmp')
+        os.makedirs(partial)
+        with open(os.path.join(partial, 'manifest.json'), 'w') as f:
+            f.write('{}')
+
+        self.assertEqual(store.versions(), ['v0001'])
+        self.assertEqual(store.load()[0]['df']['a'].tolist(), [1])
+        self.assertEqual(store.save({'df': pd.DataFrame({'a': [2]})}),
+                         'v0002')
+        self.assertEqual(store.load()[0]['df']['a'].tolist(), [2])
+
+    def test_restore_resumes(self):
+        '''Test a restored processor skips stages that already ran'''
+        self.segmentation.save_snapshot(self.snapshot_dir)
+
+        processor = ecommerceProcessor()
+        processor.restore_snapshot(self.snapshot_dir)
+        segmentation = customerSegmentation(processor, n_centers_=2)
+        segmentation.restore_snapshot(self.snapshot_dir)
+
+        for attr in ['event_df', 'long_event_df', 'heatmap_conversion_df']:
+            pd.testing.assert_frame_equal(getattr(processor, attr),
+                                          getattr(self.processor, attr))
+        pd.testing.assert_frame_equal(processor.funnel_cube.counts,
+                                      self.processor.funnel_cube.counts)
+        np.testing.assert_array_equal(
+            segmentation.k_means.predict(segmentation.cluster_features.matrix),
+            self.segmentation.k_means.predict(
+                self.segmentation.cluster_features.matrix))
+
+        # Nothing reruns, and there is no backend to rerun the queries
+        versions = dict(processor.pipeline.versions)
+        processor.prep_events()
+        processor.prep_segments_conversion_heatmap()
+        self.assertTrue(processor.created_segments)
+        self.assertEqual(processor.pipeline.versions, versions)
+
+
+if __name__ == "__main__":
+    unittest.main()